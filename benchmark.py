@@ -0,0 +1,464 @@
+import os
+import sys
+import json
+import time
+import pickle
+import getopt
+import platform
+import tempfile
+import numpy as np
+
+from carryover import gene2phen, offspringGenotypeFnc, broodFnc, dispFnc, compnSimpleFnc, parameterModel, RandomStream, ecosystemSnapshot
+from individuals import Individual, Flock
+from timestep import timestep
+from timestepVec import timestepVec, ecosystem2popn
+from expected import expectedTables, expectedStart, timestepExpected, simulateExpected
+from simulate import simulate
+from plotFigure1s import figure1Data
+from sweep import landscapeH
+
+# Benchmarks of the hot paths of the simulation, so that speedups can be measured and slowdowns caught, e.g.
+#
+#   $ python benchmark.py -l 'before'      # runs all the benchmarks and appends the timings to benchmarks.json
+#   $ python benchmark.py -l 'after'
+#   $ python benchmark.py -c               # compares the last two runs in benchmarks.json, flagging slowdowns
+#
+# Each benchmark does its setup and returns the function to time. The function is called number times per repeat,
+# where number is chosen so that a repeat takes at least minTime seconds, and the best and median time per call are kept.
+# The history file is a JSON list of runs, each a dictionary
+#
+#   {'label': ..., 'time': ..., 'platform': ..., 'python': ..., 'numpy': ...,
+#       'timings': {name: {'best': seconds, 'median': seconds, 'number': ..., 'repeat': ...}}}
+#
+# The benchmarks run in a temporary directory, so the files simulate writes are not left behind.
+
+
+def benchParameters(geneTypes=('repn', 'neut'), rMax=10):
+    """
+    Returns the parameters of script.py with the given gene types and maximum number of offspring
+    """
+
+    genetics = {
+            'repn': {'noLoci': 20, 'maxPhen': 2,  'minPhen': -2,  'isInt': False, 'pMut': 0.001},
+            'neut': {'noLoci': 20, 'maxPhen': 1,  'minPhen': -1,  'isInt': False, 'pMut': 0.001},
+            'pref': {'noLoci': 20, 'maxPhen': 10, 'minPhen': -10, 'isInt': False, 'pMut': 0.001},
+            'phil': {'noLoci': 20, 'maxPhen': 10, 'minPhen': -10, 'isInt': False, 'pMut': 0.001},
+            'dist': {'noLoci': 20, 'maxPhen': 25, 'minPhen':   0, 'isInt': True,  'pMut': 0.001},
+            }
+
+    parameters = {
+            'sexes': ('h', 'h'),
+            'genetics': { geneType: genetics[geneType] for geneType in geneTypes },
+            'distMax': None if 'dist' in geneTypes else 7,
+            'habitats': {
+                    'L': {'rMax': rMax, 'phenOpt': -1, 'sd': 1.11},
+                    'H': {'rMax': rMax, 'phenOpt':  1, 'sd': 1.11},
+                    },
+            'competition': {'L': 1, 'H': 10},
+            }
+
+    return parameters
+
+def benchEcosystem(parameters, landscape, rng):
+    """
+    Returns a random initial ecosystem with a mating pair in every territory, as simulate makes
+    """
+
+    genotypeFnc = lambda: { geneType: rng.getrandbits( geneParams['noLoci'] ) for geneType, geneParams in parameters['genetics'].items() }
+
+    return [ Flock( [ Individual(sex, habType, genotypeFnc()) for sex in parameters['sexes'] ] ) for habType in landscape ]
+
+def benchOffspring(parameters, landscape, noOffspring, rng):
+    """
+    Returns noOffspring random offspring and their natal locations
+    """
+
+    ecosystem = benchEcosystem(parameters, landscape, rng)
+    locns = [ rng.randint(0, len(landscape)-1) for cnt in range(noOffspring) ]
+
+    return [ Individual( ecosystem[locn].adults[0].sex, landscape[locn], ecosystem[locn].adults[0].genotype ) for locn in locns ], locns
+
+# each benchmark's setup, which returns the function to time
+
+def _benchGene2phen(useModel):
+
+    rng = RandomStream(1)
+    parameters = benchParameters()
+    model = parameterModel(parameters) if useModel else parameters
+    genes = [ rng.getrandbits(20) for cnt in range(1000) ]
+
+    return lambda: [ gene2phen(model, gene, 'repn') for gene in genes ]
+
+def _benchOffspringGenotype():
+
+    rng = RandomStream(1)
+    parameters = benchParameters()
+    parGenotypes = [ { geneType: ( rng.getrandbits(20), rng.getrandbits(20) ) for geneType in parameters['genetics'] } for cnt in range(1000) ]
+
+    return lambda: [ offspringGenotypeFnc(parameters, parGenotype, rng) for parGenotype in parGenotypes ]
+
+def _benchBrood():
+
+    rng = RandomStream(1)
+    landscape = landscapeH(51, 9)
+    model = parameterModel( benchParameters(), landscape )
+    parGenotypes = [ { geneType: ( rng.getrandbits(20), rng.getrandbits(20) ) for geneType in model['genetics'] } for cnt in range(100) ]
+
+    return lambda: [ broodFnc(model, parGenotype, 'L', 0, 10, landscape, rng) for parGenotype in parGenotypes ] # 1000 offspring
+
+def _benchDisp(geneType):
+
+    rng = RandomStream(1)
+    landscape = landscapeH(51, 9)
+    model = parameterModel( benchParameters( ('repn',) if geneType is None else ('repn', geneType) ), landscape )
+    offspring, locns = benchOffspring(model, landscape, 1000, rng)
+
+    return lambda: [ dispFnc(model, off, locn, landscape, rng) for off, locn in zip(offspring, locns) ]
+
+def _benchCompnSimple():
+
+    rng = RandomStream(1)
+    parameters = benchParameters()
+    juveniles, locns = benchOffspring(parameters, landscapeH(51, 9), 50, rng)
+
+    return lambda: compnSimpleFnc( parameters, Flock( list(), list(juveniles) ), rng )
+
+def _benchTimestep(engine):
+
+    rng = RandomStream(1)
+    landscape = landscapeH(51, 9)
+    model = parameterModel( benchParameters(), landscape )
+    ecosystem = benchEcosystem(model, landscape, rng)
+
+    if engine == 'numpy':
+
+        popn = [ ecosystem2popn(model, ecosystem) ]
+        generator = rng.generator
+
+        def stepFnc(): # step on from the last generation, as simulate does
+            popn[0] = timestepVec(model, popn[0], landscape, generator)[0]
+
+        return stepFnc
+
+    if engine == 'expected':
+
+        tables = expectedTables(model, landscape)
+        state = [ expectedStart(model, landscape, ecosystem) ]
+
+        def stepFnc():
+            state[0] = timestepExpected(model, state[0], landscape, None, tables)[0]
+
+        return stepFnc
+
+    return lambda: timestep(model, ecosystem, landscape, rng)
+
+def _benchSimulate(lenLandscape, rMax, engine):
+
+    parameters = benchParameters(rMax=rMax)
+    landscape = landscapeH( lenLandscape, lenLandscape*9 // 51 )
+
+    return lambda: simulate(parameters, landscape, 0, 10, engine=engine, record=None, seed=1)
+
+def _benchSimulateExpected(lenLandscape):
+
+    parameters = benchParameters()
+    landscape = landscapeH( lenLandscape, lenLandscape*9 // 51 )
+
+    return lambda: simulateExpected(parameters, landscape, 2000, every=2000, tol=1e-4) # a grid point of sweepExpected, run until it settles
+
+def _benchEcosystems():
+
+    rng = RandomStream(1)
+    landscape = landscapeH(51, 9)
+    model = parameterModel( benchParameters(), landscape )
+    ecosystem = benchEcosystem(model, landscape, rng)
+    ecosystems = list()
+
+    for t in range(100):
+        ecosystem = timestep(model, ecosystem, landscape, rng)[0]
+        ecosystems.append( ecosystemSnapshot(ecosystem) )
+
+    return ecosystems
+
+def _benchPickleWrite():
+
+    ecosystems = _benchEcosystems()
+
+    def writeFnc():
+        with open('bench_ecosystems.pkl', 'wb') as f:
+            pickle.dump(ecosystems, f)
+
+    return writeFnc
+
+def _benchPickleRead():
+
+    _benchPickleWrite()()
+
+    def readFnc():
+        with open('bench_ecosystems.pkl', 'rb') as f:
+            return pickle.load(f)
+
+    return readFnc
+
+def _benchFigure1Data():
+
+    simulate( benchParameters(), landscapeH(51, 9), 0, 100, seed=1, suffix='_bench' )
+
+    return lambda: figure1Data('ecosystems_bench.pkl', seed=1)
+
+benchmarks = {
+        'gene2phen': lambda: _benchGene2phen(False),
+        'gene2phen_model': lambda: _benchGene2phen(True),
+        'offspringGenotypeFnc': _benchOffspringGenotype,
+        'broodFnc': _benchBrood,
+        'dispFnc_random': lambda: _benchDisp(None),
+        'dispFnc_pref': lambda: _benchDisp('pref'),
+        'dispFnc_phil': lambda: _benchDisp('phil'),
+        'dispFnc_dist': lambda: _benchDisp('dist'),
+        'compnSimpleFnc': _benchCompnSimple,
+        'timestep': lambda: _benchTimestep('dicts'),
+        'timestepVec': lambda: _benchTimestep('numpy'),
+        'timestepExpected': lambda: _benchTimestep('expected'),
+        }
+
+benchmarks.update( { 'simulate_L%d_r%d' % (lenLandscape, rMax): ( lambda lenLandscape=lenLandscape, rMax=rMax: _benchSimulate(lenLandscape, rMax, 'dicts') )
+        for lenLandscape in [51, 201, 1001] for rMax in [5, 10, 20] } )
+
+benchmarks.update( { 'simulate_L%d_r10_numpy' % lenLandscape: ( lambda lenLandscape=lenLandscape: _benchSimulate(lenLandscape, 10, 'numpy') )
+        for lenLandscape in [1001, 10001] } )
+
+benchmarks.update( { 'simulateExpected_L%d_settled' % lenLandscape: ( lambda lenLandscape=lenLandscape: _benchSimulateExpected(lenLandscape) )
+        for lenLandscape in [51, 1001] } )
+
+benchmarks.update( {
+        'pickleWrite': _benchPickleWrite,
+        'pickleRead': _benchPickleRead,
+        'figure1Data': _benchFigure1Data,
+        } )
+
+def timeBenchmark(fnc, repeat=5, minTime=0.2):
+    """
+    timing = timeBenchmark(fnc, repeat=5, minTime=0.2)
+
+    Times calls of fnc, doubling the number of calls per repeat until a repeat takes at least minTime seconds
+
+    timing:
+        dictionary, with the 'best' and 'median' time per call over the repeats, and the 'number' of calls per repeat and 'repeat'
+
+    >>> timing = timeBenchmark(lambda: None, repeat=3, minTime=0.001)
+    >>> sorted(timing.keys()), timing['repeat'], timing['best'] <= timing['median']
+    (['best', 'median', 'number', 'repeat'], 3, True)
+    """
+
+    def timeCalls(number):
+
+        start = time.perf_counter()
+        for cnt in range(number):
+            fnc()
+        return time.perf_counter() - start
+
+    number = 1
+    elapsed = timeCalls(number)
+
+    while elapsed < minTime:
+        number *= 2
+        elapsed = timeCalls(number)
+
+    times = [elapsed] + [ timeCalls(number) for cnt in range(repeat-1) ]
+    times = [ elapsed / number for elapsed in times ]
+
+    return { 'best': min(times), 'median': float( np.median(times) ), 'number': number, 'repeat': repeat }
+
+def runBenchmarks(names=None, repeat=5, minTime=0.2, verbose=False):
+    """
+    timings = runBenchmarks(names=None, repeat=5, minTime=0.2, verbose=False)
+
+    Runs the benchmarks in a temporary directory and returns their timings
+
+    names:
+        list of strings, the benchmarks to run (keys of benchmarks), if None all of them
+    timings:
+        dictionary, keys are the benchmark names and values their timings (see timeBenchmark)
+    """
+
+    if names is None:
+        names = list( benchmarks.keys() )
+
+    unknown = [ name for name in names if name not in benchmarks ]
+    if unknown:
+        raise ValueError('unknown benchmarks ' + ', '.join(unknown))
+
+    timings = dict()
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory(prefix='benchmark') as dirName: # removed with the files the benchmarks write
+
+        os.chdir(dirName)
+
+        try:
+
+            for name in names:
+
+                timings[name] = timeBenchmark( benchmarks[name](), repeat, minTime )
+
+                if verbose:
+                    print('%-28s %12.6f s' % ( name, timings[name]['best'] ))
+
+        finally:
+
+            os.chdir(cwd)
+
+    return timings
+
+def historyLoad(fName):
+    """
+    Returns the list of benchmark runs in the history file fName, or an empty list if there is none
+    """
+
+    if not os.path.exists(fName):
+        return list()
+
+    with open(fName) as f:
+        return json.load(f)
+
+def historyAppend(fName, timings, label=None):
+    """
+    Appends a run of the benchmarks, with their timings and a description of the machine, to the history file fName
+    """
+
+    history = historyLoad(fName)
+    history.append( {
+            'label': label,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'timings': timings,
+            } )
+
+    with open(fName, 'w') as f:
+        json.dump(history, f, indent=1)
+
+def compareRuns(baseRun, newRun, tol=0.1):
+    """
+    rows = compareRuns(baseRun, newRun, tol=0.1)
+
+    Compares the best times of the benchmarks in both runs
+
+    tol:
+        float, a benchmark is flagged 'slower' if its time increased by more than the fraction tol, and 'faster' if it decreased
+        by as much
+    rows:
+        list of tuples (name, base time, new time, new / base, flag), where flag is 'slower', 'faster' or ''
+
+    >>> baseRun = {'timings': {'a': {'best': 1.0}, 'b': {'best': 1.0}, 'c': {'best': 1.0}}}
+    >>> newRun = {'timings': {'a': {'best': 1.5}, 'b': {'best': 0.5}, 'c': {'best': 1.05}}}
+    >>> [ (name, flag) for name, baseTime, newTime, ratio, flag in compareRuns(baseRun, newRun) ]
+    [('a', 'slower'), ('b', 'faster'), ('c', '')]
+    """
+
+    rows = list()
+
+    for name, newTiming in newRun['timings'].items():
+
+        if name not in baseRun['timings']:
+            continue
+
+        baseTime = baseRun['timings'][name]['best']
+        newTime = newTiming['best']
+        ratio = newTime / baseTime if baseTime > 0 else float('inf')
+
+        if ratio > 1 + tol:
+            flag = 'slower'
+        elif ratio < 1 / (1 + tol):
+            flag = 'faster'
+        else:
+            flag = ''
+
+        rows.append( (name, baseTime, newTime, ratio, flag) )
+
+    return rows
+
+def printComparison(baseRun, newRun, rows):
+
+    print( 'base: %s (%s)' % ( baseRun.get('label'), baseRun.get('time') ) )
+    print( 'new:  %s (%s)' % ( newRun.get('label'), newRun.get('time') ) )
+    print( '%-28s %12s %12s %8s' % ( 'benchmark', 'base (s)', 'new (s)', 'ratio' ) )
+
+    for name, baseTime, newTime, ratio, flag in rows:
+        print( '%-28s %12.6f %12.6f %8.2f %s' % ( name, baseTime, newTime, ratio, flag.upper() if flag == 'slower' else flag ) )
+
+if __name__ == "__main__":
+
+    usage = 'benchmark.py [-o <history file>] [-l <label>] [-b <benchmark,benchmark,...>] [-r <repeats>] [-q] | -c [-o <history file>] [-i <base run>,<new run>] [-t <tolerance>]'
+
+    try:
+
+        opts, args = getopt.getopt(sys.argv[1:],'ho:l:b:r:qci:t:')
+
+    except getopt.GetoptError:
+
+        print(usage)
+        sys.exit(2)
+
+    fName = 'benchmarks.json'; label = None; names = None; repeat = 5; minTime = 0.2; compare = False; idxs = (-2, -1); tol = 0.1
+
+    for opt, arg in opts:
+
+        if opt == '-h':
+
+            print(usage)
+            print('benchmarks: ' + ', '.join(benchmarks.keys()))
+            sys.exit()
+
+        elif opt == '-o':
+
+            fName = arg
+
+        elif opt == '-l':
+
+            label = arg
+
+        elif opt == '-b':
+
+            names = arg.split(',')
+
+        elif opt == '-r':
+
+            repeat = int(arg)
+
+        elif opt == '-q': # quick, a single call of each benchmark
+
+            repeat = 1; minTime = 0
+
+        elif opt == '-c':
+
+            compare = True
+
+        elif opt == '-i':
+
+            idxs = tuple( int(idx) for idx in arg.split(',') )
+
+        elif opt == '-t':
+
+            tol = float(arg)
+
+    if compare:
+
+        history = historyLoad(fName)
+
+        if len(history) < 2:
+            print('need at least two runs in ' + fName + ' to compare')
+            sys.exit(2)
+
+        baseRun, newRun = history[idxs[0]], history[idxs[1]]
+        rows = compareRuns(baseRun, newRun, tol)
+        printComparison(baseRun, newRun, rows)
+
+        sys.exit( 1 if any( flag == 'slower' for name, baseTime, newTime, ratio, flag in rows ) else 0 )
+
+    else:
+
+        fName = os.path.abspath(fName) # as the benchmarks run in a temporary directory
+        timings = runBenchmarks(names, repeat, minTime, verbose=True)
+        historyAppend(fName, timings, label)
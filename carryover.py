@@ -1,9 +1,110 @@
+import time
 import random
-from math import exp
+from math import exp, log
 import itertools as it
 from bisect import bisect
 import numpy as np
 
+from landscape import landscapeCodes
+from packedGenes import isPacked, linkageRates, recombinationMasks, mutateGenes, offspringWords
+from metrics import metricsCount, metricsPhase
+from individuals import Individual, Flock, asFlock
+
+class RandomStream:
+    """
+    rng = RandomStream(seed=None)
+
+    A seedable stream of random numbers for one simulation run, built on a numpy Generator. It has the scalar methods
+    of the random module that the simulation uses (random, getrandbits, randint, choice), so it can be passed as rng to
+    any function that would otherwise use the global random module. Scalar draws are taken from buffers filled by batched
+    numpy draws, and array functions can use its numpy Generator directly (rng.generator).
+
+    seed:
+        integer, numpy SeedSequence, or None for fresh entropy
+
+    >>> rng = RandomStream(42)
+    >>> rng.random() == RandomStream(42).random() # the same seed gives the same stream
+    True
+    >>> child0, child1 = rng.spawn(2) # independent streams, e.g. for parallel workers
+    >>> child0.random() != child1.random()
+    True
+    >>> 0 <= rng.getrandbits(20) < 2**20
+    True
+    """
+
+    bufferSize = 4096
+
+    def __init__(self, seed=None):
+
+        if isinstance(seed, np.random.SeedSequence):
+            self.seedSeq = seed
+        else:
+            self.seedSeq = np.random.SeedSequence(seed)
+
+        self.generator = np.random.default_rng(self.seedSeq)
+        self._doubles = iter(())
+        self._raws = iter(())
+
+    def seed(self):
+        """
+        Returns a dictionary recording the seed of this stream, to be stored with results, so RandomStream(np.random.SeedSequence(**seed)) recreates it
+        """
+
+        return { 'entropy': self.seedSeq.entropy, 'spawn_key': tuple(self.seedSeq.spawn_key) }
+
+    def spawn(self, n):
+        """
+        Returns a list of n independent child streams
+        """
+
+        return [ RandomStream(seedSeq) for seedSeq in self.seedSeq.spawn(n) ]
+
+    def random(self):
+        """
+        Returns a float uniformly distributed in [0, 1)
+        """
+
+        try:
+            return next(self._doubles)
+        except StopIteration:
+            self._doubles = iter( self.generator.random(self.bufferSize).tolist() )
+            return next(self._doubles)
+
+    def getrandbits(self, k):
+        """
+        Returns an integer with k random bits
+        """
+
+        bits = 0
+        noBits = 0
+
+        while noBits < k:
+
+            try:
+                raw = next(self._raws)
+            except StopIteration:
+                self._raws = iter( self.generator.bit_generator.random_raw(self.bufferSize).tolist() )
+                raw = next(self._raws)
+
+            bits = (bits << 64) | raw
+            noBits += 64
+
+        return bits >> (noBits - k)
+
+    def randint(self, a, b):
+        """
+        Returns an integer in [a, b] inclusive
+        """
+
+        return a + int( self.random() * (b - a + 1) )
+
+    def choice(self, seq):
+        """
+        Returns a random element of the non-empty sequence seq
+        """
+
+        return seq[ int( self.random() * len(seq) ) ]
+
 def gene2bin(parameters, gene, geneType):
     """
     geneBin = gene2bin(parameters, gene, geneType)
@@ -55,20 +156,48 @@ def gene2phen(parameters, gene, geneType):
     -1.0
     """
 
+    noOnes = bin(gene).count('1')
+
+    if 'tables' in parameters: # a parameter model, so look up the phenotype of this number of 1 alleles
+
+        phenotype = parameters['tables']['phen'][geneType][noOnes]
+
+    else:
+
+        phenotype = popcount2phen(parameters, noOnes, geneType)
+
+    return phenotype
+
+def popcount2phen(parameters, noOnes, geneType):
+    """
+    phen = popcount2phen(parameters, noOnes, geneType)
+
+    Turns the number of 1 alleles in the genes into a phenotype value.
+
+    noOnes:
+        integer, the number of loci with a 1 allele
+    phen:
+        value
+
+    >>> parameters = {'genetics': {'dist': {'noLoci': 20, 'maxPhen': 25, 'minPhen': 0, 'isInt': True} } }
+    >>> popcount2phen(parameters, 10, 'dist')
+    12
+    """
+
     maxPhen = parameters['genetics'][geneType]['maxPhen']
     minPhen = parameters['genetics'][geneType]['minPhen']
     noLoci = parameters['genetics'][geneType]['noLoci']
 
     if parameters['genetics'][geneType]['isInt']:
-        phenotype = round(minPhen + (bin(gene).count('1') / noLoci) * ( maxPhen - minPhen ))
+        phenotype = round(minPhen + (noOnes / noLoci) * ( maxPhen - minPhen ))
     else:
-        phenotype = minPhen + (bin(gene).count('1') / noLoci) * ( maxPhen - minPhen )
+        phenotype = minPhen + (noOnes / noLoci) * ( maxPhen - minPhen )
 
     return phenotype
 
-def randIdxWeights(weights):
+def randIdxWeights(weights, rng=None):
     """
-    idx = randIdxWeights(weights)
+    idx = randIdxWeights(weights, rng=None)
 
     Return a randomly chosen index where choice is weighted.
     Special because weights can sum to whatever, don't have to be probabilities.
@@ -76,12 +205,17 @@ def randIdxWeights(weights):
 
     weights:
         iterable, containing weightings to apply to each index
+    rng:
+        RandomStream, or None to use the random module
     idx:
         integer, the random index chosen according to weights
     """
 
+    if rng is None:
+        rng = random
+
     cumWeights = list( it.accumulate(weights) )
-    idx = bisect( cumWeights, random.random()*cumWeights[-1] )
+    idx = bisect( cumWeights, rng.random()*cumWeights[-1] )
 
     return idx
 
@@ -93,7 +227,7 @@ def noOffspringFnc(parameters, adults, habType):
     to calculate how many offspring they'll have.
 
     adults:
-        two-element list or similar, with each element a dictionary, describing an individual
+        two-element list or similar, with each element a dictionary or an Individual (see individuals.py), describing an individual
         e.g. {'genotype': {'disp': 274226, 'dist': 133608, 'repn': 951436}, 'natalHabType': 'L', 'sex': 'f'}
     habType:
         string, describes habitat type the pair reside on
@@ -120,6 +254,8 @@ def noOffspringFnc(parameters, adults, habType):
     >>> adults = [mum, dad]
     >>> noOffspringFnc(parameters, adults,habType)
     10
+    >>> noOffspringFnc(parameters, [ Individual(genotype={'repn': 31}) ]*2, habType) # or Individuals
+    10
     """
 
     if len(adults) != 2:
@@ -128,115 +264,382 @@ def noOffspringFnc(parameters, adults, habType):
 
     else:
 
-        # get the reproductive phenotype of pair
+        gene0 = adults[0]['genotype']['repn']
+        gene1 = adults[1]['genotype']['repn']
+
+        if 'tables' in parameters and parameters['tables']['noOffspring'] is not None:
+
+            # a parameter model, so look up the number of offspring for the pair's total number of 1 alleles
+            noOffspring = parameters['tables']['noOffspring'][habType][ bin(gene0).count('1') + bin(gene1).count('1') ]
+
+        else:
+
+            # get the reproductive phenotype of pair
+
+            phen0 = gene2phen(parameters, gene0, 'repn')
+            phen1 = gene2phen(parameters, gene1, 'repn')
+            phenPair = (phen0+phen1)/2
+
+            noOffspring = phenPair2noOffspring(parameters, phenPair, habType)
+
+    return noOffspring
+
+def phenPair2noOffspring(parameters, phenPair, habType):
+    """
+    noOffspring = phenPair2noOffspring(parameters, phenPair, habType)
 
-        phen0 = gene2phen(parameters, adults[0]['genotype']['repn'], 'repn')
-        phen1 = gene2phen(parameters, adults[1]['genotype']['repn'], 'repn')
-        phenPair = (phen0+phen1)/2
+    The Gaussian fitness function, giving the number of offspring of a pair with mean
+    reproductive phenotype phenPair on habitat type habType
 
-        # get the attributes of mum and dad's habitat type that relate to reproduction
+    >>> parameters = { 'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1} } }
+    >>> phenPair2noOffspring(parameters, -1, 'L')
+    10
+    """
 
-        rMax = parameters['habitats'][habType]['rMax']
-        phenOpt = parameters['habitats'][habType]['phenOpt']
-        sd = parameters['habitats'][habType]['sd']
+    # get the attributes of mum and dad's habitat type that relate to reproduction
 
-        # calculate the number of offspring the pair will have based on the Gaussian function
+    rMax = parameters['habitats'][habType]['rMax']
+    phenOpt = parameters['habitats'][habType]['phenOpt']
+    sd = parameters['habitats'][habType]['sd']
 
-        noOffspring = round( rMax * exp( - (phenPair - phenOpt)**2 / (2*sd**2) ) )
+    # calculate the number of offspring the pair will have based on the Gaussian function
+
+    noOffspring = round( rMax * exp( - (phenPair - phenOpt)**2 / (2*sd**2) ) )
 
     return noOffspring
 
-# parGenotypeBin looks like: {polygenes type: (mum's polygenes as binary string, dad's polygenes as binary str)}
-def offspringGenotypeFnc(parameters,parGenotypeBin):
+def parameterModel(parameters, landscape=None):
+    """
+    model = parameterModel(parameters, landscape=None)
+
+    Compiles the parameters dictionary into a parameter model, which is a copy of parameters with an additional key 'tables'
+    holding lookup tables built once. Because phenotype depends only on the number of 1 alleles (popcount, 0..noLoci),
+    and number of offspring only on the pair's total popcount and the habitat type, they can be looked up rather than recalculated.
+    The model can be passed to any function in place of parameters.
+
+    landscape:
+        string or Landscape (see landscape.py), if given, the landscape's habitat-type codes are also stored for the array functions in timestepVec.py
+    model['tables']:
+        dictionary, with keys
+        'phen': {geneType: list, phenotype value indexed by popcount}
+        'noOffspring': {habType: list, no. offspring indexed by popcount0 + popcount1}, or None if the repn phenotype isInt
+        'phenArray', 'noOffspringArray': numpy array versions of the above, the latter indexed [habitat code, popcount0 + popcount1]
+        'habTypes': list, habitat types in the order of their integer codes
+        'landscape', 'landCodes': the landscape and its habitat-type codes, if landscape given
+        'disp': the neighbourhood tables from dispersalTables, if landscape given, is a 1-D ring, and there are 'pref' or 'phil' genes
+
+    >>> parameters = { 'sexes': ( 'h', 'h' ), 'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2,  'minPhen': -2,  'isInt': False, 'pMut': 0.001} }, 'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt':  1, 'sd': 1.1}, }, 'competition': { 'L': 1, 'H': 10, } }
+    >>> model = parameterModel(parameters)
+    >>> model['tables']['phen']['repn'][5]
+    -1.0
+    >>> gene2phen(model, 31, 'repn') == gene2phen(parameters, 31, 'repn')
+    True
+    >>> adults = [ {'genotype': {'repn': 31}}, {'genotype': {'repn': 2**20-1}} ]
+    >>> noOffspringFnc(model, adults, 'H') == noOffspringFnc(parameters, adults, 'H')
+    True
+    """
+
+    habTypes = sorted( parameters['habitats'].keys() )
+
+    # phenotype of each possible number of 1 alleles
+
+    phen = { geneType: [ popcount2phen(parameters, noOnes, geneType) for noOnes in range(geneParams['noLoci']+1) ]
+            for geneType, geneParams in parameters['genetics'].items() }
+
+    # number of offspring of each possible total number of 1 alleles in the pair
+
+    if 'repn' in parameters['genetics'] and not parameters['genetics']['repn']['isInt']:
+
+        noLoci = parameters['genetics']['repn']['noLoci']
+        noOffspring = { habType: [ phenPair2noOffspring( parameters, popcount2phen(parameters, noOnes/2, 'repn'), habType ) for noOnes in range(2*noLoci+1) ]
+                for habType in habTypes }
+
+    else: # the pair's phenotype is not determined by its total popcount, so must be calculated
+
+        noOffspring = None
+
+    tables = {
+            'phen': phen,
+            'noOffspring': noOffspring,
+            'phenArray': { geneType: np.array(phens) for geneType, phens in phen.items() },
+            'noOffspringArray': None if noOffspring is None else np.array( [ noOffspring[habType] for habType in habTypes ], dtype=np.int64 ),
+            'habTypes': habTypes,
+            }
+
+    if landscape is not None:
+
+        tables['landscape'] = landscape
+        tables['landCodes'] = landscapeCodes(landscape, habTypes)
+
+        if ( 'pref' in parameters['genetics'] or 'phil' in parameters['genetics'] ) and ( isinstance(landscape, str) or landscape.topology == 'ring' ): # preference or NHPI dispersal on a ring
+
+            tables['disp'] = dispersalTables(parameters, tables['landCodes'])
+
+    model = dict(parameters)
+    model['tables'] = tables
+
+    return model
+
+def mutationMaskFnc(noLoci, pMut, rng=None):
+    """
+    mask = mutationMaskFnc(noLoci, pMut, rng=None)
+
+    Returns an integer with a 1 at each locus position that mutates, where each locus mutates with probability pMut.
+    Rather than drawing once per locus, the gaps between mutated loci are drawn from the geometric distribution,
+    so usually only one random number is needed. rng is a RandomStream, or None to use the random module.
+
+    >>> mutationMaskFnc(20, 0)
+    0
+    >>> mutationMaskFnc(20, 1) == 2**20-1
+    True
+    """
+
+    if pMut <= 0:
+
+        return 0
+
+    if pMut >= 1:
+
+        return (1 << noLoci) - 1
+
+    if rng is None:
+        rng = random
+
+    logq = log(1-pMut)
+
+    mask = 0
+    posn = int( log( 1-rng.random() ) / logq ) # number of loci skipped before the first mutation
+
+    while posn < noLoci:
+
+        mask |= 1 << posn
+        posn += 1 + int( log( 1-rng.random() ) / logq )
+
+    return mask
+
+def recombinationMaskFnc(noLoci, linkageMap, rng=None):
     """
-    offGenotypeBin = offspringGenotypeBinFnc(parameters, parGenotypeBin)
+    mask = recombinationMaskFnc(noLoci, linkageMap, rng=None)
+
+    Returns an integer with a 1 at each locus the offspring takes from mum and 0 from dad, with linkage: the first locus
+    comes from either parent, and the parent switches between loci i and i+1 with probability linkageMap[i] (a crossover).
+    As in mutationMaskFnc, the gaps between candidate crossovers at the largest probability are drawn from the geometric
+    distribution, and each is kept with probability linkageMap[i]/largest.
+
+    linkageMap:
+        float, the probability of a crossover between every pair of adjacent loci, or a list of the noLoci-1 probabilities
+
+    >>> recombinationMaskFnc(20, 0) in [0, 2**20-1] # no crossovers, so all loci come from one parent
+    True
+    >>> recombinationMaskFnc(20, [0]*9 + [1] + [0]*9) in [2**10-1, 2**20-2**10] # always a crossover in the middle
+    True
+    """
+
+    if rng is None:
+        rng = random
+
+    mask = (1 << noLoci) - 1 if rng.random() < 0.5 else 0
+
+    rates = None if np.isscalar(linkageMap) else list(linkageMap)
+    rMax = max(rates) if rates is not None else linkageMap
+
+    if rMax <= 0:
+
+        return mask
+
+    logq = log(1-rMax) if rMax < 1 else None
+    gap = int( log( 1-rng.random() ) / logq ) if logq is not None else 0 # number of gaps skipped before the first candidate
 
-    Accepts the parents' genotype in binary format and returns offspring's genotype in integer format
+    while gap < noLoci-1:
 
-    parGenotypeBin:
-        dictionary, keys are genetypes and values are tuples of mum and dad genes as a binary string
-        i.e.  {polygenes type: (mum's polygenes as binary string, dad's polygenes as binary str)}
-        e.g. {'disp': ('01000010111100110010', '10110110110100100010'),
-              'dist': ('00100000100111101000', '10101110100011000110'),
-              'repn': ('11101000010010001100', '00101110110001101110')}
+        if rates is None or rng.random()*rMax < rates[gap]:
+            mask ^= ( (1 << noLoci) - 1 ) ^ ( (1 << (gap+1)) - 1 ) # switch parent from locus gap+1 on
+
+        gap += 1 + ( int( log( 1-rng.random() ) / logq ) if logq is not None else 0 )
+
+    return mask
+
+# parGenotype looks like: {polygenes type: (mum's polygenes as integer, dad's polygenes as integer)}
+def offspringGenotypeFnc(parameters,parGenotype,rng=None,metrics=None):
+    """
+    offGenotype = offspringGenotypeFnc(parameters, parGenotype, rng=None, metrics=None)
+
+    Accepts the parents' genotype and returns offspring's genotype, both in integer format.
+    Free recombination is done with a random bitmask, taking the loci from mum where the mask is 1 and from dad where it is 0,
+    and mutation by XOR with a mask of the mutated loci. If the gene type has a 'linkageMap' (see packedGenes.py), the
+    bitmask comes from recombinationMaskFnc instead.
+
+    parGenotype:
+        dictionary, keys are genetypes and values are tuples of mum and dad genes as integers
+        i.e.  {polygenes type: (mum's polygenes, dad's polygenes)}
+        e.g. {'disp': (274226, 748834), 'dist': (133608, 715974), 'repn': (951436, 191598)}
+    rng:
+        RandomStream, or None to use the random module
+    metrics:
+        dictionary or None, if given the mutations are counted in it (see metrics.py)
     offGenotype:
         dictionary, keys are gene types and values are genes in integer format
         e.g. {'disp': 591984, 'dist': 792214, 'repn': 378862}
-    """
 
-    # create new genotype for offspring by randomly choosing genes from mum and dad
-
-    offGenotypeBinList = { geneType: list(map( lambda locus: random.choice(locus), zip(mumGeneBin, dadGeneBin) ))
-            for geneType, (mumGeneBin,dadGeneBin) in parGenotypeBin.items() } # retain as list for now so mutations easier
+    >>> parameters = {'genetics': {'repn': {'noLoci': 20, 'pMut': 0}, 'neut': {'noLoci': 20, 'pMut': 0} } }
+    >>> offspringGenotypeFnc(parameters, {'repn': (31, 31), 'neut': (0, 0)}) # identical parents and no mutation
+    {'repn': 31, 'neut': 0}
+    >>> offGenotype = offspringGenotypeFnc(parameters, {'repn': (0, 2**20-1), 'neut': (0, 0)})
+    >>> offGenotype['repn'] < 2**20 # each locus from one or the other parent
+    True
+    """
 
-    # find positions to mutate
+    if rng is None:
+        rng = random
 
-    mutposns = list()
+    offGenotype = dict()
 
-    for geneType in offGenotypeBinList.keys(): # for each polygenes type
+    for geneType, (mumGene, dadGene) in parGenotype.items(): # for each polygenes type
 
         pMut = parameters['genetics'][geneType]['pMut'] # get its mutations probability
         noLoci = parameters['genetics'][geneType]['noLoci'] # get the number of loci
+        linkageMap = parameters['genetics'][geneType].get('linkageMap')
 
-        p = [ i for i in range(noLoci) if random.random() < pMut ] # create list of locus positions at which to flip alleles
+        # create new genes for offspring by randomly choosing each locus from mum or dad
 
-        if p: # if any positions to be modified for these genes type
+        if linkageMap is None:
+            mask = rng.getrandbits(noLoci)
+        else:
+            mask = recombinationMaskFnc(noLoci, linkageMap, rng)
 
-            mutposns.append( (geneType,p) ) # add them to the list
+        offGene = (mumGene & mask) | (dadGene & ~mask)
 
+        # flip the alleles at the mutated loci
 
-    # apply mutations
+        mutnMask = mutationMaskFnc(noLoci, pMut, rng)
+        offGenotype[geneType] = offGene ^ mutnMask
 
-    if mutposns: # if any mutations to apply
+        if metrics is not None and mutnMask:
+            metricsCount( metrics, 'mutations', bin(mutnMask).count('1') )
 
-        for geneType, p in mutposns: # for each genes type to apply it to
+    return offGenotype
 
-            for pp in p: # for each position to be modified
+def offspringGenesArray(parameters, mumGenes, dadGenes, geneType, rng, size=None, metrics=None):
+    """
+    offGenes = offspringGenesArray(parameters, mumGenes, dadGenes, geneType, rng, size=None, metrics=None)
+
+    Batch version of offspringGenotypeFnc for one gene type, for many offspring at once (e.g. all the
+    offspring of one pair, or of a whole generation). Free recombination uses a random bitmask per offspring,
+    and mutation draws how many loci mutate across the whole batch, then which ones. Genes of more than 62 loci are
+    packed words (see packedGenes.py).
+
+    mumGenes, dadGenes:
+        integers or int64 arrays, the parents' genes of each offspring, or packed words
+    rng:
+        numpy random Generator
+    size:
+        integer, the number of offspring, only needed if mumGenes and dadGenes are both integers (e.g. one pair)
+    metrics:
+        dictionary or None, if given the mutations are counted in it (see metrics.py)
+    offGenes:
+        int64 array, the offspring's genes
+
+    >>> parameters = {'genetics': {'repn': {'noLoci': 20, 'pMut': 0} } }
+    >>> rng = np.random.default_rng(1)
+    >>> offGenes = offspringGenesArray(parameters, np.array([0]*1000), np.array([2**20-1]*1000), 'repn', rng)
+    >>> bool( abs( np.bitwise_count(offGenes).mean() - 10 ) < 0.5 ) # half the alleles come from each parent
+    True
+    >>> offspringGenesArray(parameters, 31, 31, 'repn', rng, 3) # a brood of 3 from identical parents, no mutation
+    array([31, 31, 31])
+    """
 
-                # flip the allele at that position
-                if offGenotypeBinList[geneType][pp] == '0':
+    if isPacked(parameters, geneType):
+        return offspringWords(parameters, mumGenes, dadGenes, geneType, rng, size, metrics)
 
-                    offGenotypeBinList[geneType][pp] = '1'
+    pMut = parameters['genetics'][geneType]['pMut']
+    noLoci = parameters['genetics'][geneType]['noLoci']
 
-                else:
+    if size is None:
+        size = np.broadcast( mumGenes, dadGenes ).size
 
-                    offGenotypeBinList[geneType][pp] = '0'
+    # recombination, each locus comes from mum where the mask has a 1 and from dad where it has a 0
 
-    # create the genotype of the offspring by joining those lists of alleles and converting to integers
+    rates = linkageRates(parameters, geneType)
 
-    offGenotype = { geneType: int( ''.join(geneBinList), 2 ) for geneType, geneBinList in offGenotypeBinList.items() }
+    if rates is None:
+        mask = rng.integers(0, 1 << noLoci, size=size, dtype=np.int64)
+    else:
+        mask = recombinationMasks(noLoci, rates, size, rng)[:, 0].astype(np.int64)
 
-    return offGenotype
+    offGenes = (mumGenes & mask) | (dadGenes & ~mask & ((1 << noLoci) - 1))
 
-def dispFnc(parameters, offspring, locn, landscape):
+    # mutation, draw how many of all the offspring's loci mutate, then which ones
+
+    return mutateGenes(offGenes, noLoci, pMut, rng, metrics)
+
+def dispFnc(parameters, offspring, locn, landscape, rng=None, metrics=None):
     """
-    newLocn = dispFnc(parameters, offspring, locn, landscape)
+    newLocn = dispFnc(parameters, offspring, locn, landscape, rng=None, metrics=None)
 
     Accepts an offspring and its location and finds its new location after dispersal
 
     offspring:
-        dictionary, describing an individual e.g. {'genotype': {'disp': 274226, 'dist': 133608, 'repn': 951436}, 'natalHabType': 'L', 'sex': 'f'}
+        dictionary or Individual (see individuals.py), describing an individual e.g. {'genotype': {'disp': 274226, 'dist': 133608, 'repn': 951436}, 'natalHabType': 'L', 'sex': 'f'}
     locn:
         integer, an index to a location in the landscape
     landscape:
-        string, describes the habitat types in the landscape e.g. 'LLLLLLLLLLLLLLLLLLLLLLHHHHHHHHHLLLLLLLLLLLLLLLLLLLL'
+        string, describes the habitat types in the landscape e.g. 'LLLLLLLLLLLLLLLLLLLLLLHHHHHHHHHLLLLLLLLLLLLLLLLLLLL',
+        or a Landscape (see landscape.py)
+    rng:
+        RandomStream, or None to use the random module
+    metrics:
+        dictionary or None, if given the locations proposed are counted in it (see metrics.py)
+
+    If parameters is a parameter model built with this landscape (see parameterModel), preference and NHPI
+    dispersal use its precomputed neighbourhoods instead of building the neighbourhood for each offspring.
+
+    >>> parameters = { 'distMax': 1, 'genetics': { 'repn': {'noLoci': 20} } }
+    >>> offspring = {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 31}}
+    >>> dispFnc(parameters, offspring, 0, 'LLL', RandomStream(1)) in [0, 1, 2]
+    True
+    """
+
+    return dispGenotypeFnc(parameters, offspring['genotype'], offspring['natalHabType'], locn, landscape, rng, metrics)
+
+def dispGenotypeFnc(parameters, offGenotype, natalHabType, locn, landscape, rng=None, metrics=None):
+    """
+    newLocn = dispGenotypeFnc(parameters, offGenotype, natalHabType, locn, landscape, rng=None, metrics=None)
+
+    dispFnc given the offspring's genotype and natal habitat type, e.g. for offspring not yet made into Individuals (see broodFnc)
     """
 
+    if rng is None:
+        rng = random
+
+    if metrics is not None: # one location proposed, and one more for each rejected below
+        metricsCount(metrics, 'dispersalDraws', 1)
+
     # find the maximum dispersal distance of the offspring
     distMax = parameters['distMax']
 
     if distMax is None:
 
         # will need to use offspring's genotype to find its dispersal distance
-        distMax = gene2phen( parameters, offspring['genotype']['dist'], 'dist' )
+        distMax = gene2phen( parameters, offGenotype['dist'], 'dist' )
 
     # find the new location it disperses too
 
-    offGenotype = offspring['genotype']
-
     if ('pref' not in offGenotype) and ('phil' not in offGenotype): # assume random dispersal
 
-        newLocn = ( locn + random.randint(-distMax,distMax) ) % len(landscape)
+        if isinstance(landscape, str):
+
+            newLocn = ( locn + rng.randint(-distMax,distMax) ) % len(landscape)
+
+        else: # a Landscape (see landscape.py), choose again if off the edge of a bounded grid
+
+            newLocn = landscape.propose(locn, distMax, rng.random())
+
+            while newLocn < 0:
+
+                if metrics is not None:
+                    metricsCount(metrics, 'dispersalDraws', 1)
+
+                newLocn = landscape.propose(locn, distMax, rng.random())
 
     else: # has genes controlling habitat type preferences
 
@@ -265,15 +668,44 @@ def dispFnc(parameters, offspring, locn, landscape):
 
             # identify preferred habitat type
             if phen < 0:
-                prefHabType = 'L' if offspring['natalHabType'] == 'H' else 'H'
+                prefHabType = 'L' if natalHabType == 'H' else 'H'
             else:
-                prefHabType = offspring['natalHabType']
+                prefHabType = natalHabType
 
         # convert phenotype value to weight
         weight = 1+abs(phen) # > 1 because non-preferred habitat type has weighting 1, "has weight times the probability ..."
 
         # choose new location using the weight and prefHabType
 
+        tables = parameters.get('tables', dict())
+
+        if 'disp' in tables and tables['landscape'] == landscape: # use the precomputed neighbourhoods
+
+            # as in dispTablesSample, but with scalar lookups
+            dispTables = tables['disp']
+            prefHabCode = tables['habTypes'].index(prefHabType)
+            nIn = dispTables['counts'].item(locn, prefHabCode, distMax)
+            x = rng.random() * ( weight*nIn + 2*distMax+1 - nIn )
+
+            if x < weight*nIn: # a cell of the preferred habitat type
+                offset = dispTables['offsetsIn'].item( locn, prefHabCode, min( int(x/weight), nIn-1 ) )
+            else:
+                offset = dispTables['offsetsOut'].item( locn, prefHabCode, min( int(x - weight*nIn), 2*distMax-nIn ) )
+
+            return ( locn + offset ) % len(landscape)
+
+        if not isinstance(landscape, str): # a Landscape (see landscape.py), choose uniformly in the neighbourhood, and accept with probability weight/maximum weight
+
+            while True:
+
+                newLocn = landscape.propose(locn, distMax, rng.random())
+
+                if newLocn >= 0 and ( landscape[newLocn] == prefHabType or rng.random()*weight < 1 ): # -1 is off the edge of a bounded grid
+                    return newLocn
+
+                if metrics is not None:
+                    metricsCount(metrics, 'dispersalDraws', 1)
+
         # get the locations and habitat types of the neighbourhood around it to which it may disperse given its dispersal distance
         lenLandscape = len(landscape)
         neighbourHabTypes = [ landscape[ i % lenLandscape ] for i in range(locn-distMax, locn+distMax+1) ]
@@ -283,15 +715,223 @@ def dispFnc(parameters, offspring, locn, landscape):
         neighbourWeights = [ weight if habType == prefHabType else 1 for habType in neighbourHabTypes ]
 
         # use preference weighting of neighbouring locations to choose a new location
-        newLocn = neighbourLocns[ randIdxWeights(neighbourWeights) ]
+        newLocn = neighbourLocns[ randIdxWeights(neighbourWeights, rng) ]
 
     return newLocn
 
-def compnSimpleFnc(parameters, flock):
+def broodFnc(parameters, parGenotype, natalHabType, locn, noOffspring, landscape, rng=None, metrics=None):
+    """
+    sexes, offGenotypes, newLocns = broodFnc(parameters, parGenotype, natalHabType, locn, noOffspring, landscape, rng=None, metrics=None)
+
+    Batch version of making each of a pair's offspring with offspringGenotypeFnc and dispersing it with dispFnc, so
+    timestep makes one call per pair. The recombination and mutation masks of each gene type are drawn for the whole
+    brood at once, as one integer of noOffspring*noLoci bits (one run of the geometric gaps of mutationMaskFnc across
+    all the brood's loci), and split between the offspring. Random dispersal on a ring is done for the whole brood here,
+    and other dispersal by dispGenotypeFnc for each offspring.
+
+    parGenotype:
+        dictionary, keys are gene types and values are tuples of mum and dad genes as integers (see offspringGenotypeFnc)
+    natalHabType:
+        string, the habitat type of the pair's territory locn
+    rng:
+        RandomStream, or None to use the random module
+    metrics:
+        dictionary or None, if given the time of reproduction and dispersal, the mutations and the locations proposed
+        are added to it (see metrics.py)
+    sexes:
+        list, the sex of each offspring
+    offGenotypes:
+        dictionary, keys are gene types and values are lists of the offspring's genes in integer format
+    newLocns:
+        list, where each offspring disperses to
+
+    >>> parameters = {'sexes': ('m', 'f'), 'distMax': 1, 'genetics': {'repn': {'noLoci': 20, 'pMut': 0}, 'neut': {'noLoci': 20, 'pMut': 0} } }
+    >>> sexes, offGenotypes, newLocns = broodFnc(parameters, {'repn': (31, 31), 'neut': (0, 2**20-1)}, 'H', 2, 4, 'LLHLL')
+    >>> len(sexes), offGenotypes['repn'], all( gene < 2**20 for gene in offGenotypes['neut'] ), set(newLocns) <= {1, 2, 3}
+    (4, [31, 31, 31, 31], True, True)
+    """
+
+    if rng is None:
+        rng = random
+
+    if metrics is not None:
+        lap = time.perf_counter()
+
+    sexes = [ rng.choice( parameters['sexes'] ) for cnt in range(noOffspring) ]
+
+    # the genes of each gene type for the whole brood
+
+    offGenotypes = dict()
+
+    for geneType, (mumGene, dadGene) in parGenotype.items():
+
+        geneParams = parameters['genetics'][geneType]
+        noLoci = geneParams['noLoci']
+        allLoci = (1 << noLoci) - 1
+        linkageMap = geneParams.get('linkageMap')
+
+        # recombination masks, and the mutation masks, each offspring's noLoci bits in turn
+
+        if linkageMap is None:
+            masks = rng.getrandbits(noOffspring*noLoci)
+            masks = [ ( masks >> (cnt*noLoci) ) & allLoci for cnt in range(noOffspring) ]
+        else:
+            masks = [ recombinationMaskFnc(noLoci, linkageMap, rng) for cnt in range(noOffspring) ]
+
+        mutnMasks = mutationMaskFnc(noOffspring*noLoci, geneParams['pMut'], rng)
+
+        if mutnMasks:
+
+            if metrics is not None:
+                metricsCount( metrics, 'mutations', bin(mutnMasks).count('1') )
+
+            offGenotypes[geneType] = [ ( (mumGene & mask) | (dadGene & ~mask) ) ^ ( ( mutnMasks >> (cnt*noLoci) ) & allLoci )
+                    for cnt, mask in enumerate(masks) ]
+
+        else:
+
+            offGenotypes[geneType] = [ (mumGene & mask) | (dadGene & ~mask) for mask in masks ]
+
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'reproduction', lap)
+
+    # dispersal
+
+    if isinstance(landscape, str) and ('pref' not in parGenotype) and ('phil' not in parGenotype): # random dispersal on a ring
+
+        if metrics is not None:
+            metricsCount(metrics, 'dispersalDraws', noOffspring)
+
+        lenLandscape = len(landscape)
+
+        if parameters['distMax'] is None:
+            newLocns = [ ( locn + rng.randint(-distMax, distMax) ) % lenLandscape
+                    for distMax in ( gene2phen(parameters, gene, 'dist') for gene in offGenotypes['dist'] ) ]
+        else:
+            distMax = parameters['distMax']
+            newLocns = [ ( locn + rng.randint(-distMax, distMax) ) % lenLandscape for cnt in range(noOffspring) ]
+
+    else:
+
+        newLocns = [ dispGenotypeFnc( parameters, { geneType: genes[cnt] for geneType, genes in offGenotypes.items() }, natalHabType, locn, landscape, rng, metrics )
+                for cnt in range(noOffspring) ]
+
+    if metrics is not None:
+        metricsPhase(metrics, 'dispersal', lap)
+
+    return sexes, offGenotypes, newLocns
+
+def dispersalTables(parameters, landCodes):
+    """
+    dispTables = dispersalTables(parameters, landCodes)
+
+    Precomputes the neighbourhood around each location for preference and NHPI dispersal, which never changes
+    because the landscape is static. For each location and habitat-type code, it stores the offsets of neighbouring
+    cells of that habitat type (offsetsIn) and of other habitat types (offsetsOut), each ordered by distance, and the
+    number of cells of that habitat type within each radius (counts). So the cells of a class within radius d are the
+    first counts[locn, code, d] entries of offsetsIn[locn, code] (and the first 2d+1 minus that of offsetsOut).
+
+    landCodes:
+        array, the habitat type code of each location in the landscape
+    dispTables:
+        dictionary, with keys 'distMax', 'offsetsIn', 'offsetsOut' (arrays (noLocns, noHabTypes, 2*distMax+1)),
+        and 'counts' (array (noLocns, noHabTypes, distMax+1))
+
+    >>> parameters = { 'distMax': 2, 'genetics': {}, 'habitats': {'L': {}, 'H': {}} }
+    >>> dispTables = dispersalTables(parameters, np.array([1, 1, 0, 1, 1, 1]))
+    >>> dispTables['counts'][1] # around location 1, the number of 'H' (code 0) and 'L' (code 1) cells within radius 0, 1, 2
+    array([[0, 1, 1],
+           [1, 2, 4]])
+    >>> dispTables['offsetsIn'][1, 0, :1] # where the 'H' cell is
+    array([1], dtype=int32)
+    """
+
+    # the largest distance anybody can disperse
+
+    distMax = parameters['distMax']
+    if distMax is None:
+        distMax = max( popcount2phen(parameters, noOnes, 'dist') for noOnes in range(parameters['genetics']['dist']['noLoci']+1) )
+
+    noHabTypes = len( parameters['habitats'] )
+    noLocns = len(landCodes)
+
+    # neighbourhood offsets ordered by distance, i.e. 0, -1, 1, -2, 2, ...
+
+    offsets = np.arange(-distMax, distMax+1)
+    offsets = offsets[ np.argsort( np.abs(offsets), kind='stable' ) ].astype(np.int32)
+    neighbourCodes = landCodes[ ( np.arange(noLocns)[:,None] + offsets[None,:] ) % noLocns ]
+
+    offsetsIn = np.empty( (noLocns, noHabTypes, len(offsets)), dtype=np.int32 )
+    offsetsOut = np.empty( (noLocns, noHabTypes, len(offsets)), dtype=np.int32 )
+    counts = np.empty( (noLocns, noHabTypes, distMax+1), dtype=np.int64 )
+
+    for code in range(noHabTypes):
+
+        isIn = neighbourCodes == code
+
+        # stable sorts put the cells of (or not of) this habitat type first, still ordered by distance
+        offsetsIn[:, code, :] = offsets[ np.argsort( ~isIn, axis=1, kind='stable' ) ]
+        offsetsOut[:, code, :] = offsets[ np.argsort( isIn, axis=1, kind='stable' ) ]
+
+        # the cells within radius d are the first 2d+1
+        counts[:, code, :] = np.cumsum( isIn, axis=1 )[:, 0::2]
+
+    dispTables = { 'distMax': distMax, 'offsetsIn': offsetsIn, 'offsetsOut': offsetsOut, 'counts': counts }
+
+    return dispTables
+
+def dispTablesSample(dispTables, locns, prefHabCodes, weights, dists, r):
+    """
+    offsets = dispTablesSample(dispTables, locns, prefHabCodes, weights, dists, r)
+
+    Chooses dispersal offsets using the precomputed neighbourhoods from dispersalTables. Each cell within the
+    dispersal radius of the preferred habitat type has weight times the probability of each other cell, as in dispFnc.
+    A single uniform random number chooses first the class (preferred or not) and then a cell uniformly within the class,
+    so the cost does not depend on the radius. Works on single values or arrays (e.g. all offspring leaving a territory).
+
+    locns, prefHabCodes, weights, dists:
+        integers or arrays, the natal location, preferred habitat type code, weighting and dispersal radius
+    r:
+        float or array, uniform random number(s) in [0, 1)
+    offsets:
+        integer or array, the offset from locn to the new location
+
+    >>> parameters = { 'distMax': 2, 'genetics': {}, 'habitats': {'L': {}, 'H': {}} }
+    >>> dispTables = dispersalTables(parameters, np.array([1, 1, 0, 1, 1, 1]))
+    >>> int( dispTablesSample(dispTables, 1, 0, 2, 2, 0.3) ) # P(the 'H' cell) = 2/(2*1+4), so r < 1/3 chooses it
+    1
+    >>> int( dispTablesSample(dispTables, 1, 0, 2, 2, 0.4) ) # r/(1/6) - 2 = 0.4 so the first 'L' cell, location 1 itself
+    0
+    """
+
+    nIn = dispTables['counts'][locns, prefHabCodes, dists]
+    nOut = 2*np.asarray(dists) + 1 - nIn
+
+    # position along the weighted cells, preferred cells first
+
+    x = r * ( weights*nIn + nOut )
+    isIn = x < weights*nIn
+
+    idxIn = np.minimum( (x / weights).astype(np.int64), np.maximum(nIn-1, 0) )
+    idxOut = np.minimum( (x - weights*nIn).astype(np.int64), nOut-1 )
+
+    offsets = np.where( isIn,
+            dispTables['offsetsIn'][locns, prefHabCodes, np.where(isIn, idxIn, 0)],
+            dispTables['offsetsOut'][locns, prefHabCodes, np.where(isIn, 0, idxOut)] )
+
+    return offsets
+
+def compnSimpleFnc(parameters, flock, rng=None):
     """
     A simple competition function in which one juvenile of each mating-pair sex
     becomes a new adult in the flock and all other juveniles die.
-    Winner found by random weighted choice, where weighting determined by natal habitat type
+    Winner found by random weighted choice, where weighting determined by natal habitat type.
+    flock is a dictionary or Flock (see individuals.py), and rng a RandomStream, or None to use the random module
+
+    >>> parameters = { 'sexes': ('m', 'f'), 'competition': {'L': 1, 'H': 10} }
+    >>> flock = {'adults': [ {'sex': 'm', 'natalHabType': 'L'} ], 'juveniles': [ {'sex': 'm', 'natalHabType': 'H'}, {'sex': 'f', 'natalHabType': 'H'} ]}
+    >>> compnSimpleFnc(parameters, flock, RandomStream(1))
+    {'adults': [{'sex': 'm', 'natalHabType': 'L'}, {'sex': 'f', 'natalHabType': 'H'}], 'juveniles': []}
     """
 
     # find out which positions are open for this flock's mating pair
@@ -300,7 +940,7 @@ def compnSimpleFnc(parameters, flock):
 
     for a in flock['adults']:
 
-        openPositions.remove(a)
+        openPositions.remove(a['sex'])
 
     # for each position that is open in the mating pair, choose a juvenile to take it
 
@@ -311,11 +951,8 @@ def compnSimpleFnc(parameters, flock):
 
         if any( w > 0 for w in compnWeights ): # if any of the competitors can be chosen
 
-            # determine the winner using the competition weights
-            winner = flock['juveniles'][ randIdxWeights(compnWeights) ]
-
-            # remove winner from juvenile flock and add to adult list
-            flock['juveniles'].remove(winner)
+            # determine the winner using the competition weights, remove winner from juvenile flock and add to adult list
+            winner = flock['juveniles'].pop( randIdxWeights(compnWeights, rng) )
             flock['adults'].append(winner)
 
     # for this run we assume all remaining juveniles die
@@ -323,15 +960,226 @@ def compnSimpleFnc(parameters, flock):
 
     return flock
 
-def ecosystemIsEmpty(ecosystem):
+def compnReservoir(parameters):
+    """
+    reservoir = compnReservoir(parameters)
+
+    An empty competition for a flock's mating-pair positions, to be filled by compnOffer as juveniles arrive
+
+    reservoir:
+        list, for each position in parameters['sexes'], a list [key, juvenile] of the juvenile currently winning it
+        and its key, [inf, None] while nobody has arrived
+    """
+
+    return [ [float('inf'), None] for sex in parameters['sexes'] ]
+
+def compnOffer(parameters, reservoir, juvenile, rng=None):
+    """
+    compnOffer(parameters, reservoir, juvenile, rng=None)
+
+    Single-pass version of compnSimpleFnc: a juvenile arriving at a flock enters the competition for the positions of its sex
+    without the other juveniles being stored. Each juvenile gets a random key, exponential with rate its competition weight,
+    and the juveniles with the smallest keys win, which is the same as choosing winners one after another by weighted choice
+    without replacement (Efraimidis-Spirakis). So only the current winner of each position is kept, and a juvenile that loses
+    (or has zero weight, so can never win) can be discarded straight away.
+    rng is a RandomStream, or None to use the random module
+
+    >>> parameters = { 'sexes': ('m', 'f'), 'competition': {'L': 0, 'H': 10} }
+    >>> reservoir = compnReservoir(parameters)
+    >>> compnOffer(parameters, reservoir, {'sex': 'f', 'natalHabType': 'L'}) # can never win
+    >>> compnOffer(parameters, reservoir, {'sex': 'f', 'natalHabType': 'H'})
+    >>> compnWinners(reservoir)
+    [{'sex': 'f', 'natalHabType': 'H'}]
+    """
+
+    if type(juvenile) is Individual: # read as attributes, which is faster, as this is called for every juvenile
+        sexJuvenile, natalHabType = juvenile.sex, juvenile.natalHabType
+    else:
+        sexJuvenile, natalHabType = juvenile['sex'], juvenile['natalHabType']
+
+    weight = parameters['competition'][natalHabType]
+
+    if weight <= 0:
+        return
+
+    if rng is None:
+        rng = random
+
+    key = - log( 1 - rng.random() ) / weight
+
+    # take the first position of this sex held with a larger key, and move its holder on to the next position of this sex
+
+    for sex, position in zip(parameters['sexes'], reservoir):
+
+        if sex == sexJuvenile and key < position[0]:
+
+            position[0], key = key, position[0]
+            position[1], juvenile = juvenile, position[1]
+
+            if juvenile is None: # displaced nobody
+                return
+
+def compnWinners(reservoir):
+    """
+    Returns the winners of a competition filled by compnOffer, the flock's new adults, in the order of parameters['sexes']
+    """
+
+    return [ juvenile for key, juvenile in reservoir if juvenile is not None ]
+
+def compnClassOffer(parameters, classes, sex, natalHabType, candidate, rng=None):
+    """
+    compnClassOffer(parameters, classes, sex, natalHabType, candidate, rng=None)
+
+    Another single-pass version of compnSimpleFnc. Because a juvenile's competition weight depends only on its natal habitat type,
+    juveniles of the same sex and natal habitat type are interchangeable in the competition, so the flock only needs to count
+    how many of each class arrive and keep a uniform random sample (reservoir sampling) of as many of each class as there are
+    positions for its sex. The winners are then drawn by compnClassWinners. The candidate can be anything describing the juvenile,
+    e.g. what is needed to build its genotype if it wins.
+
+    classes:
+        dictionary, the flock's competition, starting empty, keys are (sex, natalHabType) and values are [count, candidates]
+    rng:
+        RandomStream, or None to use the random module
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'competition': {'L': 0, 'H': 10} }
+    >>> classes = dict()
+    >>> for candidate in range(5):
+    ...     compnClassOffer(parameters, classes, 'h', 'H', candidate)
+    >>> compnClassOffer(parameters, classes, 'h', 'L', 5) # can never win
+    >>> classes[('h', 'H')][0], len( classes[('h', 'H')][1] ), ('h', 'L') in classes
+    (5, 2, False)
+    """
+
+    if parameters['competition'][natalHabType] <= 0:
+        return
+
+    if rng is None:
+        rng = random
+
+    classEntry = classes.get( (sex, natalHabType) )
+
+    if classEntry is None:
+        classEntry = classes[ (sex, natalHabType) ] = [ 0, list() ]
+
+    classEntry[0] += 1
+    noPositions = parameters['sexes'].count(sex)
+
+    # keep each of the class's juveniles with probability noPositions / count
+
+    if classEntry[0] <= noPositions:
+        classEntry[1].append(candidate)
+    else:
+        idx = int( rng.random() * classEntry[0] )
+        if idx < noPositions:
+            classEntry[1][idx] = candidate
+
+def compnClassWinners(parameters, classes, rng=None):
+    """
+    winners = compnClassWinners(parameters, classes, rng=None)
+
+    Draws the winners of a competition filled by compnClassOffer, for each position in the order of parameters['sexes'],
+    by weighted choice of a class (its competition weight times how many of it are left) and then a random candidate of the class
+
+    winners:
+        list of tuples (sex, natalHabType, candidate)
+
+    >>> parameters = { 'sexes': ('m', 'f'), 'competition': {'L': 1, 'H': 10} }
+    >>> classes = dict()
+    >>> compnClassOffer(parameters, classes, 'f', 'L', 'a')
+    >>> compnClassWinners(parameters, classes)
+    [('f', 'L', 'a')]
+    """
+
+    if rng is None:
+        rng = random
+
+    winners = list()
+
+    for sex in parameters['sexes']:
+
+        keys = [ key for key, (count, candidates) in classes.items() if key[0] == sex and count > 0 ]
+
+        if keys:
+
+            weights = [ parameters['competition'][key[1]] * classes[key][0] for key in keys ]
+            key = keys[ randIdxWeights(weights, rng) ]
+
+            # the candidates left are a uniform sample of those of the class left, so take one at random
+
+            classEntry = classes[key]
+            candidate = classEntry[1].pop( int( rng.random() * len(classEntry[1]) ) )
+            classEntry[0] -= 1
+
+            winners.append( (sex, key[1], candidate) )
+
+    return winners
+
+def occupiedIndex(ecosystem):
+    """
+    occupied = occupiedIndex(ecosystem)
+
+    Returns the index of occupied territories, the set of locations whose flock has any adults (mating pairs and single adults).
+    Functions given it (e.g. timestep, ecosystemIsEmpty, phenInSpace, gendiffInSpace) visit only those flocks, so their cost
+    scales with the size of the population rather than the length of the landscape, and timestep keeps it up to date
+
+    >>> occupiedIndex( [ {'adults': [], 'juveniles': []}, {'adults': [{'sex': 'h'}], 'juveniles': []} ] )
+    {1}
+    >>> occupiedIndex( [ Flock(), Flock( [ Individual('h') ] ) ] )
+    {1}
+    """
+
+    return { locn for locn, flock in enumerate(ecosystem) if flock['adults'] }
+
+def ecosystemSnapshot(ecosystem):
+    """
+    snapshot = ecosystemSnapshot(ecosystem)
+
+    Returns a copy of the ecosystem that later timesteps do not change, e.g. for recording it, in place of copy.deepcopy.
+    The timesteps never change an individual once it is made, as every generation's adults are new offspring, but they
+    replace the lists of adults and juveniles of the flocks. So only the list of flocks, the Flocks and their lists are
+    copied, and the individuals are shared. Flocks and Individuals pickle as calls that rebuild dictionaries, so the bytes
+    differ from a deep copy of dictionaries, but they unpickle as the same plain dictionaries.
+    Flocks and individuals given as dictionaries are converted to Flocks and Individuals (see individuals.py), so this
+    also turns an initial ecosystem of dictionaries into the ecosystem the timesteps work on.
+
+    >>> from timestep import timestep
+    >>> import copy, pickle
+    >>> parameters = {'sexes': ('h', 'h'), 'distMax': 2, 'competition': {'L': 1, 'H': 10},
+    ...     'genetics': {'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0.01}},
+    ...     'habitats': {'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.11}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.11}} }
+    >>> landscape = 'LLLLHHHLLLL'
+    >>> initial = [ {'adults': [ {'sex': 'h', 'natalHabType': habType, 'genotype': {'repn': 31}} ]*2, 'juveniles': []} for habType in landscape ]
+    >>> ecosystem = ecosystemSnapshot(initial)
+    >>> ecosystem == initial, type( ecosystem[0].adults[0] ).__name__
+    (True, 'Individual')
+    >>> rng = RandomStream(1)
+    >>> snapshots = list(); deepCopies = list()
+    >>> for t in range(10):
+    ...     ecosystem = timestep(parameters, ecosystem, landscape, rng)[0]
+    ...     snapshots.append( ecosystemSnapshot(ecosystem) ); deepCopies.append( copy.deepcopy(ecosystem) )
+    >>> stored = pickle.loads( pickle.dumps(snapshots) )
+    >>> snapshots == deepCopies, stored == deepCopies # the recorded history is unchanged
+    (True, True)
+    >>> type( stored[0][0] ).__name__, type( stored[0][0]['adults'][0] ).__name__ # and is read back without individuals.py
+    ('dict', 'dict')
+    """
+
+    return [ Flock( list(flock.adults), list(flock.juveniles) ) if type(flock) is Flock else asFlock(flock) for flock in ecosystem ]
+
+def ecosystemIsEmpty(ecosystem, occupied=None):
     """
     Checks to see that there is at least one mating pair in the ecosystem
     If there is at least one mating pair, returns False, or else returns True
+    If occupied is given (see occupiedIndex), only those flocks are checked
+
+    >>> ecosystem = [ {'adults': [{'sex': 'h'}], 'juveniles': []}, {'adults': [{'sex': 'h'}]*2, 'juveniles': []} ]
+    >>> ecosystemIsEmpty(ecosystem), ecosystemIsEmpty(ecosystem[:1]), ecosystemIsEmpty( ecosystemSnapshot(ecosystem) )
+    (False, True, False)
     """
 
     returnValue = True
 
-    for flock in ecosystem:
+    for flock in ( ecosystem if occupied is None else ( ecosystem[locn] for locn in occupied ) ):
 
         if len(flock['adults']) == 2: # having mating pair
 
@@ -340,54 +1188,61 @@ def ecosystemIsEmpty(ecosystem):
 
     return returnValue
 
-def phenInSpace(parameters, ecosystem):
+def phenInSpace(parameters, ecosystem, rng=None, occupied=None):
     """
     Returns a dictionary with keys geneType and values as a list of phenotypes
     Note: will only return value if location has a mating *pair*
+    rng is a RandomStream used to choose which adult of the pair, or None to use the random module
+    If occupied is given (see occupiedIndex), only those flocks are visited, with the same result
+
+    >>> parameters = { 'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False} } }
+    >>> ecosystem = [ {'adults': [ {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 31}} ]*2, 'juveniles': []}, {'adults': [], 'juveniles': []} ]
+    >>> phenInSpace(parameters, ecosystem, RandomStream(1))
+    {'repn': [-1.0, nan]}
+    >>> phenInSpace(parameters, ecosystemSnapshot(ecosystem), RandomStream(1), occupiedIndex(ecosystem))
+    {'repn': [-1.0, nan]}
     """
 
-    phenDict = { geneType: list() for geneType in parameters['genetics'] }
+    if rng is None:
+        rng = random
 
-    for flock in ecosystem:
+    phenDict = { geneType: [np.nan]*len(ecosystem) for geneType in parameters['genetics'] } # nan where there is no mating pair
 
-        adults = flock['adults']
-
-        if len(adults) == 2: # has a mating pair
+    for locn in ( range(len(ecosystem)) if occupied is None else sorted(occupied) ):
 
-            adult = random.choice(adults) # choose a random adult
+        adults = ecosystem[locn]['adults']
 
-            for geneType in parameters['genetics']: # calculate each phenotype value and append to the list of that phenotypes in space
-                phenDict[geneType].append( gene2phen( parameters, adult['genotype'][geneType], geneType ) )
+        if len(adults) == 2: # has a mating pair
 
-        else: # no mating pair, so append nans
+            adult = rng.choice(adults) # choose a random adult
 
-            for geneType in parameters['genetics']:
-                phenDict[geneType].append( np.nan )
+            for geneType in parameters['genetics']: # calculate each phenotype value
+                phenDict[geneType][locn] = gene2phen( parameters, adult['genotype'][geneType], geneType )
 
     return phenDict
 
-def gendiffInSpace(parameters, ecosystem):
+def gendiffInSpace(parameters, ecosystem, occupied=None):
     """
     Returns a dictionary with keys geneType and values as a list of the number of alleles that differ between mating partners
+    If occupied is given (see occupiedIndex), only those flocks are visited
 
+    >>> parameters = { 'genetics': { 'repn': {'noLoci': 20} } }
+    >>> ecosystem = [ {'adults': [ {'genotype': {'repn': 31}}, {'genotype': {'repn': 7}} ], 'juveniles': []}, {'adults': [], 'juveniles': []} ]
+    >>> gendiffInSpace(parameters, ecosystem)
+    {'repn': [2, nan]}
     """
 
-    gendiffDict = { geneType: list() for geneType in parameters['genetics'] }
-    for flock in ecosystem:
+    gendiffDict = { geneType: [np.nan]*len(ecosystem) for geneType in parameters['genetics'] } # nan where there is no mating pair
 
-        adults = flock['adults']
-
-        if len(adults) == 2: # has a mating pair
+    for locn in ( range(len(ecosystem)) if occupied is None else occupied ):
 
-            # calculate the genetic difference between them and append
-            for geneType in parameters['genetics']:
-                gendiffDict[geneType].append( genediffFnc( parameters, adults[0]['genotype'][geneType], adults[1]['genotype'][geneType], geneType ) )
+        adults = ecosystem[locn]['adults']
 
-        else: # no mating pair, so append nans
+        if len(adults) == 2: # has a mating pair
 
+            # calculate the genetic difference between them
             for geneType in parameters['genetics']:
-
-                gendiffDict[geneType].append( np.nan )
+                gendiffDict[geneType][locn] = genediffFnc( parameters, adults[0]['genotype'][geneType], adults[1]['genotype'][geneType], geneType )
 
     return gendiffDict
 
@@ -414,10 +1269,7 @@ def pcolormeshCorrectionXY(xV, yV):
 
 def genediffFnc(parameters, gene0, gene1, geneType):
 
-    geneBin0 = gene2bin( parameters, gene0, geneType ) # each gene as binary string
-    geneBin1 = gene2bin( parameters, gene1, geneType )
-
-    return sum(1 for g0, g1 in zip(geneBin0, geneBin1) if g0 != g1) # count differences and return
+    return bin( gene0 ^ gene1 ).count('1') # count differences and return
 
 if __name__ == "__main__":
 
@@ -0,0 +1,833 @@
+from math import comb
+import numpy as np
+
+from carryover import parameterModel, popcount2phen, phenPair2noOffspring
+from timestepVec import habTypesList, landscape2codes, ecosystem2popn
+from packedGenes import popcountGenes
+
+# A deterministic, expected-value version of the model, to pre-screen a grid of parameter values (e.g. with
+# sweep.sweepExpected) before running the stochastic model over the interesting part. Instead of individuals, it follows
+# for each territory and mating-pair position (slot) the probability that the slot holds an adult of each natal habitat
+# type with each number of 1 alleles:
+#
+#   state = {geneType: array (noLocns, noSlots, noHabTypes, noLoci+1)}
+#
+# so summing over the last axis gives the probability each slot is filled by an adult of each natal habitat type. A generation
+# follows the rules of timestep on expected values: the number of offspring from the Gaussian fitness function (as
+# noOffspringFnc, also with an isInt 'repn' phenotype), dispersal within distMax or the 'dist' phenotype, weighted towards the
+# habitat type preferred by the 'pref' or 'phil' phenotype (as dispFnc), and competition weighted by natal habitat type (as
+# compnSimpleFnc). The approximations are:
+#
+#   - the two slots of a territory are independent, and so are the gene types of an adult (mean field), so e.g. a juvenile's
+#     dispersal phenotypes are drawn from those of its natal territory whatever its other genes
+#   - the juveniles of each sex and natal habitat type arriving at a territory are Poisson-distributed
+#   - an offspring takes the 1 alleles its parents share and half of those at the loci where they differ, the loci being in
+#     linkage equilibrium (a 'linkageMap' is ignored); but the parents in a territory are related, so they differ at fewer loci
+#     than unrelated parents would, by the fraction from segregatingFrac, the balance of genetic drift and mutation in the landscape
+#
+# Without that last correction, the loci never fix, so there is several times the genetic variance of the stochastic model,
+# and local adaptation goes faster and further (e.g. mean phenotypes of 0.77 on H and -0.33 on L, where the stochastic
+# model gives 0.31 and -0.05). With it, over a grid of competition['H'], H-patch width and distMax on a 51-territory ring,
+# the mean phenotypes on H and on L rank the grid points as the means of 8 stochastic replicates do (Spearman correlation
+# 0.97 to 0.99), though they still miss the stochastic values by about 0.1 on H, as drift also moves whole patches between states.
+#
+# A generation costs about 1.5 times one of the numpy engine, and a quarter (L=51) to a tenth (L=1001) of one of timestep.
+# The speed-up comes from needing one run rather than replicates, which settles to a steady state in a few hundred
+# generations, when it can stop (tol in simulateExpected). On that grid, with tol=1e-4, a grid point took about 0.2 s,
+# where 20 replicates of 600 generations take about 4 s with the numpy engine and 25 s with timestep; at L=1001, about
+# 1 s, where they take 30 s and 9 minutes (see benchmark.py).
+#
+#   results = simulateExpected(parameters, landscape, tf, tol=1e-4)
+#   results['phen']['repn'][-1] # the expected mean phenotype of the adults in each territory when it stopped
+
+_gaussLegendre = np.polynomial.legendre.leggauss(5) # nodes and weights on each panel of the competition integral
+
+_noCompnNodes = 49 # the arrivals of each natal habitat type in the tables of compnTables
+
+def segregatingFrac(landscape, dists, distFracs, pMut):
+    """
+    frac = segregatingFrac(landscape, dists, distFracs, pMut)
+
+    The fraction of loci at which the two adults of a territory differ, relative to unrelated adults with the same numbers of
+    1 alleles, where genetic drift and mutation balance. Traced back in time, the genes of the two adults move to the
+    territories their ancestors were born in, and join when they come from the same parent, T generations back; as each
+    locus then mutates with probability pMut a generation, they are the same with probability (1 + (1-2*pMut)**(2*T)) / 2,
+    so the fraction is 1 - E[ (1-2*pMut)**(2*T) ], from the eigenvalues of the dispersal kernel (every territory full and
+    producing alike). It is exact on a ring or torus, treats a bounded grid as a torus, and on a graph uses the
+    eigenvalues of its dispersal matrix.
+
+    dists, distFracs:
+        arrays, the dispersal distances and the fraction of juveniles with each
+    frac:
+        value, between 0 (parents the same) and 1 (unrelated)
+
+    >>> frac = segregatingFrac(51*'L', np.array([7]), np.array([1.]), 0.001)
+    >>> round(frac, 3), round( 4*0.001*102 / (1 + 4*0.001*102), 3 ) # nearly as if the 102 adults mixed freely
+    (0.285, 0.29)
+    >>> round( segregatingFrac(1001*'L', np.array([7]), np.array([1.]), 0.001), 3 ) # more, but far from 1, on a long ring
+    0.536
+    """
+
+    if pMut == 0: # every locus fixes in the end
+        return 0.
+
+    if isinstance(landscape, str) or landscape.topology in ['ring', 'torus', 'bounded']: # the Fourier transform of the kernel
+
+        shape = ( len(landscape), ) if isinstance(landscape, str) or landscape.topology == 'ring' else landscape.shape
+        kernel = np.zeros(shape)
+
+        for dist, distFrac in zip(dists, distFracs):
+
+            steps = np.arange(-dist, dist+1)
+            step = np.zeros(shape)
+            np.add.at( step, tuple( np.meshgrid( *[ steps % noCells for noCells in shape ], indexing='ij' ) ), 1 )
+            kernel += distFrac * step / step.sum()
+
+        eigs = np.abs( np.fft.fftn(kernel) ).ravel()**2 # of the kernel of the separation of two genes
+
+    else: # the matrix of the probability of having been born in each territory
+
+        births = np.zeros( ( len(landscape), len(landscape) ) )
+
+        for dist, distFrac in zip(dists, distFracs):
+
+            tables = landscape.graphTables(dist)
+            counts = np.diff( tables['starts'] )
+            np.add.at( births, ( tables['neighbours'], np.repeat( np.arange( len(landscape) ), counts ) ), distFrac / np.repeat(counts, counts) )
+
+        births /= births.sum(axis=1)[:, None]
+        eigs = np.linalg.eigvalsh( births @ births.T )
+
+    # the chance the genes are the same, psi, satisfies psi = means/2 * (1 - psi), means the mean over the eigenvalues
+    # of their generating function
+
+    decays = (1 - 2*pMut)**2 * eigs
+    means = np.mean( decays / (1 - decays) )
+
+    return float( 2 / (2 + means) )
+
+def inheritTable(noLoci, pMut, frac):
+    """
+    inherit = inheritTable(noLoci, pMut, frac)
+
+    The probability of an offspring's number of 1 alleles given its parents' total. Parents with s between them are taken
+    each to have s/2, at random loci, so they differ at s - s**2/(2*noLoci) loci on average, times frac (see segregatingFrac).
+    The offspring has the 1 alleles at the loci where they agree and each of the rest with probability 1/2, and then
+    each locus mutates with probability pMut
+
+    inherit:
+        array (2*noLoci+1, noLoci+1)
+
+    >>> inheritTable(2, 0, 1.)[2] # parents with 2 of their 4 alleles 1, differing at 1 locus on average
+    array([0.125, 0.75 , 0.125])
+    >>> inheritTable(2, 0, 0.)[2] # identical parents
+    array([0., 1., 0.])
+    """
+
+    totals = np.arange(2*noLoci+1)
+    parities = totals % 2
+
+    # the number of loci the parents differ at, of the same parity as their total, either side of the mean
+
+    diffs = np.maximum( frac * ( totals - totals**2 / (2*noLoci) ), parities )
+    diffsMax = np.minimum( totals, 2*noLoci - totals )
+    diffsLo = np.minimum( parities + 2 * ( (diffs - parities) // 2 ).astype(np.int64), diffsMax )
+    fracsHi = np.where( diffsLo < diffsMax, (diffs - diffsLo) / 2, 0 )
+
+    inherit = np.zeros( (2*noLoci+1, noLoci+1) )
+
+    for total, diffsLo, fracHi in zip( totals, diffsLo, fracsHi ):
+        for noDiffs, share in [ (diffsLo, 1 - fracHi), (diffsLo + 2, fracHi) ]:
+            if share > 0:
+                halves = np.array( [ comb(noDiffs, k) for k in range(noDiffs+1) ] ) / 2**noDiffs
+                inherit[ total, (total - noDiffs)//2 : (total + noDiffs)//2 + 1 ] += share * halves
+
+    # mutation, from k 1 alleles to k - lost + gained
+
+    noOnes = np.arange(noLoci+1)
+    lost = np.array( [ [ comb(k, j) for j in range(noLoci+1) ] for k in range(noLoci+1) ] ) * pMut**noOnes * (1 - pMut)**np.maximum(noOnes[:, None] - noOnes, 0)
+    gained = np.array( [ [ comb(noLoci - k, j) for j in range(noLoci+1) ] for k in range(noLoci+1) ] ) * pMut**noOnes * (1 - pMut)**np.maximum(noLoci - noOnes[:, None] - noOnes, 0)
+
+    mutate = np.zeros( (noLoci+1, noLoci+1) )
+    for k in range(noLoci+1):
+        for j in range(k+1):
+            mutate[ k, k-j : k-j+noLoci-k+1 ] += lost[k, j] * gained[k, :noLoci-k+1]
+
+    return inherit @ mutate
+
+def windowSums(window, values):
+    """
+    sums = windowSums(window, values)
+
+    For each territory, the sum of values over the territories whose neighbourhood within the window's distance it is in
+    (counting a territory as often as it is reached, e.g. around a small torus)
+
+    window:
+        dictionary, 'offsets' (a ring), or 'sources' and 'starts' (other landscapes), as in expectedTables
+    values:
+        array (noLocns, ...)
+
+    >>> windowSums( {'offsets': np.arange(-1, 2)}, np.array([3., 0, 0, 0]) )
+    array([3., 3., 0., 3.])
+    """
+
+    if 'offsets' in window: # a running sum around the ring
+
+        offsets = window['offsets']
+        noLocns = len(values)
+
+        sums = np.cumsum( values[ np.arange( offsets[0], noLocns + offsets[-1] ) % noLocns ], axis=0 )
+        sums = np.concatenate( ( np.zeros( (1,) + values.shape[1:] ), sums ) )
+
+        return np.maximum( sums[ len(offsets): ] - sums[ :noLocns ], 0 ) # not below 0 by rounding
+
+    return np.add.reduceat( values[ window['sources'] ], window['starts'], axis=0 )
+
+def compnExpected(arrivals, weights, noRanks):
+    """
+    fills = compnExpected(arrivals, weights, noRanks)
+
+    The probability that each position of a territory is won by a juvenile of each natal habitat type, when the numbers of
+    juveniles of each type arriving are Poisson and each draws an exponential key with rate its weight, as in compnOffer.
+    The position of rank r (0 first) goes to the juvenile with the (r+1)th smallest key, so it is won by type h with probability
+
+        integral over t of  arrivals[h] * weights[h] * exp(-weights[h] t) * cum(t)**r / r! * exp(-cum(t)),
+        where cum(t) = sum over h of arrivals[h] * (1 - exp(-weights[h] t)) is the expected number of keys below t
+
+    found by Gauss-Legendre quadrature on panels of geometrically increasing length. It is used to build the tables of
+    compnTables, and each generation only with three or more different positive weights.
+
+    arrivals:
+        array (noLocns, noHabTypes), the expected number of juveniles of each natal habitat type arriving at each territory
+    fills:
+        array (noRanks, noLocns, noHabTypes)
+
+    >>> fills = compnExpected( np.array([[2., 3.]]), np.array([1., 1.]), 2 )
+    >>> fills[0].round(4) # equal weights, so shared in proportion to the arrivals
+    array([[0.3973, 0.596 ]])
+    >>> float( fills[1].sum().round(4) ), float( ( 1 - np.exp(-5) * (1 + 5) ).round(4) ) # filled if at least 2 arrive
+    (0.9596, 0.9596)
+    >>> compnExpected( np.array([[2., 3.]]), np.array([10., 1.]), 1 )[0].round(4)
+    array([[0.7469, 0.2463]])
+    """
+
+    noLocns, noHabTypes = arrivals.shape
+
+    # in units u = scale*t, where scale is the rate at which the expected number of keys first grows, panels
+    # [0, 1], [1, 2], [2, 4], ... until the smallest positive weight's keys have all been passed
+
+    scales = arrivals @ weights + weights.max()
+    uMax = 30 * scales.max() / weights[ weights > 0 ].min()
+    edges = np.concatenate( ( [0], 2.0**np.arange( max( int( np.ceil( np.log2(uMax) ) ), 0 ) + 1 ) ) )
+
+    nodes, nodeWeights = _gaussLegendre
+    lengths = np.diff(edges)[:, None]
+    us = ( edges[:-1, None] + lengths * (nodes + 1) / 2 ).ravel()
+    uWeights = ( lengths * nodeWeights / 2 ).ravel()
+
+    ts = us / scales[:, None] # (noLocns, noNodes)
+
+    # the density of the keys of each natal habitat type, and the expected number of keys below t
+
+    decays = np.exp( -weights[:, None, None] * ts ) # (noHabTypes, noLocns, noNodes)
+    cum = arrivals.sum(axis=1)[:, None] - np.einsum('hl,hln->ln', arrivals.T, decays)
+    densities = decays
+    densities *= ( arrivals * weights ).T[:, :, None]
+    densities *= uWeights / scales[:, None]
+
+    # the chance that r keys are below t, for each rank in turn
+
+    fills = np.empty( (noRanks, noLocns, noHabTypes) )
+    poisson = np.exp(-cum)
+
+    for rank in range(noRanks):
+
+        fills[rank] = np.einsum('hln,ln->lh', densities, poisson)
+        poisson = poisson * cum / (rank + 1)
+
+    return fills
+
+def compnTables(weights, noRanks, arrivalsMax):
+    """
+    compn = compnTables(weights, noRanks, arrivalsMax)
+
+    What compnFills needs to find the chance each position is won by each natal habitat type. Natal habitat types with the
+    same weight compete alike, so they are grouped, and only the groups' arrivals matter. With one group the chance a
+    position is filled is the Poisson chance that enough arrive; with two it is tabulated over both groups' arrivals, up
+    to arrivalsMax, from compnExpected, once for the run; with more it is integrated each generation.
+
+    compn:
+        dictionary, with keys
+        'groups': array, the group of each natal habitat type, -1 if its weight is 0 so it never wins
+        'weights': array, the weight of each group
+        'arrivals', 'fills': if two groups, the arrivals of each group the table is at, and the table, array (noRanks, noNodes, noNodes, 2)
+
+    >>> compn = compnTables(np.array([10., 1.]), 1, 20.)
+    >>> compnFills( compn, np.array([[2., 3.]]), 1 )[0].round(3) # as compnExpected, to within the interpolation
+    array([[0.746, 0.247]])
+    """
+
+    groupWeights, groups = np.unique(weights, return_inverse=True)
+    groups = np.where( weights > 0, groups - (groupWeights[0] == 0), -1 )
+    groupWeights = groupWeights[ groupWeights > 0 ]
+
+    compn = { 'groups': groups, 'weights': groupWeights }
+
+    if len(groupWeights) == 2: # each group's arrivals at nodes closer together near 0, where the chances change fastest
+
+        nodes = arrivalsMax * np.linspace(0, 1, _noCompnNodes)**2
+        arrivals = np.stack( np.meshgrid(nodes, nodes, indexing='ij'), axis=-1 ).reshape(-1, 2)
+
+        compn['arrivals'] = nodes
+        compn['fills'] = compnExpected( arrivals, groupWeights, noRanks ).reshape( noRanks, _noCompnNodes, _noCompnNodes, 2 )
+
+    return compn
+
+def compnFills(compn, arrivals, noRanks):
+    """
+    fills = compnFills(compn, arrivals, noRanks)
+
+    The probability that each position of a territory is won by a juvenile of each natal habitat type, as compnExpected,
+    using the tables of compnTables
+
+    >>> compn = compnTables(np.array([1., 1.]), 2, 20.)
+    >>> compnFills( compn, np.array([[2., 3.]]), 2 ).round(3) # as compnExpected
+    array([[[0.397, 0.596]],
+    <BLANKLINE>
+           [[0.384, 0.576]]])
+    """
+
+    groups = compn['groups']
+    noLocns, noHabTypes = arrivals.shape
+    noGroups = len( compn['weights'] )
+
+    groupArrivals = np.zeros( (noLocns, noGroups) )
+    for habCode, group in enumerate(groups):
+        if group >= 0:
+            groupArrivals[:, group] += arrivals[:, habCode]
+
+    if noGroups == 1: # filled if more arrive than the rank
+
+        poisson = np.exp( -groupArrivals[:, 0] )
+        noArrived = poisson.copy()
+        groupFills = np.empty( (noRanks, noLocns, 1) )
+
+        for rank in range(noRanks):
+
+            groupFills[rank, :, 0] = 1 - noArrived
+            poisson = poisson * groupArrivals[:, 0] / (rank + 1)
+            noArrived += poisson
+
+    elif noGroups == 2: # bilinear interpolation in the table, found from the square root of the arrivals, where its nodes are evenly spaced
+
+        nodes = compn['arrivals']
+        groupArrivals = np.minimum( groupArrivals, nodes[-1] )
+        idxs = np.minimum( ( np.sqrt( groupArrivals / nodes[-1] ) * (len(nodes) - 1) ).astype(np.int64), len(nodes) - 2 )
+        fracs = ( groupArrivals - nodes[idxs] ) / ( nodes[idxs+1] - nodes[idxs] )
+
+        table = compn['fills'][:noRanks]
+        idxs0, idxs1 = idxs[:, 0], idxs[:, 1]
+        fracs0, fracs1 = fracs[:, 0, None], fracs[:, 1, None]
+
+        groupFills = ( (1 - fracs0) * ( (1 - fracs1) * table[:, idxs0, idxs1] + fracs1 * table[:, idxs0, idxs1+1] )
+                + fracs0 * ( (1 - fracs1) * table[:, idxs0+1, idxs1] + fracs1 * table[:, idxs0+1, idxs1+1] ) )
+
+    elif noGroups > 2:
+
+        groupFills = compnExpected( groupArrivals, compn['weights'], noRanks )
+
+    else: # nobody can win
+
+        return np.zeros( (noRanks, noLocns, noHabTypes) )
+
+    # shared among the natal habitat types of each group in proportion to their arrivals
+
+    shares = np.where( groups >= 0, arrivals, 0 ) / np.where( groupArrivals > 0, groupArrivals, 1 )[:, np.maximum(groups, 0)]
+
+    return groupFills[:, :, np.maximum(groups, 0)] * shares
+
+def expectedTables(parameters, landscape):
+    """
+    tables = expectedTables(parameters, landscape)
+
+    The arrays used by timestepExpected, built once for a run
+
+    tables:
+        dictionary, with keys
+        'landCodes', 'noHabTypes': array, the habitat type code of each territory, and the number of habitat types
+        'noOffspring': array (noHabTypes, 2*noLoci+1), number of offspring by habitat type and the pair's total number of 1 alleles,
+            or if the repn phenotype isInt, array (noHabTypes, 2*noLoci+1, noLoci+1), by the total and the first slot's number
+        'frac': {geneType: value}, the fraction of loci at which the parents in a territory differ (see segregatingFrac)
+        'inherit': {geneType: array (2*noLoci+1, noLoci+1)}, probability of an offspring's number of 1 alleles given its parents' total
+        'slotSexes', 'sexFracs', 'ranks': arrays, the index of each slot's sex in its first appearance in parameters['sexes'],
+            the fraction of offspring of that sex, and the slot's rank among the slots of that sex
+        'lastSlots': array, the slots that are the last of their sex, all filled if there is a mating pair
+        'compn': the competition tables (see compnTables)
+        'dists', 'windows': the dispersal distances, and for each the territories reached (see windowSums)
+        'distIdxs': if 'dist' genes, the index into dists of each number of 1 alleles
+        'prefGene', 'prefWeights', 'prefCodes': if 'pref' or 'phil' genes, which, and by its number of 1 alleles, the weight
+            of the preferred habitat type and its code, for juveniles born in each territory
+        'invTotals': array (noLocns, len(dists), noPrefs), 1 over the total weight of the neighbourhood of each
+            territory, for each distance and preference (noPrefs is 1 if there are no 'pref' or 'phil' genes)
+
+    >>> parameters = { 'sexes': ('m', 'f'), 'distMax': 1, 'competition': {'L': 1, 'H': 10},
+    ...     'genetics': { 'repn': {'noLoci': 2, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0} },
+    ...     'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.1} } }
+    >>> tables = expectedTables(parameters, 'LLHL')
+    >>> tables['landCodes'], tables['ranks'], tables['lastSlots'], tables['frac']
+    (array([1, 1, 0, 1], dtype=uint8), array([0, 0]), array([0, 1]), {'repn': 0.0})
+    >>> tables['inherit']['repn'][2] # parents with 2 of their 4 alleles 1, the same, as without mutation the loci all fix
+    array([0., 1., 0.])
+    >>> parameters['genetics']['pref'] = {'noLoci': 4, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0}
+    >>> tables = expectedTables(parameters, 'LLHL')
+    >>> tables['prefWeights'], tables['prefCodes'][2] # the habitat type preferred, by the number of 1 alleles, born in H
+    (array([3., 2., 1., 2., 3.]), array([1, 1, 0, 0, 0]))
+    >>> tables['invTotals'][0, 0] # at 0, 'H' is not within 1, so with weights 3, 2, 2, 3 on 'L', 3 weighted cells
+    array([0.11111111, 0.16666667, 0.33333333, 0.33333333, 0.33333333])
+    """
+
+    if 'tables' not in parameters:
+        parameters = parameterModel(parameters, landscape)
+
+    genetics = parameters['genetics']
+    habTypes = habTypesList(parameters)
+    sexes = parameters['sexes']
+    landCodes = landscape2codes(parameters, landscape)
+    noLocns = len(landCodes)
+
+    tables = {
+            'landCodes': landCodes,
+            'noHabTypes': len(habTypes),
+            'slotSexes': np.array( [ sexes.index(sex) for sex in sexes ] ),
+            'sexFracs': np.array( [ sexes.count(sex) / len(sexes) for sex in sexes ] ),
+            'ranks': np.array( [ sexes[:idxSlot].count(sex) for idxSlot, sex in enumerate(sexes) ] ),
+            'lastSlots': np.array( [ idxSlot for idxSlot, sex in enumerate(sexes) if sex not in sexes[idxSlot+1:] ] ),
+            }
+
+    # the number of offspring, by the pair's total number of 1 alleles, or with an isInt phenotype also by the first slot's
+
+    if parameters['tables']['noOffspringArray'] is not None:
+
+        tables['noOffspring'] = parameters['tables']['noOffspringArray'].astype(float)
+
+    else:
+
+        noLoci = genetics['repn']['noLoci']
+        phens = [ popcount2phen(parameters, noOnes, 'repn') for noOnes in range(noLoci+1) ]
+        tables['noOffspring'] = np.array( [ [ [ phenPair2noOffspring( parameters, ( phens[noOnes] + phens[total-noOnes] ) / 2, habType )
+                if 0 <= total - noOnes <= noLoci else 0 for noOnes in range(noLoci+1) ] for total in range(2*noLoci+1) ] for habType in habTypes ], dtype=float )
+
+    # the dispersal distances, and the fraction of juveniles with each at a random start
+
+    if parameters['distMax'] is not None:
+
+        dists = np.array( [ parameters['distMax'] ] )
+        distFracs = np.ones(1)
+
+    else:
+
+        noLoci = genetics['dist']['noLoci']
+        distPhens = np.array( [ popcount2phen(parameters, noOnes, 'dist') for noOnes in range(noLoci+1) ], dtype=np.int64 )
+        dists, tables['distIdxs'] = np.unique(distPhens, return_inverse=True)
+        distFracs = np.bincount( tables['distIdxs'], weights=[ comb(noLoci, k) / 2**noLoci for k in range(noLoci+1) ] )
+
+    # the inheritance of each gene type, its parents related as in a landscape where everyone is born where they settle (see segregatingFrac)
+
+    tables['frac'] = { geneType: segregatingFrac( landscape, dists, distFracs, geneParams['pMut'] ) for geneType, geneParams in genetics.items() }
+    tables['inherit'] = { geneType: inheritTable( geneParams['noLoci'], geneParams['pMut'], tables['frac'][geneType] ) for geneType, geneParams in genetics.items() }
+
+    # for each distance, each territory's neighbourhood, as a window on a ring, else as lists of the territories reached from each
+
+    isRing = isinstance(landscape, str) or landscape.topology == 'ring'
+    windows = list()
+    counts = np.empty( (noLocns, len(dists)) ) # the number of territories within each distance
+    habCounts = np.empty( (noLocns, len(dists), len(habTypes)) ) # and of each habitat type
+
+    for idxDist, dist in enumerate(dists):
+
+        if isRing:
+
+            windows.append( { 'offsets': np.arange(-dist, dist+1) } )
+            counts[:, idxDist] = 2*dist+1
+            habCounts[:, idxDist] = windowSums( windows[-1], np.eye( len(habTypes) )[landCodes] )
+
+        else:
+
+            neighbours = [ landscape.neighbours(locn, dist) for locn in range(noLocns) ]
+            sources = np.concatenate( [ np.full( len(nbrs), locn ) for locn, nbrs in enumerate(neighbours) ] )
+            dests = np.concatenate(neighbours)
+            order = np.argsort(dests, kind='stable')
+
+            windows.append( { 'sources': sources[order], 'starts': np.searchsorted( dests[order], np.arange(noLocns) ) } )
+            counts[:, idxDist] = np.bincount( sources, minlength=noLocns )
+
+            for habCode in range( len(habTypes) ):
+                habCounts[:, idxDist, habCode] = np.bincount( sources, weights=landCodes[dests] == habCode, minlength=noLocns )
+
+    tables['dists'] = dists
+    tables['windows'] = windows
+
+    # the total weight of each neighbourhood, for each preference: the preferred habitat type weighted 1 + |phen|, the others 1
+
+    prefGenes = [ geneType for geneType in ['pref', 'phil'] if geneType in genetics ]
+
+    if prefGenes:
+
+        prefGene = prefGenes[0] # as in dispFnc, 'pref' if both
+        codeH, codeL = habTypes.index('H'), habTypes.index('L')
+        phens = np.array( [ popcount2phen(parameters, noOnes, prefGene) for noOnes in range( genetics[prefGene]['noLoci']+1 ) ] )
+
+        if prefGene == 'pref': # positive prefers 'H' and negative prefers 'L'
+            prefCodes = np.broadcast_to( np.where( phens < 0, codeL, codeH ), (noLocns, len(phens)) )
+        else: # positive prefers the natal habitat type and negative the other
+            prefCodes = np.where( phens < 0, np.where( landCodes == codeH, codeL, codeH )[:, None], landCodes[:, None] )
+
+        tables['prefGene'] = prefGene
+        tables['prefWeights'] = 1 + np.abs(phens)
+        tables['prefCodes'] = prefCodes
+        tables['invTotals'] = 1 / ( counts[:, :, None] + (tables['prefWeights'] - 1) * habCounts[ np.arange(noLocns)[:, None, None], np.arange( len(dists) )[:, None], prefCodes[:, None, :] ] )
+
+    else:
+
+        tables['invTotals'] = 1 / counts[:, :, None]
+
+    # competition, tabulated up to the most juveniles of a sex that can arrive: the largest brood, in the neighbourhood most weighted to it
+
+    weights = np.array( [ parameters['competition'][habType] for habType in habTypes ], dtype=float )
+    prefWeightMax = tables['prefWeights'].max() if prefGenes else 1
+    concentration = max( windowSums( window, prefWeightMax * tables['invTotals'][:, idxDist].max(axis=1) ).max() for idxDist, window in enumerate(windows) )
+    arrivalsMax = tables['noOffspring'].max() * concentration * tables['sexFracs'].max()
+
+    tables['compn'] = compnTables( weights, tables['ranks'].max() + 1, max(arrivalsMax, 1e-9) )
+
+    return tables
+
+def dispExpected(tables, juveniles, dispDists):
+    """
+    arrivals = dispExpected(tables, juveniles, dispDists)
+
+    The expected number of juveniles arriving at each territory, of each natal habitat type and number of 1 alleles of each
+    gene type. A juvenile with dispersal distance d and preference k born at o arrives at x, in o's neighbourhood within d,
+    with probability w(x) * invTotals[o, d, k], where w(x) is the weight of the preferred habitat type if x is of it, else 1.
+    Summed over the juveniles, this is a sum over windows, for each distance, of the juveniles times invTotals, plus for the
+    territories of each habitat type, a sum of the juveniles preferring it times (weight - 1) * invTotals.
+
+    juveniles:
+        {geneType: array (noLocns, noLoci+1)}, the expected number of juveniles born in each territory with each number of 1 alleles
+    dispDists:
+        {geneType: array (noLocns, noLoci+1)}, the distribution of the juveniles born in each territory over the dispersal
+        genes ('pref' or 'phil', and 'dist'), if any
+    arrivals:
+        {geneType: array (noLocns, noHabTypes, noLoci+1)}
+
+    >>> tables = { 'landCodes': np.array([0, 0, 0, 0]), 'noHabTypes': 1, 'dists': np.array([1]), 'windows': [ {'offsets': np.arange(-1, 2)} ],
+    ...     'invTotals': np.full( (4, 1, 1), 1/3 ) }
+    >>> dispExpected( tables, {'repn': np.array([[3., 0], [0, 0], [0, 0], [0, 6]])}, dict() )['repn'][:, 0]
+    array([[1., 2.],
+           [1., 0.],
+           [0., 2.],
+           [1., 2.]])
+    """
+
+    landCodes = tables['landCodes']
+    noLocns = len(landCodes)
+    noHabTypes = tables['noHabTypes']
+    noDists = len( tables['dists'] )
+    invTotals = tables['invTotals']
+    prefGene = tables.get('prefGene')
+    geneTypes = list(juveniles)
+
+    # the juveniles of every gene type side by side, each by its natal habitat type
+
+    sizes = [ juveniles[geneType].shape[1] for geneType in geneTypes ]
+    born = np.zeros( (noLocns, noHabTypes, sum(sizes)) )
+    born[ np.arange(noLocns), landCodes ] = np.concatenate( [ juveniles[geneType] for geneType in geneTypes ], axis=1 )
+
+    # for each gene type, the chance of each distance, and the mean of invTotals (and of (weight - 1) * invTotals for each
+    # preferred habitat type), over the other dispersal genes at the juvenile's natal territory, or its own if a dispersal gene
+
+    if 'dist' in dispDists:
+        distFracs = np.stack( [ dispDists['dist'][:, tables['distIdxs'] == idxDist].sum(axis=1) for idxDist in range(noDists) ], axis=1 )
+    else:
+        distFracs = np.ones( (noLocns, 1) )
+
+    if prefGene is not None:
+        prefFracs = dispDists[prefGene]
+        prefOnes = np.eye(noHabTypes)[ tables['prefCodes'] ] * (tables['prefWeights'] - 1)[:, None] # (noLocns, noPrefs, noHabTypes)
+        meanInvs = np.einsum('lk,ldk->ld', prefFracs, invTotals)
+        meanExtras = np.einsum('lk,ldk,lkh->ldh', prefFracs, invTotals, prefOnes)
+
+    factors = list() # each (noLocns, noDists, noLoci+1), and with a last axis of habitat type for the extras
+    extras = list()
+
+    for geneType, size in zip(geneTypes, sizes):
+
+        if geneType == prefGene:
+            factors.append( distFracs[:, :, None] * invTotals )
+            extras.append( distFracs[:, :, None, None] * invTotals[:, :, :, None] * prefOnes[:, None] )
+        elif prefGene is None:
+            factors.append( np.broadcast_to( ( distFracs * invTotals[:, :, 0] )[:, :, None], (noLocns, noDists, size) ) )
+        else:
+            factors.append( np.broadcast_to( ( distFracs * meanInvs )[:, :, None], (noLocns, noDists, size) ) )
+            extras.append( np.broadcast_to( ( distFracs[:, :, None] * meanExtras )[:, :, None], (noLocns, noDists, size, noHabTypes) ) )
+
+        if geneType == 'dist': # its own distance
+            isDist = tables['distIdxs'] == np.arange(noDists)[:, None]
+            factors[-1] = np.where( isDist, invTotals[:, :, :1] if prefGene is None else meanInvs[:, :, None], 0 )
+            if prefGene is not None:
+                extras[-1] = np.where( isDist[:, :, None], meanExtras[:, :, None], 0 )
+
+    factors = np.concatenate(factors, axis=2)
+    extras = np.concatenate(extras, axis=2) if prefGene is not None else None
+
+    arrivals = np.zeros_like(born)
+
+    for idxDist, window in enumerate( tables['windows'] ):
+
+        if factors[:, idxDist].any():
+
+            arrivals += windowSums( window, born * factors[:, None, idxDist] )
+
+            if extras is not None: # the extra weight of each preferred habitat type, to the territories of that type
+
+                extraSums = windowSums( window, born[:, :, :, None] * extras[:, None, idxDist] )
+                arrivals += extraSums[ np.arange(noLocns), :, :, landCodes ]
+
+    return dict( zip( geneTypes, np.split( arrivals, np.cumsum(sizes)[:-1], axis=2 ) ) )
+
+def expectedStart(parameters, landscape, initial_ecosystem=None):
+    """
+    state = expectedStart(parameters, landscape, initial_ecosystem=None)
+
+    The state at the start of a run: of the initial ecosystem if given, else of simulate's random start,
+    where every slot is filled by an adult with random genes and a natal habitat type drawn from the landscape
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'genetics': { 'repn': {'noLoci': 2} }, 'habitats': {'L': {}, 'H': {}} }
+    >>> state = expectedStart(parameters, 'LLHL')
+    >>> state['repn'][0, 0]
+    array([[0.0625, 0.125 , 0.0625],
+           [0.1875, 0.375 , 0.1875]])
+    >>> ecosystem = [ {'adults': [{'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 3}}], 'juveniles': []} ]
+    >>> expectedStart(parameters, 'L', ecosystem)['repn'][0].tolist()
+    [[[0.0, 0.0, 0.0], [0.0, 0.0, 1.0]], [[0.0, 0.0, 0.0], [0.0, 0.0, 0.0]]]
+    """
+
+    habTypes = habTypesList(parameters)
+    noLocns = len(landscape)
+    noSlots = len( parameters['sexes'] )
+    state = dict()
+
+    if initial_ecosystem is None:
+
+        habFracs = np.array( [ landscape.count(habType) / noLocns for habType in habTypes ] )
+
+        for geneType, geneParams in parameters['genetics'].items():
+
+            noLoci = geneParams['noLoci']
+            binom = np.array( [ comb(noLoci, k) for k in range(noLoci+1) ] ) / 2**noLoci
+            state[geneType] = np.broadcast_to( habFracs[:, None] * binom, (noLocns, noSlots, len(habTypes), noLoci+1) ).copy()
+
+    else:
+
+        popn = ecosystem2popn(parameters, initial_ecosystem)
+        locns, slots = np.nonzero( popn['present'] )
+        natalHabCodes = popn['natalHabType'][locns, slots]
+
+        for geneType, geneParams in parameters['genetics'].items():
+
+            state[geneType] = np.zeros( (noLocns, noSlots, len(habTypes), geneParams['noLoci']+1) )
+            state[geneType][ locns, slots, natalHabCodes, popcountGenes( popn['genotype'][geneType][locns, slots] ) ] = 1
+
+    return state
+
+def timestepExpected(parameters, state, landscape, stats=None, tables=None):
+    """
+    state, landscape = timestepExpected(parameters, state, landscape, stats=None, tables=None)
+
+    One generation of expected values: reproduction, dispersal, death of adults, and competition
+
+    stats:
+        dictionary or None, if given stats['noPairs'] is set to the expected number of mating pairs after competition
+    tables:
+        the arrays from expectedTables, so they need not be rebuilt each generation
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'distMax': 1, 'competition': {'L': 1, 'H': 1},
+    ...     'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0} },
+    ...     'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.1} } }
+    >>> ecosystem = [ {'adults': [ {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 31}} ]*2, 'juveniles': []} ]*3
+    >>> stats = dict()
+    >>> state, _ = timestepExpected(parameters, expectedStart(parameters, 'LLL', ecosystem), 'LLL', stats)
+    >>> round( stats['noPairs'], 2 ), expectedSummary(parameters, state)['phen']['repn'].round(2) # well-adapted parents fill the landscape
+    (3.0, array([-1., -1., -1.]))
+    """
+
+    if tables is None:
+        tables = expectedTables(parameters, landscape)
+
+    landCodes = tables['landCodes']
+    noLocns = len(landCodes)
+    noOffspringTable = tables['noOffspring']
+    ranks = tables['ranks']
+
+    # reproduction: the chance of a pair, and the distribution of its total number of 1 alleles, from each slot's distribution
+
+    slotFills = np.einsum('lshk->ls', state['repn']) # (noLocns, noSlots)
+    pPair = slotFills[:, tables['lastSlots']].prod(axis=1)
+
+    juveniles = dict()
+    dispDists = dict()
+
+    for geneType in ['repn'] + [ geneType for geneType in state if geneType != 'repn' ]:
+
+        slotDists = np.einsum('lshk->lsk', state[geneType]) # (einsum sums over the middle axis faster than sum)
+        slotDists /= np.maximum( np.einsum('lsk->ls', slotDists), 1e-300 )[:, :, None] # by its own total, so rounding errors don't build up
+        noLoci = slotDists.shape[2] - 1
+
+        # the pair's total, convolving the two slots: total s is i in the first slot and s-i in the second, in windows of the second's padded
+
+        windows = np.lib.stride_tricks.sliding_window_view( np.pad( slotDists[:, 1], ( (0, 0), (noLoci, noLoci) ) ), noLoci+1, axis=1 )
+
+        if geneType == 'repn': # expected number of offspring, and of each number of 1 alleles
+
+            if noOffspringTable.ndim == 2:
+                broods = ( windows @ slotDists[:, 0, ::-1, None] )[:, :, 0] * noOffspringTable[landCodes]
+            else: # by the first slot's number too
+                broods = np.einsum( 'lsi,li,lsi->ls', windows, slotDists[:, 0, ::-1], noOffspringTable[landCodes][:, :, ::-1] )
+
+            broods *= pPair[:, None]
+            noOffspring = broods.sum(axis=1)
+            juveniles[geneType] = broods @ tables['inherit'][geneType]
+
+        else:
+
+            juveniles[geneType] = noOffspring[:, None] * ( ( windows @ slotDists[:, 0, ::-1, None] )[:, :, 0] @ tables['inherit'][geneType] )
+
+        if geneType in ['pref', 'phil', 'dist']:
+            dispDists[geneType] = juveniles[geneType] / np.where( noOffspring > 0, noOffspring, 1 )[:, None]
+
+    # dispersal, then death of adults, and competition among the juveniles for the positions of each sex
+
+    juveniles = dispExpected(tables, juveniles, dispDists)
+
+    arrivals = juveniles['repn'].sum(axis=2) # (noLocns, noHabTypes)
+    fills = np.empty( (noLocns, len(ranks), arrivals.shape[1]) )
+
+    for idxSex in set( tables['slotSexes'].tolist() ):
+
+        slots = np.flatnonzero( tables['slotSexes'] == idxSex )
+        sexFills = compnFills( tables['compn'], tables['sexFracs'][idxSex] * arrivals, ranks[slots].max() + 1 )
+        fills[:, slots] = sexFills[ ranks[slots] ].transpose(1, 0, 2)
+
+    state = dict()
+
+    for geneType, arrived in juveniles.items(): # each slot's natal habitat type, then the genes of the juveniles of that type
+
+        totals = arrived.sum(axis=2)
+        state[geneType] = ( fills / np.where( totals > 0, totals, 1 )[:, None, :] )[:, :, :, None] * arrived[:, None]
+
+    if stats is not None:
+        stats['noPairs'] = float( fills.sum(axis=2)[:, tables['lastSlots']].prod(axis=1).sum() )
+
+    return state, landscape
+
+def expectedSummary(parameters, state):
+    """
+    summary = expectedSummary(parameters, state)
+
+    Expected values in each territory
+
+    summary:
+        dictionary, with keys
+        'occupancy': array (noLocns,), the expected number of adults
+        'phen': {geneType: array (noLocns,)}, the expected mean phenotype of the adults (nan if almost surely empty)
+        'natalHabType': array (noLocns, noHabTypes), the expected number of adults born on each habitat type
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'genetics': { 'repn': {'noLoci': 2, 'maxPhen': 2, 'minPhen': -2, 'isInt': False} }, 'habitats': {'L': {}, 'H': {}} }
+    >>> summary = expectedSummary( parameters, expectedStart(parameters, 'LLHL') )
+    >>> summary['occupancy'], summary['phen']['repn'], summary['natalHabType'][0]
+    (array([2., 2., 2., 2.]), array([0., 0., 0., 0.]), array([0.5, 1.5]))
+    """
+
+    natalHabType = state['repn'].sum(axis=(1, 3))
+    occupancy = natalHabType.sum(axis=1)
+    phen = dict()
+
+    for geneType, dists in state.items():
+
+        phens = np.array( [ popcount2phen(parameters, noOnes, geneType) for noOnes in range( dists.shape[3] ) ] )
+        phen[geneType] = np.where( occupancy > 1e-12, dists.sum(axis=(1, 2)) @ phens / np.where( occupancy > 1e-12, occupancy, 1 ), np.nan )
+
+    return { 'occupancy': occupancy, 'phen': phen, 'natalHabType': natalHabType }
+
+def simulateExpected(parameters, landscape, tf, initial_ecosystem=None, every=1, tol=None):
+    """
+    results = simulateExpected(parameters, landscape, tf, initial_ecosystem=None, every=1, tol=None)
+
+    Runs the expected-value model for tf generations, from the initial ecosystem or simulate's random start,
+    keeping the summary (see expectedSummary) every few generations
+
+    every:
+        integer, keep the summary of every this many generations, and always of the last
+    tol:
+        value or None, if given stop once no probability in the state changes by more than tol in a generation
+    results:
+        dictionary, with 't' (the last the generation it stopped), 'noPairs' (the expected number of mating pairs),
+        and the summary arrays stacked with the generation first, and 'state', the final state
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'distMax': 1, 'competition': {'L': 1, 'H': 10},
+    ...     'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0.01} },
+    ...     'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.1} } }
+    >>> results = simulateExpected(parameters, 'LLLLLLHHHLLLLLL', 100, every=50)
+    >>> results['t'].tolist(), results['phen']['repn'].shape
+    ([0, 50, 100], (3, 15))
+    >>> results['phen']['repn'][-1, [0, 7]].round(1) # adapted to L far from the H patch, and to H in it
+    array([-0.5,  0.5])
+    >>> results = simulateExpected(parameters, 'LLLLLLHHHLLLLLL', 1000, every=1000, tol=1e-4)
+    >>> results['t'].tolist() # stopped once settled
+    [0, 96]
+    """
+
+    model = parameterModel(parameters, landscape)
+    tables = expectedTables(model, landscape)
+    state = expectedStart(model, landscape, initial_ecosystem)
+    stats = { 'noPairs': float( state['repn'].sum(axis=(2, 3))[:, tables['lastSlots']].prod(axis=1).sum() ) }
+
+    ts = list()
+    summaries = list()
+    noPairs = list()
+    isSettled = False
+
+    for t in range(tf+1):
+
+        if t > 0:
+
+            lastState = state
+            state, landscape = timestepExpected(model, state, landscape, stats, tables)
+
+            if tol is not None:
+                isSettled = max( np.abs( state[geneType] - lastState[geneType] ).max() for geneType in state ) <= tol
+
+        if t % every == 0 or t == tf or isSettled:
+
+            ts.append(t)
+            summaries.append( expectedSummary(model, state) )
+            noPairs.append( stats['noPairs'] )
+
+        if isSettled:
+            break
+
+    results = {
+            't': np.array(ts),
+            'noPairs': np.array(noPairs),
+            'occupancy': np.stack( [ summary['occupancy'] for summary in summaries ] ),
+            'phen': { geneType: np.stack( [ summary['phen'][geneType] for summary in summaries ] ) for geneType in parameters['genetics'] },
+            'natalHabType': np.stack( [ summary['natalHabType'] for summary in summaries ] ),
+            'state': state,
+            }
+
+    return results
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,159 @@
+# The individuals and flocks of the pure-Python engines ('dicts' and 'fused'), e.g.
+#
+#   Individual('h', 'L', {'repn': 31, 'pref': 1023})
+#   Flock(adults=[mum, dad], juveniles=[])
+#
+# in place of the dictionaries {'sex': 'h', 'natalHabType': 'L', 'genotype': {...}} and {'adults': [...], 'juveniles': [...]}.
+# They keep their fields in __slots__, so an individual takes about a third of the memory of the dictionary (the genotype
+# is still a dictionary) and the timesteps read individual.natalHabType and flock.adults as attributes, which is faster than
+# looking up a key. They also behave like the dictionaries they replace, so code that indexes them, e.g.
+# ecosystem[locn]['adults'][0]['genotype']['repn'], keeps working, they compare equal to the dictionaries, and they pickle
+# as the dictionaries, so the recorded ecosystems and checkpoints are lists of dictionaries as before.
+# ecosystemSnapshot (in carryover.py) turns an ecosystem of dictionaries into one of Flocks and Individuals.
+
+
+class DictSlots:
+    """
+    The dictionary-like behaviour shared by Individual and Flock, with the keys the names of the __slots__
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+
+        if key not in self.__slots__:
+            raise KeyError(key)
+
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+
+        return key in self.__slots__
+
+    def __iter__(self):
+
+        return iter(self.__slots__)
+
+    def __len__(self):
+
+        return len(self.__slots__)
+
+    def get(self, key, default=None):
+
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def keys(self):
+
+        return list(self.__slots__)
+
+    def values(self):
+
+        return [ getattr(self, key) for key in self.__slots__ ]
+
+    def items(self):
+
+        return [ (key, getattr(self, key)) for key in self.__slots__ ]
+
+    def __eq__(self, other):
+
+        if type(other) is type(self):
+            return self.values() == other.values()
+
+        if isinstance(other, (DictSlots, dict)):
+            return dict( self.items() ) == dict( other.items() )
+
+        return NotImplemented
+
+    __hash__ = None # unhashable, like a dictionary
+
+    def __reduce__(self): # pickled (and copied) as a dictionary
+
+        return dict, (), None, None, iter( self.items() )
+
+    def __repr__(self):
+
+        return type(self).__name__ + '(' + ', '.join( key + '=' + repr(value) for key, value in self.items() ) + ')'
+
+class Individual(DictSlots):
+    """
+    individual = Individual(sex=None, natalHabType=None, genotype=None)
+
+    sex:
+        string, one of parameters['sexes']
+    natalHabType:
+        string, the habitat type it was born on
+    genotype:
+        dictionary, keys are gene types and values the genes, e.g. {'repn': 31}
+
+    >>> individual = Individual('h', 'L', {'repn': 31})
+    >>> individual.natalHabType, individual['genotype']['repn']
+    ('L', 31)
+    >>> individual == {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 31}}
+    True
+    >>> import pickle
+    >>> pickle.loads( pickle.dumps(individual) )
+    {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 31}}
+    """
+
+    __slots__ = ('sex', 'natalHabType', 'genotype')
+
+    def __init__(self, sex=None, natalHabType=None, genotype=None):
+
+        self.sex = sex
+        self.natalHabType = natalHabType
+        self.genotype = genotype
+
+class Flock(DictSlots):
+    """
+    flock = Flock(adults=None, juveniles=None)
+
+    adults:
+        list of Individuals, the mating pair (or a single adult), empty if None
+    juveniles:
+        list of Individuals waiting to compete for the positions of the pair, empty if None
+
+    >>> flock = Flock( [ Individual('h', 'L', {'repn': 31}) ] )
+    >>> len( flock.adults ), flock['juveniles']
+    (1, [])
+    """
+
+    __slots__ = ('adults', 'juveniles')
+
+    def __init__(self, adults=None, juveniles=None):
+
+        self.adults = list() if adults is None else adults
+        self.juveniles = list() if juveniles is None else juveniles
+
+def asIndividual(individual):
+    """
+    Returns the individual as an Individual, converting it if it is a dictionary
+    """
+
+    if type(individual) is Individual:
+        return individual
+
+    return Individual( **individual )
+
+def asFlock(flock):
+    """
+    Returns a new Flock with new lists of the flock's adults and juveniles, converting any that are dictionaries,
+    and sharing those that are Individuals
+
+    >>> flock = asFlock( {'adults': [ {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 31}} ], 'juveniles': []} )
+    >>> flock.adults[0].genotype, flock == {'adults': [ {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': 31}} ], 'juveniles': []}
+    ({'repn': 31}, True)
+    """
+
+    return Flock( [ asIndividual(adult) for adult in flock['adults'] ], [ asIndividual(juvenile) for juvenile in flock['juveniles'] ] )
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
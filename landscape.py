@@ -0,0 +1,312 @@
+from collections import deque
+import numpy as np
+
+# Landscapes other than the 1-D ring of a landscape string: 2-D grids of territories, wrapped (torus) or not (bounded),
+# and networks of patches (graph). A Landscape can be passed anywhere a landscape string can, e.g.
+#
+#   landscape = landscapeGrid( ['LLLLL', 'LHHHL', 'LLLLL'], torus=True )
+#   simulate(parameters, landscape, burnInT, tf)
+#
+# The distance between territories is the distance around the ring, the Chebyshev (king-move) distance on a grid, so the
+# territories within distance d form a (2d+1) x (2d+1) square, and the number of edges on a graph. Territories are numbered
+# 0 .. len(landscape)-1, row by row on a grid, so the population arrays and recorded results are laid out as for a ring.
+
+
+class Landscape:
+    """
+    landscape = Landscape(habTypes, codes, topology='ring', shape=None, edges=None)
+
+    The habitat types of the territories stored compactly as codes, with the neighbourhoods within each dispersal distance
+    precomputed when first needed and cached. Like a landscape string, len(landscape) is the number of territories, and
+    landscape[locn] and iterating give the habitat type letters, and landscape.count(habType) counts territories.
+
+    habTypes:
+        list of strings, the habitat types in the order of their codes
+    codes:
+        array, the habitat type code of each territory (stored as uint8)
+    topology:
+        string, 'ring' (1-D, wrapping around, as a landscape string), 'torus' (2-D, wrapping around both ways),
+        'bounded' (2-D, not wrapping), or 'graph' (patches connected by edges)
+    shape:
+        tuple (noRows, noCols) of a 2-D grid
+    edges:
+        list of pairs of adjacent territories of a graph
+
+    >>> landscape = landscapeGrid( ['LLL', 'LHL'], torus=False )
+    >>> len(landscape), landscape[4], ''.join(landscape)
+    (6, 'H', 'LLLLHL')
+    >>> landscape.neighbours(0, 1).tolist() # territories within distance 1 of the corner, nearest first
+    [0, 1, 3, 4]
+    """
+
+    def __init__(self, habTypes, codes, topology='ring', shape=None, edges=None):
+
+        if topology not in ['ring', 'torus', 'bounded', 'graph']:
+            raise ValueError('unknown topology ' + str(topology))
+
+        self.habTypes = list(habTypes)
+        self.codes = np.asarray(codes, dtype=np.uint8)
+        self.topology = topology
+        self.shape = tuple(shape) if shape is not None else None
+        self.edges = list(edges) if edges is not None else None
+        self._cache = dict() # neighbourhood tables by dispersal distance
+
+    def __len__(self):
+
+        return len(self.codes)
+
+    def __getitem__(self, locn):
+
+        return self.habTypes[ self.codes[locn] ]
+
+    def __iter__(self):
+
+        habTypes = self.habTypes
+        return ( habTypes[code] for code in self.codes.tolist() )
+
+    def count(self, habType):
+
+        if habType not in self.habTypes:
+            return 0
+
+        return int( np.count_nonzero( self.codes == self.habTypes.index(habType) ) )
+
+    def __repr__(self):
+
+        size = 'x'.join( str(n) for n in self.shape ) if self.shape is not None else str(len(self))
+        return 'Landscape(' + self.topology + ', ' + size + ')'
+
+    def __getstate__(self): # the cached tables are not pickled with results
+
+        state = dict(self.__dict__)
+        state['_cache'] = dict()
+        return state
+
+    def offsets(self, dist):
+        """
+        Returns the offsets (ring) or (row, column) offsets (grid) of the territories within distance dist, nearest first,
+        so those within any smaller distance d come first (2d+1 of them on a ring, (2d+1)**2 on a grid)
+        """
+
+        if dist not in self._cache:
+
+            steps = np.arange(-dist, dist+1)
+            steps = steps[ np.argsort( np.abs(steps), kind='stable' ) ] # 0, -1, 1, -2, 2, ...
+
+            if self.topology == 'ring':
+
+                self._cache[dist] = steps
+
+            else:
+
+                offsets = np.array( [ (dRow, dCol) for dRow in steps for dCol in steps ], dtype=np.int64 ).reshape(-1, 2)
+                self._cache[dist] = offsets[ np.argsort( np.abs(offsets).max(axis=1), kind='stable' ) ]
+
+        return self._cache[dist]
+
+    def graphTables(self, dist):
+        """
+        tables = graphTables(dist)
+
+        For a graph, the territories within dist edges of each territory, found by breadth-first search
+
+        tables:
+            dictionary, with 'starts' (array, where each territory's neighbourhood starts in 'neighbours'), 'neighbours'
+            (array, nearest first), and 'counts' (array (noLocns, dist+1), how many are within each distance)
+        """
+
+        if dist not in self._cache:
+
+            noLocns = len(self)
+            adjacent = [ list() for locn in range(noLocns) ]
+            for locn0, locn1 in self.edges:
+                adjacent[locn0].append(locn1)
+                adjacent[locn1].append(locn0)
+
+            starts = np.zeros( noLocns+1, dtype=np.int64 )
+            counts = np.zeros( (noLocns, dist+1), dtype=np.int64 )
+            neighbours = list()
+
+            for locn in range(noLocns):
+
+                found = {locn: 0}
+                queue = deque([locn])
+
+                while queue:
+
+                    here = queue.popleft()
+
+                    if found[here] < dist:
+                        for there in adjacent[here]:
+                            if there not in found:
+                                found[there] = found[here] + 1
+                                queue.append(there)
+
+                neighbours.extend(found.keys()) # in the order found, so nearest first
+                counts[locn] = np.cumsum( np.bincount( list(found.values()), minlength=dist+1 ) )
+                starts[locn+1] = len(neighbours)
+
+            self._cache[dist] = { 'starts': starts, 'neighbours': np.array(neighbours, dtype=np.int64), 'counts': counts }
+
+        return self._cache[dist]
+
+    def neighbours(self, locn, dist):
+        """
+        Returns the territories within distance dist of locn, nearest first
+        """
+
+        if self.topology == 'graph':
+
+            tables = self.graphTables(dist)
+            return tables['neighbours'][ tables['starts'][locn]:tables['starts'][locn+1] ]
+
+        noOffsets = len( self.offsets(dist) )
+        locns = self.proposeArray( np.full(noOffsets, locn), np.full(noOffsets, dist), ( np.arange(noOffsets) + 0.5 ) / noOffsets ) # each offset in turn
+
+        return locns[ locns >= 0 ]
+
+    def propose(self, locn, dist, r):
+        """
+        newLocn = propose(locn, dist, r)
+
+        Chooses a territory uniformly from all the places within distance dist of locn, using the uniform random number r.
+        On a bounded grid, a place can be off the edge, given as -1, so the choice can be repeated (rejection sampling)
+
+        >>> landscape = landscapeGrid( ['LLLL', 'LLLL', 'LLLL'], torus=True )
+        >>> landscape.propose(0, 1, 0.0), landscape.propose(0, 1, 0.99) # itself, and the last of the 9 nearest
+        (0, 5)
+        """
+
+        if self.topology == 'graph':
+
+            tables = self.graphTables(dist)
+            start = tables['starts'].item(locn)
+
+            return tables['neighbours'].item( start + int( r * ( tables['starts'].item(locn+1) - start ) ) )
+
+        offsets = self.offsets(dist)
+        idx = int( r * len(offsets) )
+
+        if self.topology == 'ring':
+            return ( locn + offsets.item(idx) ) % len(self)
+
+        noRows, noCols = self.shape
+        row = locn // noCols + offsets.item(idx, 0)
+        col = locn % noCols + offsets.item(idx, 1)
+
+        if self.topology == 'torus':
+            return (row % noRows) * noCols + col % noCols
+
+        return row*noCols + col if 0 <= row < noRows and 0 <= col < noCols else -1
+
+    def proposeArray(self, locns, dists, r):
+        """
+        newLocns = proposeArray(locns, dists, r)
+
+        Array version of propose, for arrays of locations, distances and uniform random numbers
+
+        >>> landscape = landscapeGrid( ['LLLL', 'LLLL', 'LLLL'], torus=False )
+        >>> landscape.proposeArray( np.array([0, 0, 5]), np.array([1, 1, 0]), np.array([0.0, 0.15, 0.5]) ) # the second is off the edge
+        array([ 0, -1,  5])
+        """
+
+        if self.topology == 'graph':
+
+            tables = self.graphTables( int( dists.max() ) )
+            idxs = ( r * tables['counts'][locns, dists] ).astype(np.int64)
+
+            return tables['neighbours'][ tables['starts'][locns] + idxs ]
+
+        offsets = self.offsets( int( dists.max() ) )
+
+        if self.topology == 'ring':
+
+            idxs = ( r * (2*dists+1) ).astype(np.int64)
+
+            return ( locns + offsets[idxs] ) % len(self)
+
+        noRows, noCols = self.shape
+        idxs = ( r * (2*dists+1)**2 ).astype(np.int64)
+        rows = locns // noCols + offsets[idxs, 0]
+        cols = locns % noCols + offsets[idxs, 1]
+
+        if self.topology == 'torus':
+            return (rows % noRows) * noCols + cols % noCols
+
+        return np.where( (rows >= 0) & (rows < noRows) & (cols >= 0) & (cols < noCols), rows*noCols + cols, -1 )
+
+def landscapeCodes(landscape, habTypes):
+    """
+    landCodes = landscapeCodes(landscape, habTypes)
+
+    Returns an array of the habitat type code of each territory, where the codes index the list habTypes, for a landscape
+    string or a Landscape
+
+    >>> landscapeCodes( landscapeRing('LLHHL'), ['H', 'L'] )
+    array([1, 1, 0, 0, 1], dtype=uint8)
+    """
+
+    if isinstance(landscape, str):
+        return np.array( [ habTypes.index(habType) for habType in landscape ], dtype=np.uint8 )
+
+    lookup = np.array( [ habTypes.index(habType) for habType in landscape.habTypes ], dtype=np.uint8 ) # from its codes to these
+
+    return lookup[ landscape.codes ]
+
+def landscapeRing(landscapeStr):
+    """
+    Returns the Landscape of a landscape string, a 1-D ring
+    """
+
+    habTypes = sorted( set(landscapeStr) )
+
+    return Landscape( habTypes, [ habTypes.index(habType) for habType in landscapeStr ], 'ring' )
+
+def landscapeGrid(rows, torus=True):
+    """
+    landscape = landscapeGrid(rows, torus=True)
+
+    Returns a 2-D grid Landscape
+
+    rows:
+        list of strings, the habitat types of each row of the grid, all the same length
+    torus:
+        boolean, if True the grid wraps around at its edges, else dispersal is bounded by them
+
+    >>> landscapeGrid( ['LLHH', 'LLHH'] )
+    Landscape(torus, 2x4)
+    """
+
+    if len( set( len(row) for row in rows ) ) != 1:
+        raise ValueError('the rows of a grid must all be the same length')
+
+    landscapeStr = ''.join(rows)
+    habTypes = sorted( set(landscapeStr) )
+    codes = np.array( [ habTypes.index(habType) for habType in landscapeStr ], dtype=np.uint8 )
+
+    return Landscape( habTypes, codes, 'torus' if torus else 'bounded', shape=( len(rows), len(rows[0]) ) )
+
+def landscapeGraph(habTypesStr, edges):
+    """
+    landscape = landscapeGraph(habTypesStr, edges)
+
+    Returns a Landscape of patches connected by edges
+
+    habTypesStr:
+        string, the habitat type of each patch
+    edges:
+        list of pairs of patches that are adjacent (e.g. within reach of a single dispersal step)
+
+    >>> landscape = landscapeGraph( 'LHL', [(0, 1), (1, 2)] )
+    >>> landscape.neighbours(0, 1).tolist(), landscape.neighbours(0, 2).tolist()
+    ([0, 1], [0, 1, 2])
+    """
+
+    habTypes = sorted( set(habTypesStr) )
+
+    return Landscape( habTypes, [ habTypes.index(habType) for habType in habTypesStr ], 'graph', edges=edges )
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
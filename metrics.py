@@ -0,0 +1,228 @@
+import json
+import time
+import tracemalloc
+
+try:
+    import resource # not on Windows
+except ImportError:
+    resource = None
+
+# Instrumentation of the simulation loop, to see where the time goes in each generation, e.g.
+#
+#   simulate(parameters, landscape, burnInT, tf, metrics=True)
+#
+# writes ecosystems_suffix.metrics.json. The timesteps add to a metrics dictionary as they go (passed like stats, and
+# None to switch it off, which costs only a check of metrics is not None here and there), and simulate closes each
+# generation with metricsGeneration. For each generation it holds the wall time (in seconds) of each phase:
+#
+#   'step'          the whole timestep, of which
+#   'reproduction'  the number of offspring of each pair and making their genotypes
+#   'dispersal'     choosing where each offspring goes
+#   'competition'   juveniles competing for the positions in the flock they arrive at
+#   'death'         the adults dying and the winners becoming the new adults
+#   'breed', 'exchange', 'compete'
+#                   instead of the above for the 'parallel' engine: the workers breeding and dispersing, sending the
+#                   juveniles that leave a block to its neighbours and waiting for those arriving, and competing, each
+#                   the time of the slowest worker
+#
+# (the compiled loops of the 'numba' engine cannot be timed by phase, so simulate does not take metrics with it), and
+# outside the timestep:
+#
+#   'record'        storing the generation (e.g. copying the ecosystem, or writing it to disk)
+#   'observe', 'stop', 'checkpoint'
+#                   observers, stopping criteria and checkpoints
+#
+# the counts:
+#
+#   'offspring'         offspring created
+#   'flocksReached'     flocks that juveniles arrived at, so offspring / flocksReached is the mean number of juveniles per flock
+#   'maxJuveniles'      the most juveniles arriving at one flock
+#   'dispersalDraws'    locations proposed in dispersal, more than offspring when proposals are rejected (e.g. off the edge of a bounded grid)
+#   'mutations'         alleles flipped by mutation
+#   'exchanged'         juveniles sent between blocks by the 'parallel' engine (whose other counts are not collected)
+#   'noPairs'           mating pairs after competition
+#
+# and the memory:
+#
+#   'maxRSS'        the peak resident memory of the process so far, in bytes (where the resource module is available)
+#   'peakTraced'    with metrics='memory', the peak memory allocated by Python during the generation, in bytes (traced by
+#                   tracemalloc, which makes the run several times slower)
+
+
+def metricsOpen(memory=False):
+    """
+    metrics = metricsOpen(memory=False)
+
+    Starts the metrics of a run, with tracing of Python memory allocations if memory is True
+
+    >>> metrics = metricsOpen()
+    >>> start = metricsPhase(metrics, 'dispersal', time.perf_counter())
+    >>> metricsCount(metrics, 'offspring', 3); metricsMax(metrics, 'maxJuveniles', 2); metricsMax(metrics, 'maxJuveniles', 1)
+    >>> metricsGeneration(metrics, 1)
+    >>> gen = metrics['generations'][0]
+    >>> gen['t'], list(gen['phases'].keys()), gen['counts']
+    (1, ['dispersal'], {'offspring': 3, 'maxJuveniles': 2})
+    """
+
+    if memory:
+        tracemalloc.start()
+
+    return { 'memory': memory, 'phases': dict(), 'counts': dict(), 'generations': list() }
+
+def metricsReopen(metrics):
+    """
+    Carries on with the metrics of a run (e.g. from a checkpoint), tracing memory again if it was
+    """
+
+    if metrics['memory'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    return metrics
+
+def metricsPhase(metrics, phase, start):
+    """
+    now = metricsPhase(metrics, phase, start)
+
+    Adds the time since start to phase, and returns the time now, the start of the next phase
+    """
+
+    now = time.perf_counter()
+    phases = metrics['phases']
+    phases[phase] = phases.get(phase, 0.0) + now - start
+
+    return now
+
+def metricsTime(metrics, phase, seconds):
+    """
+    Adds seconds to phase, e.g. a time measured in another process
+    """
+
+    phases = metrics['phases']
+    phases[phase] = phases.get(phase, 0.0) + seconds
+
+def metricsCount(metrics, name, n):
+    """
+    Adds n to the count name of this generation
+    """
+
+    counts = metrics['counts']
+    counts[name] = counts.get(name, 0) + int(n)
+
+def metricsMax(metrics, name, n):
+    """
+    Sets the count name of this generation to n if that is more
+    """
+
+    counts = metrics['counts']
+    counts[name] = max( counts.get(name, 0), int(n) )
+
+def metricsArrivals(metrics, noJuveniles):
+    """
+    Counts the offspring, the flocks reached and the most juveniles at one flock, from the list of how many juveniles
+    arrived at each flock reached
+    """
+
+    noJuveniles = list(noJuveniles)
+
+    metricsCount( metrics, 'offspring', sum(noJuveniles) )
+    metricsCount( metrics, 'flocksReached', len(noJuveniles) )
+    metricsMax( metrics, 'maxJuveniles', max(noJuveniles, default=0) )
+
+def metricsGeneration(metrics, t):
+    """
+    Closes the generation t, storing its phase times, counts and memory, and starts the next
+    """
+
+    gen = { 't': t, 'phases': metrics['phases'], 'counts': metrics['counts'] }
+
+    if resource is not None:
+        gen['maxRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on Linux
+
+    if metrics['memory']:
+        gen['peakTraced'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+
+    metrics['generations'].append(gen)
+    metrics['phases'] = dict()
+    metrics['counts'] = dict()
+
+def metricsTotals(metrics):
+    """
+    totals = metricsTotals(metrics)
+
+    The phase times and counts summed over all the generations, and the largest memory
+
+    >>> metrics = {'generations': [ {'t': 1, 'phases': {'step': 1.0}, 'counts': {'offspring': 5}, 'maxRSS': 10},
+    ...     {'t': 2, 'phases': {'step': 2.0, 'record': 0.5}, 'counts': {'offspring': 7}, 'maxRSS': 20} ]}
+    >>> metricsTotals(metrics)
+    {'phases': {'step': 3.0, 'record': 0.5}, 'counts': {'offspring': 12}, 'maxRSS': 20}
+    """
+
+    totals = { 'phases': dict(), 'counts': dict() }
+
+    for gen in metrics['generations']:
+
+        for key in ['phases', 'counts']:
+            for name, value in gen[key].items():
+                totals[key][name] = max( totals[key].get(name, 0), value ) if name == 'maxJuveniles' else totals[key].get(name, 0) + value
+
+        for key in ['maxRSS', 'peakTraced']:
+            if key in gen:
+                totals[key] = max( totals.get(key, 0), gen[key] )
+
+    return totals
+
+def metricsClose(fName, metrics, header):
+    """
+    metricsClose(fName, metrics, header)
+
+    Writes the metrics of the run, with the run's metadata in header, to the JSON file fName, and stops tracing memory
+    """
+
+    if metrics['memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+    out = dict(header)
+    out['totals'] = metricsTotals(metrics)
+    out['generations'] = metrics['generations']
+
+    with open(fName, 'w') as f:
+        json.dump(out, f, default=repr) # repr for anything JSON does not know, e.g. a Landscape
+
+def metricsLoad(fName):
+    """
+    Returns the metrics written by metricsClose
+    """
+
+    with open(fName) as f:
+        return json.load(f)
+
+def metricsReport(metrics):
+    """
+    rows = metricsReport(metrics)
+
+    The total time of each phase of the run and its share of the total, the slowest first, so the bottleneck is at the top.
+    The phases within the timestep are shares of 'step', and the rest (and 'step') of all the time measured
+
+    >>> metrics = {'generations': [ {'t': 1, 'phases': {'step': 3.0, 'dispersal': 2.0, 'reproduction': 1.0, 'record': 1.0}, 'counts': {}} ]}
+    >>> metricsReport(metrics)
+    [('step', 3.0, 0.75), ('dispersal', 2.0, 0.6666666666666666), ('reproduction', 1.0, 0.3333333333333333), ('record', 1.0, 0.25)]
+    """
+
+    phases = metricsTotals(metrics)['phases']
+    outer = [ 'step', 'record', 'observe', 'stop', 'checkpoint' ]
+    outerTotal = sum( value for phase, value in phases.items() if phase in outer )
+    stepTotal = phases.get('step', 0)
+
+    rows = list()
+
+    for phase, value in phases.items():
+        total = outerTotal if phase in outer else stepTotal
+        rows.append( ( phase, value, value / total if total > 0 else 0.0 ) )
+
+    return sorted( rows, key=lambda row: - row[1] )
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
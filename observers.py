@@ -0,0 +1,268 @@
+import os
+import pickle
+import numpy as np
+
+from timestepVec import phenArray, noOffspringArray, habTypesList, landscape2codes
+from packedGenes import popcountGenes
+from recorder import columnsWriteMeta # the same atomic write of meta.pkl as a .cols directory
+
+# Summary statistics calculated during a run, so the full population need not be stored every generation.
+#
+# Each observer is named by a string. Per-territory observers give one value per territory per generation,
+# with nan where there is no mating pair (as in phenInSpace and gendiffInSpace):
+#
+#   'occupancy'     number of adults in the territory
+#   'noOffspring'   number of offspring of the mating pair (noOffspringFnc)
+#   'phen'          phenotype of one randomly chosen adult of the pair, for each gene type (phenInSpace)
+#   'gendiff'       number of alleles that differ between the pair, for each gene type (gendiffInSpace)
+#
+# and the others give a few values per generation:
+#
+#   'habMeans'      mean phenotype of adults living on each habitat type, for each gene type
+#   'LD'            linkage disequilibrium between the reproduction trait and the habitat-preference ('pref') or NHPI
+#                   ('phil') trait, as the correlation between their number of 1 alleles across adults
+#
+# They are written to a directory of .npy arrays with one row per recorded generation, allocated when the run starts
+# and filled in as it goes (as for the columnar format in recorder.py), named e.g. phen_repn.npy, habMeans_repn.npy, LD_pref.npy.
+# The habMeans columns are in the order of meta['habTypes'].
+
+allObservers = ['occupancy', 'noOffspring', 'phen', 'gendiff', 'habMeans', 'LD']
+
+
+def observe(parameters, popn, landscape, observers, rng):
+    """
+    obsVals = observe(parameters, popn, landscape, observers, rng)
+
+    Calculates the observers' values for one generation
+
+    popn:
+        dictionary of arrays, the population in the form of timestepVec.py
+    rng:
+        numpy random Generator, used to choose which adult of each pair is observed for 'phen'
+    obsVals:
+        dictionary, keys are array names (e.g. 'occupancy', 'phen_repn') and values are arrays
+
+    >>> parameters = {'sexes': ('h', 'h'), 'genetics': {'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False}},
+    ...     'habitats': {'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.1}} }
+    >>> popn = { 'present': np.array([[True, True], [True, False]]), 'natalHabType': np.zeros((2,2), dtype=np.uint8),
+    ...     'genotype': {'repn': np.array([[31, 31+32], [0, 0]])} }
+    >>> obsVals = observe(parameters, popn, 'LH', ['occupancy', 'noOffspring', 'gendiff', 'habMeans'], np.random.default_rng(1))
+    >>> obsVals['occupancy'], obsVals['noOffspring'], obsVals['gendiff_repn']
+    (array([2, 1], dtype=uint8), array([10., nan]), array([ 1., nan]))
+    >>> obsVals['habMeans_repn'] # in the order of habTypesList, i.e. H then L
+    array([-2. , -0.9])
+    """
+
+    geneTypes = list( parameters['genetics'].keys() )
+    present = popn['present']
+    isPair = present.all(axis=1)
+    noLocns = len(present)
+    landCodes = landscape2codes(parameters, landscape)
+
+    obsVals = dict()
+
+    if 'occupancy' in observers:
+
+        obsVals['occupancy'] = present.sum(axis=1).astype(np.uint8)
+
+    if 'noOffspring' in observers:
+
+        pairLocns, noOffspring = noOffspringArray(parameters, popn, landCodes)
+        obsVals['noOffspring'] = np.full( noLocns, np.nan )
+        obsVals['noOffspring'][pairLocns] = noOffspring
+
+    if 'phen' in observers:
+
+        slots = rng.integers( 0, present.shape[1], size=noLocns ) # a random adult of each pair
+
+        for geneType in geneTypes:
+            genes = popn['genotype'][geneType][ np.arange(noLocns), slots ]
+            obsVals['phen_' + geneType] = np.where( isPair, phenArray(parameters, genes, geneType), np.nan )
+
+    if 'gendiff' in observers:
+
+        for geneType in geneTypes:
+            genes = popn['genotype'][geneType]
+            obsVals['gendiff_' + geneType] = np.where( isPair, popcountGenes( genes[:,0] ^ genes[:,1] ), np.nan )
+
+    if 'habMeans' in observers or 'LD' in observers:
+
+        habCodes = np.broadcast_to( landCodes[:,None], present.shape )[present]
+        genes = { geneType: popn['genotype'][geneType][present] for geneType in geneTypes }
+
+    if 'habMeans' in observers:
+
+        noHabTypes = len( habTypesList(parameters) )
+        counts = np.bincount( habCodes, minlength=noHabTypes )
+
+        for geneType in geneTypes:
+            sums = np.bincount( habCodes, weights=phenArray(parameters, genes[geneType], geneType), minlength=noHabTypes )
+            obsVals['habMeans_' + geneType] = np.where( counts > 0, sums / np.maximum(counts, 1), np.nan )
+
+    if 'LD' in observers:
+
+        for geneType in [ geneType for geneType in ['pref', 'phil'] if geneType in geneTypes ]:
+
+            x = popcountGenes( genes['repn'] ).astype(float)
+            y = popcountGenes( genes[geneType] ).astype(float)
+
+            if len(x) > 1 and x.std() > 0 and y.std() > 0:
+                obsVals['LD_' + geneType] = np.array( np.corrcoef(x, y)[0,1] )
+            else:
+                obsVals['LD_' + geneType] = np.array( np.nan )
+
+    return obsVals
+
+def observersOpen(dirName, header, observers, noLocns):
+    """
+    obs = observersOpen(dirName, header, observers, noLocns)
+
+    Creates the observations directory dirName, writes the metadata and allocates the arrays for tf - burnInT generations
+
+    header:
+        dictionary, metadata of the run, must include 'parameters', 'burnInT' and 'tf'
+    obs:
+        dictionary, the observations recorder
+    """
+
+    parameters = header['parameters']
+    noGens = max( header['tf'] - header['burnInT'], 0 )
+    habTypes = habTypesList(parameters)
+    geneTypes = list( parameters['genetics'].keys() )
+
+    # the name and shape of each array
+
+    shapes = dict()
+
+    for observer in observers:
+
+        if observer in ['occupancy', 'noOffspring']:
+            shapes[observer] = ( noGens, noLocns )
+        elif observer in ['phen', 'gendiff']:
+            shapes.update( { observer + '_' + geneType: ( noGens, noLocns ) for geneType in geneTypes } )
+        elif observer == 'habMeans':
+            shapes.update( { observer + '_' + geneType: ( noGens, len(habTypes) ) for geneType in geneTypes } )
+        elif observer == 'LD':
+            shapes.update( { observer + '_' + geneType: ( noGens, ) for geneType in ['pref', 'phil'] if geneType in geneTypes } )
+        else:
+            raise ValueError('unknown observer ' + str(observer))
+
+    os.makedirs(dirName, exist_ok=True)
+
+    meta = dict(header)
+    meta['observers'] = list(observers)
+    meta['names'] = list(shapes.keys())
+    meta['habTypes'] = habTypes
+    columnsWriteMeta(dirName, meta)
+
+    openFnc = lambda name, dtype, shape: np.lib.format.open_memmap( os.path.join(dirName, name + '.npy'), mode='w+', dtype=dtype, shape=shape )
+
+    obs = {
+            'dirName': dirName,
+            'meta': meta,
+            'row': 0,
+            't': openFnc('t', np.int64, (noGens,)),
+            'arrays': { name: openFnc(name, np.uint8 if name == 'occupancy' else float, shape) for name, shape in shapes.items() },
+            }
+
+    return obs
+
+def observersReopen(dirName, row):
+    """
+    obs = observersReopen(dirName, row)
+
+    Reopens an observations directory to continue writing at row (e.g. from a checkpoint), discarding any rows after it
+    """
+
+    f = open( os.path.join(dirName, 'meta.pkl'), 'rb' )
+    meta = pickle.load(f)
+    f.close()
+
+    openFnc = lambda name: np.load( os.path.join(dirName, name + '.npy'), mmap_mode='r+' )
+
+    obs = { 'dirName': dirName, 'meta': meta, 'row': row, 't': openFnc('t'), 'arrays': { name: openFnc(name) for name in meta['names'] } }
+    obs['t'][row:] = 0
+
+    return obs
+
+def observersWrite(obs, t, parameters, popn, landscape, rng):
+    """
+    observersWrite(obs, t, parameters, popn, landscape, rng)
+
+    Calculates the observers' values for the population popn at timestep t and writes them into the next row
+    """
+
+    obsVals = observe( parameters, popn, landscape, obs['meta']['observers'], rng )
+    row = obs['row']
+
+    for name, array in obs['arrays'].items():
+        array[row] = obsVals[name]
+
+    obs['t'][row] = t # written last, so a row is only counted once it is complete
+    obs['row'] = row + 1
+
+def observersPosn(obs):
+    """
+    Flushes the observations and returns the row at which the next generation will be written
+    """
+
+    obs['t'].flush()
+
+    for array in obs['arrays'].values():
+        array.flush()
+
+    return obs['row']
+
+def observersClose(obs, t, stop=None):
+    """
+    observersClose(obs, t, stop=None)
+
+    Flushes the observations and stores t (the timestep after the last one run) and stop in the metadata
+    """
+
+    observersPosn(obs)
+
+    obs['meta']['t'] = t
+    obs['meta']['stop'] = stop
+    columnsWriteMeta(obs['dirName'], obs['meta'])
+
+def loadObservations(dirName, mmap=True):
+    """
+    results = loadObservations(dirName, mmap=True)
+
+    Loads an observations directory, returning the metadata with 'ts' (the timestep of each row) and each observed array,
+    memory-mapped if mmap, up to the last written row
+
+    >>> import tempfile
+    >>> dirName = os.path.join( tempfile.mkdtemp(), 'test.obs' )
+    >>> parameters = {'sexes': ('h', 'h'), 'genetics': {'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False}}, 'habitats': {'L': {}, 'H': {}} }
+    >>> obs = observersOpen( dirName, {'parameters': parameters, 'burnInT': 0, 'tf': 5}, ['occupancy', 'gendiff'], 2 )
+    >>> popn = { 'present': np.ones((2,2), dtype=bool), 'natalHabType': np.zeros((2,2), dtype=np.uint8), 'genotype': {'repn': np.array([[0, 3], [1, 1]])} }
+    >>> observersWrite(obs, 1, parameters, popn, 'LH', None)
+    >>> observersClose(obs, 2)
+    >>> results = loadObservations(dirName)
+    >>> results['ts'], results['gendiff_repn']
+    (array([1]), memmap([[2., 0.]]))
+    """
+
+    f = open( os.path.join(dirName, 'meta.pkl'), 'rb' )
+    results = pickle.load(f)
+    f.close()
+
+    mmapMode = 'r' if mmap else None
+    loadFnc = lambda name: np.load( os.path.join(dirName, name + '.npy'), mmap_mode=mmapMode )
+
+    t = loadFnc('t')
+    noGens = int( np.argmin( np.r_[t, 0] > 0 ) ) # the written rows
+
+    results['ts'] = np.asarray( t[:noGens] )
+
+    for name in results['names']:
+        results[name] = loadFnc(name)[:noGens]
+
+    return results
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,257 @@
+import numpy as np
+
+from metrics import metricsCount
+
+# Genes with more loci than fit in an int64 (noLoci > maxIntLoci) are held by the array engines as packed words:
+# a uint64 array with an extra last axis of noWords(noLoci) words, where locus i is bit i % 64 of word i // 64, the same
+# bit order as the Python integers of the 'dicts' engine. So popn['genotype'][geneType] is an int64 array (noLocns, noSlots)
+# for up to maxIntLoci loci, and a uint64 array (noLocns, noSlots, noWords) for more, and the functions below work on either.
+#
+# Recombination is free (each locus from either parent) unless the gene type has a linkage map, e.g.
+#
+#   'repn': {'noLoci': 500, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0.0001, 'linkageMap': 0.01}
+#
+# where 'linkageMap' is the probability of a crossover between each pair of adjacent loci, or a list of the noLoci-1
+# probabilities between loci i and i+1.
+
+maxIntLoci = 62 # so that 1 << noLoci fits in an int64
+
+
+def noWords(noLoci):
+    """
+    Returns the number of 64-bit words needed for noLoci loci
+    """
+
+    return -( -noLoci // 64 )
+
+def isPacked(parameters, geneType):
+    """
+    Returns True if the genes of geneType are held as packed words
+    """
+
+    return parameters['genetics'][geneType]['noLoci'] > maxIntLoci
+
+def genesSpec(parameters, geneType):
+    """
+    dtype, wordsShape = genesSpec(parameters, geneType)
+
+    The dtype of the arrays holding genes of geneType, and the shape of each gene, () for int64 or (noWords,) for packed
+
+    >>> genesSpec( {'genetics': {'repn': {'noLoci': 20}}}, 'repn' ), genesSpec( {'genetics': {'repn': {'noLoci': 200}}}, 'repn' )
+    ((<class 'numpy.int64'>, ()), (<class 'numpy.uint64'>, (4,)))
+    """
+
+    if isPacked(parameters, geneType):
+        return np.uint64, ( noWords( parameters['genetics'][geneType]['noLoci'] ), )
+
+    return np.int64, ()
+
+def genesZeros(parameters, geneType, shape):
+    """
+    Returns an array of genes of geneType with all alleles 0, for an array of individuals of the given shape
+    """
+
+    dtype, wordsShape = genesSpec(parameters, geneType)
+
+    return np.zeros( tuple(shape) + wordsShape, dtype=dtype )
+
+def packGenes(genes, noLoci):
+    """
+    words = packGenes(genes, noLoci)
+
+    Packs a list of genes as Python integers into a uint64 array (len(genes), noWords(noLoci))
+
+    >>> words = packGenes( [1, 2**64 + 3], 100 )
+    >>> words.tolist(), unpackGenes(words)
+    ([[1, 0], [3, 1]], [1, 18446744073709551619])
+    """
+
+    nWords = noWords(noLoci)
+    buf = b''.join( gene.to_bytes(8*nWords, 'little') for gene in genes )
+
+    return np.frombuffer(buf, dtype='<u8').astype(np.uint64).reshape( len(genes), nWords )
+
+def unpackGenes(words):
+    """
+    genes = unpackGenes(words)
+
+    Unpacks an array of packed genes (..., noWords) into nested lists of Python integers, like tolist() of an int64 array
+    """
+
+    rows = words.reshape( -1, words.shape[-1] ).astype('<u8')
+    genes = np.empty( len(rows), dtype=object )
+    genes[:] = [ int.from_bytes( row.tobytes(), 'little' ) for row in rows ]
+
+    return genes.reshape( words.shape[:-1] ).tolist()
+
+def popcountGenes(genes):
+    """
+    noOnes = popcountGenes(genes)
+
+    The number of 1 alleles of each gene, of int64 genes or packed words
+
+    >>> popcountGenes( np.array([0, 31]) ).tolist(), popcountGenes( packGenes( [0, 2**100-1], 100 ) ).tolist()
+    ([0, 5], [0, 100])
+    """
+
+    if genes.dtype == np.uint64:
+        return np.bitwise_count(genes).sum(axis=-1, dtype=np.int64)
+
+    return np.bitwise_count(genes)
+
+def genesWhere(mask, genes):
+    """
+    Returns genes where mask is True and 0 where it is False, of int64 genes or packed words
+    """
+
+    if genes.dtype == np.uint64:
+        mask = mask[..., None]
+
+    return np.where( mask, genes, genes.dtype.type(0) )
+
+def prefixParity(toggles):
+    """
+    parity = prefixParity(toggles)
+
+    Bit i of parity is the parity of bits 0..i of toggles, along the last axis of words. With a toggle at each locus
+    where a crossover switches parent, this is a recombination mask.
+
+    >>> prefixParity( np.array([[0b1001, 0]], dtype=np.uint64) ).tolist() == [[0b111, 0]]
+    True
+    >>> prefixParity( np.array([[1, 0]], dtype=np.uint64) ).tolist() == [[2**64-1, 2**64-1]] # carried into later words
+    True
+    """
+
+    parity = toggles.copy()
+
+    for shift in [1, 2, 4, 8, 16, 32]: # prefix XOR within each word
+        parity ^= parity << np.uint64(shift)
+
+    # the parity of all the bits of earlier words flips every bit of a word
+
+    carry = np.bitwise_xor.accumulate( parity >> np.uint64(63), axis=-1 )
+    carryIn = np.zeros_like(carry)
+    carryIn[..., 1:] = carry[..., :-1]
+
+    return np.where( carryIn == 1, ~parity, parity )
+
+def wordsMask(noLoci):
+    """
+    Returns the packed words with a 1 at each of noLoci loci
+    """
+
+    return packGenes( [ (1 << noLoci) - 1 ], noLoci )[0]
+
+def linkageRates(parameters, geneType):
+    """
+    Returns the array of the probabilities of a crossover between loci i and i+1 of geneType, or None for free recombination
+    """
+
+    geneParams = parameters['genetics'][geneType]
+
+    if geneParams.get('linkageMap') is None:
+        return None
+
+    return np.broadcast_to( np.asarray( geneParams['linkageMap'], dtype=float ), (geneParams['noLoci']-1,) )
+
+def recombinationMasks(noLoci, rates, size, rng):
+    """
+    masks = recombinationMasks(noLoci, rates, size, rng)
+
+    The packed recombination masks of size offspring, with a 1 at each locus that comes from mum and 0 from dad.
+    If rates is None, every locus comes from either parent independently (free recombination). Otherwise the first locus
+    comes from either parent, and the parent switches between loci i and i+1 with probability rates[i] (a crossover):
+    candidate crossovers are drawn at the largest rate across all offspring at once, then kept with probability
+    rates[i]/largest rate, and the mask is the prefix parity of the crossovers.
+
+    >>> rng = np.random.default_rng(1)
+    >>> masks = recombinationMasks(100, np.zeros(99), 1000, rng) # no crossovers, so all loci come from one parent
+    >>> sorted( set( popcountGenes(masks).tolist() ) )
+    [0, 100]
+    """
+
+    nWords = noWords(noLoci)
+    allLoci = wordsMask(noLoci)
+
+    if rates is None:
+        return rng.integers( 0, np.iinfo(np.uint64).max, size=(size, nWords), dtype=np.uint64, endpoint=True ) & allLoci
+
+    toggles = np.zeros( (size, nWords), dtype=np.uint64 )
+    toggles[:, 0] = rng.integers( 0, 2, size=size, dtype=np.uint64 ) # whether the first locus comes from mum
+
+    rMax = rates.max() if len(rates) > 0 else 0
+    noCands = rng.binomial( size*(noLoci-1), min(rMax, 1) ) if rMax > 0 else 0
+
+    if noCands > 0:
+
+        posns = rng.choice( size*(noLoci-1), size=noCands, replace=False )
+        offIdxs, gaps = np.divmod( posns, noLoci-1 )
+        keep = rng.random(noCands) * rMax < rates[gaps]
+        loci = gaps[keep] + 1 # the first locus after each crossover
+
+        np.bitwise_xor.at( toggles, (offIdxs[keep], loci // 64), np.left_shift( np.uint64(1), (loci % 64).astype(np.uint64) ) )
+
+    return prefixParity(toggles) & allLoci
+
+def mutateGenes(genes, noLoci, pMut, rng, metrics=None):
+    """
+    Flips each allele of the int64 genes or packed words of a batch of offspring with probability pMut, in place,
+    drawing how many of all the offspring's loci mutate, then which ones. The mutations are counted in metrics (see metrics.py)
+    """
+
+    size = len(genes)
+    noMutns = rng.binomial(size*noLoci, pMut)
+
+    if metrics is not None:
+        metricsCount(metrics, 'mutations', noMutns)
+
+    if noMutns > 0:
+
+        posns = rng.choice(size*noLoci, size=noMutns, replace=False)
+
+        if genes.dtype == np.uint64:
+            offIdxs, loci = np.divmod( posns, noLoci )
+            np.bitwise_xor.at( genes, (offIdxs, loci // 64), np.left_shift( np.uint64(1), (loci % 64).astype(np.uint64) ) )
+        else:
+            np.bitwise_xor.at( genes, posns // noLoci, np.left_shift(1, posns % noLoci) )
+
+    return genes
+
+def offspringWords(parameters, mumWords, dadWords, geneType, rng, size=None, metrics=None):
+    """
+    offWords = offspringWords(parameters, mumWords, dadWords, geneType, rng, size=None, metrics=None)
+
+    Packed version of carryover.offspringGenesArray: the genes of a batch of offspring, with recombination (free, or by
+    the linkage map) and mutation
+
+    mumWords, dadWords:
+        uint64 arrays (size, noWords), or (noWords,) for the same parent of every offspring
+    size:
+        integer, the number of offspring, only needed if mumWords and dadWords are both a single gene
+
+    >>> parameters = {'genetics': {'repn': {'noLoci': 100, 'pMut': 0, 'linkageMap': 0.5} } }
+    >>> rng = np.random.default_rng(1)
+    >>> offWords = offspringWords(parameters, packGenes([0], 100)[0], packGenes([2**100-1], 100)[0], 'repn', rng, 1000)
+    >>> bool( abs( popcountGenes(offWords).mean() - 50 ) < 1 ) # half the alleles come from each parent
+    True
+    """
+
+    geneParams = parameters['genetics'][geneType]
+    noLoci = geneParams['noLoci']
+
+    if size is None:
+        size = np.broadcast_shapes( np.shape(mumWords), np.shape(dadWords) )[0]
+
+    # recombination, each locus comes from mum where the mask has a 1 and from dad where it has a 0
+
+    mask = recombinationMasks( noLoci, linkageRates(parameters, geneType), size, rng )
+    offWords = (mumWords & mask) | (dadWords & ~mask & wordsMask(noLoci))
+
+    # mutation
+
+    return mutateGenes( offWords, noLoci, geneParams['pMut'], rng, metrics )
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
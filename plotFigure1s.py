@@ -1,35 +1,27 @@
 # run with e.g.: python3 plotFigure1s.py -f ecosystems_1
-
-import pickle
+# the results can be a pickle file (the default, or ending in .pkl), a stream file (.stream), a columnar directory (.cols),
+# or an observations directory (.obs) with the observers 'noOffspring' and 'phen'
+#
+# for long runs, add e.g. -e 10 to plot every 10th generation, -m 2000 to plot at most 2000 generations,
+# and -r to draw the maps as images rather than meshes
+#
+# runs on a 2-D grid (see landscape.py) are plotted as maps of the grid at a few generations, add e.g. -n 5 for 5 of them
+#
+# to plot every run in a directory, in parallel: python3 plotFigure1s.py -d <directory> -p <no. processes>
+
+import os
 import numpy as np
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 #import sys
 #sys.path.append("../../current_code/")
-from carryover import phenInSpace
-from carryover import noOffspringFnc
 from carryover import pcolormeshCorrectionXY
+from carryover import parameterModel
+from timestepVec import phenArray, noOffspringArray, landscape2codes # array versions of gene2phen and noOffspringFnc
+from recorder import loadResults
+from observers import loadObservations
 import sys, getopt
 
-try:
-
-    opts, args = getopt.getopt(sys.argv[1:],'hf:')
-
-except getopt.GetoptError:
-
-    print('plotFigure1s.py -f <pkl file name>')
-    sys.exit(2)
-
-for opt, arg in opts:
-
-    if opt == '-h':
-
-        print('plotFigure1s.py -f <pkl file name>')
-        sys.exit()
-
-    elif opt == '-f':
-
-        fName = arg
-
 
 # some parameters for plotting
 
@@ -63,149 +55,413 @@ cbar_labels = { # colourbar labels
         'dist': 'no. territories',
         'neut': 'trait value'}
 
-if 'nodiff' in fName:
-    cbar_labels['repn'] = r'$\longleftarrow$ majority adapted $\: \vert \:$ minority adapted $\longrightarrow$'
+# results formats, the fastest to plot first
+resultsExts = ['.obs', '.cols', '.stream', '.pkl']
 
-# get data of run
 
-f = open(fName + '.pkl', 'rb')
-ss = pickle.load( f )
-burnInT = pickle.load( f )
-t = pickle.load( f )
-tf = pickle.load( f )
-landscape = pickle.load( f )
-ecosystems = pickle.load( f )
-path = pickle.load( f )
-parameters = pickle.load( f )
-f.close()
+def figure1Data(fName, every=1, maxGens=None, seed=None):
+    '''
+    data = figure1Data(fName, every=1, maxGens=None, seed=None)
 
+    Calculates the generation x territory arrays plotted in Figure 1s, for all generations at once
 
-# calculate and store info needed for plotting
+    fName:
+        string, the results of a run, in any of the formats in resultsExts
+    every:
+        integer, only use every every'th recorded generation
+    maxGens:
+        integer, if given, every is increased so that at most maxGens generations are used
+    seed:
+        seed of the random choice of which adult of each pair is plotted (as phenInSpace), if not read from observations
+    data:
+        dictionary, with the run's 'burnInT', 'tf', 'landscape' and 'parameters', 'ts' (the timestep of each row),
+        'noOffspring' (nan if there is no mating pair), and 'phen' ({geneType: phenotype of one adult of the pair, nan if none})
+    '''
 
-# list of our genetypes in order
-geneTypes = [ geneType for geneType in geneTypeOrder if geneType in parameters['genetics'] ]
+    if fName.endswith('.obs'):
 
-# prepare storage
-phenDictTs = { geneType: list() for geneType in geneTypes } # phenotype values
-noOffspringTs = list() # no offspring
+        results = loadObservations(fName)
+        names = ['noOffspring'] + [ 'phen_' + geneType for geneType in results['parameters']['genetics'] ]
 
-for ecosystem in ecosystems: # NOTE may want to modify for burn in
+        if any( name not in results['names'] for name in names ):
+            raise ValueError(fName + ' needs the observers \'noOffspring\' and \'phen\'')
 
-    noOffspring = [ np.nan if len(flock['adults']) != 2 else noOffspringFnc( parameters, flock['adults'], habType) for flock, habType in zip(ecosystem,landscape) ] # number of offspring in space
+    else:
 
-    phenDict = phenInSpace(parameters, ecosystem) # phenotypes in space
+        results = loadResults(fName)
 
-    # store info about timestep
-    noOffspringTs.append( noOffspring )
+    parameters = results['parameters']
+    landscape = results['landscape']
+    noGens = len( results['ts'] )
 
-    for geneType in geneTypes:
-        phenDictTs[geneType].append( phenDict[geneType] )
+    if maxGens is not None:
+        every = max( every, -( -noGens // maxGens ) )
+
+    rows = slice(0, noGens, every) # only these rows are read from memory-mapped arrays
+
+    data = { 'burnInT': results['burnInT'], 'tf': results['tf'], 'landscape': landscape, 'parameters': parameters, 'ts': results['ts'][rows] }
 
-# ---
+    if fName.endswith('.obs'): # already calculated during the run
 
-# need a correction of the axes for pcolormesh
-lV, tV = pcolormeshCorrectionXY( list(range(len(landscape))), np.arange(burnInT+1,t) )
+        data['noOffspring'] = np.asarray( results['noOffspring'][rows] )
+        data['phen'] = { geneType: np.asarray( results['phen_' + geneType][rows] ) for geneType in parameters['genetics'] }
 
-# plot phenotype values and proportion difference between parents' genes in space and time
+        return data
 
-nrows = 1
-ncols = len(geneTypes) + 2 # plus 2 is for occupancy and number of offspring
-f, ax = plt.subplots(nrows, ncols, sharex=True, sharey=True, figsize=(4*ncols,4*nrows))
+    # flatten the generations into one long population, so each quantity is calculated in one pass
 
+    model = parameterModel(parameters, landscape) # lookup tables for phenotypes and number of offspring
 
-# first column, occupancy
+    present = np.asarray( results['present'][rows] )
+    noRows, noLocns, noSlots = present.shape
 
-col = 0; aax = ax[col]
+    popn = { 'present': present.reshape(-1, noSlots),
+            'genotype': { geneType: np.asarray( genes[rows] ).reshape( (-1, noSlots) + genes.shape[3:] ) for geneType, genes in results['genotype'].items() } }
+    landCodes = np.tile( landscape2codes(model, landscape), noRows )
 
-# sort out colourmap
-base = plt.cm.get_cmap( diffCmaps['neut'] )
-color_list = [ base( i ) for i in np.linspace(0, 1, 2+1) ]
-cmap_name = base.name + 'occ'
-newCmap = base.from_list(cmap_name, color_list, 2)
+    # number of offspring of each mating pair
 
-# plot occupancy
-m = np.zeros( np.shape(noOffspringTs) )
-m[ np.isnan(noOffspringTs) ] = 1
-pp0 = aax.pcolormesh(lV, tV, m, cmap=newCmap, vmin=-1/2, vmax=1.5)
-aax.set_xlim( (lV[0],lV[-1]) )
-aax.set_ylim( (tV[0], tf+0.5) )
-aax.set_ylabel('generation')
-aax.set_title( 'territory occupancy' )
-cbar = plt.colorbar(pp0, ax=aax, ticks=[0,1])
-cbar.ax.set_yticklabels(['occupied','unoccupied'], rotation=90)
-aax.set_xlabel('location')
+    pairLocns, noOffspring = noOffspringArray(model, popn, landCodes)
+    data['noOffspring'] = np.full( noRows*noLocns, np.nan )
+    data['noOffspring'][pairLocns] = noOffspring
+    data['noOffspring'] = data['noOffspring'].reshape(noRows, noLocns)
 
+    # phenotypes of one randomly chosen adult of each mating pair
 
-# second column, number of offspring
+    rng = np.random.default_rng(seed)
+    slots = rng.integers( 0, noSlots, size=noRows*noLocns )
+    isPair = popn['present'].all(axis=1)
 
-col = 1; aax = ax[col]
-maxVal = max( (parameters['habitats']['L']['rMax'],parameters['habitats']['H']['rMax']) )
+    data['phen'] = dict()
+    for geneType, genes in popn['genotype'].items():
+        phens = phenArray( model, genes[ np.arange(noRows*noLocns), slots ], geneType )
+        data['phen'][geneType] = np.where( isPair, phens, np.nan ).reshape(noRows, noLocns)
 
-# sort out colourmap
-base = plt.cm.get_cmap( diffCmaps['neut'] )
-color_list = [ base( i ) for i in np.linspace(0, 1, maxVal+1) ]
-cmap_name = base.name + str(maxVal+1)
-newCmap = base.from_list(cmap_name, color_list, maxVal+1)
+    return data
 
-m = np.array( noOffspringTs )
-m = np.ma.masked_invalid(m)
-pp0 = aax.pcolormesh(lV, tV, m, cmap=newCmap, vmin=-1/2, vmax=maxVal+1/2)
-aax.set_xlim( (lV[0],lV[-1]) )
-aax.set_ylim( (tV[0], tf+0.5) )
-aax.set_title( 'reproduction' )
-cbar = plt.colorbar(pp0, ax=aax, ticks=range(maxVal+1))
-cbar.ax.set_ylabel('no. offspring')
-aax.set_xlabel('location')
+def plotFigure1s(fName, every=1, maxGens=None, raster=False, noMaps=3):
+    '''
+    plotFigure1s(fName, every=1, maxGens=None, raster=False, noMaps=3)
 
+    Plots the occupancy, number of offspring and phenotypes of a run in space and time, saved as e.g. ecosystems_1_Fig1s.png
 
-for col, geneType in enumerate(geneTypes):
+    fName:
+        string, the results of a run, if it has none of the extensions in resultsExts then .pkl is added
+    every, maxGens:
+        see figure1Data
+    raster:
+        boolean, if True draw the maps as images (imshow), which is much faster than meshes for runs with very many generations
+    noMaps:
+        integer, for a 2-D grid landscape, the number of generations (evenly spaced, including the first and last) whose
+        maps of the grid are plotted, one row each
+    '''
 
-    aax = ax[col+2]
+    if not any( fName.endswith(ext) for ext in resultsExts ):
+        fName += '.pkl'
 
+    figName = os.path.splitext(fName)[0] + '_Fig1s.png'
 
-    # info about this gene type
+    labels = dict(cbar_labels)
+    if 'nodiff' in fName:
+        labels['repn'] = r'$\longleftarrow$ majority adapted $\: \vert \:$ minority adapted $\longrightarrow$'
 
-    # the phenotype values I want to plot on the z range
-    if geneType == 'repn': # range on reproduction to -1 to 1 so clearer
+    # get data of run
 
-        phens = [-1, -0.8, -0.6, -0.4, -0.2, 0, .2, .4, .6, .8, 1]
+    data = figure1Data(fName, every, maxGens)
+    parameters = data['parameters']
+    landscape = data['landscape']
+    tf = data['tf']
+    ts = data['ts']
 
-    else: # otherwise, full range
+    # list of our genetypes in order
+    geneTypes = [ geneType for geneType in geneTypeOrder if geneType in parameters['genetics'] ]
+
+    if getattr(landscape, 'shape', None) is not None: # a 2-D grid, so plot maps of the grid at a few generations instead
+
+        plotFigure1s2D(data, geneTypes, labels, figName, noMaps)
+        return
+
+    # ---
+
+    # need a correction of the axes for pcolormesh
+    lV, tV = pcolormeshCorrectionXY( list(range(len(landscape))), ts )
+    tMax = tf + ( tV[1] - tV[0] )/2
+
+    # draw a map of m over space and time
+    if raster:
+        mapFnc = lambda aax, m, **kwargs: aax.imshow(m, extent=(lV[0], lV[-1], tV[0], tV[-1]), origin='lower', aspect='auto', interpolation='nearest', **kwargs)
+    else:
+        mapFnc = lambda aax, m, **kwargs: aax.pcolormesh(lV, tV, m, **kwargs)
+
+    # plot phenotype values and proportion difference between parents' genes in space and time
+
+    nrows = 1
+    ncols = len(geneTypes) + 2 # plus 2 is for occupancy and number of offspring
+    f, ax = plt.subplots(nrows, ncols, sharex=True, sharey=True, figsize=(4*ncols,4*nrows))
+
+
+    # first column, occupancy
+
+    col = 0; aax = ax[col]
+
+    # sort out colourmap
+    base = plt.get_cmap( diffCmaps['neut'] )
+    color_list = [ base( i ) for i in np.linspace(0, 1, 2+1) ]
+    cmap_name = base.name + 'occ'
+    newCmap = base.from_list(cmap_name, color_list, 2)
+
+    # plot occupancy
+    m = np.isnan( data['noOffspring'] ).astype(int)
+    pp0 = mapFnc(aax, m, cmap=newCmap, vmin=-1/2, vmax=1.5)
+    aax.set_xlim( (lV[0],lV[-1]) )
+    aax.set_ylim( (tV[0], tMax) )
+    aax.set_ylabel('generation')
+    aax.set_title( 'territory occupancy' )
+    cbar = plt.colorbar(pp0, ax=aax, ticks=[0,1])
+    cbar.ax.set_yticklabels(['occupied','unoccupied'], rotation=90)
+    aax.set_xlabel('location')
 
-        noLoci = parameters['genetics'][geneType]['noLoci']
-        minPhen = parameters['genetics'][geneType]['minPhen']
-        maxPhen = parameters['genetics'][geneType]['maxPhen']
-        phens = np.linspace(minPhen, maxPhen, noLoci+1) # possible phenotype values
 
+    # second column, number of offspring
 
-    # use info about this gene type to sort out colour map and decorations
+    col = 1; aax = ax[col]
+    maxVal = max( (parameters['habitats']['L']['rMax'],parameters['habitats']['H']['rMax']) )
 
-    # colourmap
-    base = plt.cm.get_cmap( phenCmaps[geneType] )
-    color_list = [ base( i ) for i in np.linspace(0, 1, len(phens)) ]
-    cmap_name = base.name + 'new'
-    newCmap = base.from_list(cmap_name, color_list, len(phens))
+    # sort out colourmap
+    base = plt.get_cmap( diffCmaps['neut'] )
+    color_list = [ base( i ) for i in np.linspace(0, 1, maxVal+1) ]
+    cmap_name = base.name + str(maxVal+1)
+    newCmap = base.from_list(cmap_name, color_list, maxVal+1)
 
-    # decorations
-    tickPhens = [ phen for i,phen in enumerate(phens) if i%2 == 0 ] # tick every second
-    delPhens = phens[1] - phens[0]
+    m = np.ma.masked_invalid( data['noOffspring'] )
+    pp0 = mapFnc(aax, m, cmap=newCmap, vmin=-1/2, vmax=maxVal+1/2)
     aax.set_xlim( (lV[0],lV[-1]) )
-    aax.set_ylim( (tV[0], tf+0.5) )
-    aax.set_title( titles[geneType] )
+    aax.set_ylim( (tV[0], tMax) )
+    aax.set_title( 'reproduction' )
+    cbar = plt.colorbar(pp0, ax=aax, ticks=range(maxVal+1))
+    cbar.ax.set_ylabel('no. offspring')
     aax.set_xlabel('location')
 
-    # sort out the data and draw the map
 
-    m = np.array( phenDictTs[geneType] )
-    m = np.ma.masked_invalid(m)
-    pp0 = aax.pcolormesh(lV, tV, m, cmap=newCmap, vmin=phens[0]-delPhens/2, vmax=phens[-1]+delPhens/2)
-    # colourbar
-    cbar = plt.colorbar(pp0, ax=aax, ticks=tickPhens)
-    cbar.ax.set_ylabel(cbar_labels[geneType])
+    for col, geneType in enumerate(geneTypes):
+
+        aax = ax[col+2]
+
+
+        # info about this gene type
+
+        # the phenotype values I want to plot on the z range
+        if geneType == 'repn': # range on reproduction to -1 to 1 so clearer
+
+            phens = [-1, -0.8, -0.6, -0.4, -0.2, 0, .2, .4, .6, .8, 1]
+
+        else: # otherwise, full range
+
+            noLoci = parameters['genetics'][geneType]['noLoci']
+            minPhen = parameters['genetics'][geneType]['minPhen']
+            maxPhen = parameters['genetics'][geneType]['maxPhen']
+            phens = np.linspace(minPhen, maxPhen, noLoci+1) # possible phenotype values
+
+
+        # use info about this gene type to sort out colour map and decorations
+
+        # colourmap
+        base = plt.get_cmap( phenCmaps[geneType] )
+        color_list = [ base( i ) for i in np.linspace(0, 1, len(phens)) ]
+        cmap_name = base.name + 'new'
+        newCmap = base.from_list(cmap_name, color_list, len(phens))
+
+        # decorations
+        tickPhens = [ phen for i,phen in enumerate(phens) if i%2 == 0 ] # tick every second
+        delPhens = phens[1] - phens[0]
+        aax.set_xlim( (lV[0],lV[-1]) )
+        aax.set_ylim( (tV[0], tMax) )
+        aax.set_title( titles[geneType] )
+        aax.set_xlabel('location')
+
+        # sort out the data and draw the map
+
+        m = np.ma.masked_invalid( data['phen'][geneType] )
+        pp0 = mapFnc(aax, m, cmap=newCmap, vmin=phens[0]-delPhens/2, vmax=phens[-1]+delPhens/2)
+        # colourbar
+        cbar = plt.colorbar(pp0, ax=aax, ticks=tickPhens)
+        cbar.ax.set_ylabel(labels[geneType])
+
+
+    plt.tight_layout()
+    plt.savefig(figName)
+    plt.close()
+    #plt.show()
+
+def discreteCmap(cmapName, noColours, suffix):
+    '''
+    Returns the colourmap cmapName cut into noColours colours
+    '''
+
+    base = plt.get_cmap(cmapName)
+    color_list = [ base( i ) for i in np.linspace(0, 1, noColours) ]
+
+    return base.from_list(base.name + suffix, color_list, noColours)
+
+def plotFigure1s2D(data, geneTypes, labels, figName, noMaps=3):
+    '''
+    plotFigure1s2D(data, geneTypes, labels, figName, noMaps=3)
+
+    The Figure 1s of a run on a 2-D grid: for each of noMaps generations, maps of the grid of territory occupancy,
+    number of offspring and phenotypes, with the same colours as plotFigure1s
+    '''
+
+    parameters = data['parameters']
+    noRows, noCols = data['landscape'].shape
+    ts = data['ts']
+    idxs = np.unique( np.linspace( 0, len(ts)-1, noMaps ).round().astype(int) ) # evenly spaced generations
+
+    # the colourmap, colour range, colourbar ticks and labels, and the maps of each column
+
+    maxVal = max( (parameters['habitats']['L']['rMax'],parameters['habitats']['H']['rMax']) )
+    columns = [
+            ( 'territory occupancy', discreteCmap( diffCmaps['neut'], 2, 'occ' ), (-1/2, 1.5), [0,1], None,
+                np.isnan( data['noOffspring'] ).astype(int) ),
+            ( 'reproduction', discreteCmap( diffCmaps['neut'], maxVal+1, str(maxVal+1) ), (-1/2, maxVal+1/2), range(maxVal+1), 'no. offspring',
+                np.ma.masked_invalid( data['noOffspring'] ) ),
+            ]
+
+    for geneType in geneTypes:
+
+        if geneType == 'repn': # range on reproduction to -1 to 1 so clearer
+            phens = [-1, -0.8, -0.6, -0.4, -0.2, 0, .2, .4, .6, .8, 1]
+        else: # otherwise, full range
+            geneParams = parameters['genetics'][geneType]
+            phens = np.linspace(geneParams['minPhen'], geneParams['maxPhen'], geneParams['noLoci']+1) # possible phenotype values
+
+        delPhens = phens[1] - phens[0]
+        columns.append( ( titles[geneType], discreteCmap( phenCmaps[geneType], len(phens), 'new' ), (phens[0]-delPhens/2, phens[-1]+delPhens/2),
+                [ phen for i,phen in enumerate(phens) if i%2 == 0 ], labels[geneType], np.ma.masked_invalid( data['phen'][geneType] ) ) )
+
+    # one row of maps per generation
+
+    nrows = len(idxs)
+    ncols = len(columns)
+    f, ax = plt.subplots(nrows, ncols, sharex=True, sharey=True, figsize=(4*ncols,4*nrows), squeeze=False)
+
+    for row, idx in enumerate(idxs):
+
+        for col, (title, cmap, (vmin, vmax), ticks, cbarLabel, m) in enumerate(columns):
+
+            aax = ax[row, col]
+            pp0 = aax.imshow( m[idx].reshape(noRows, noCols), cmap=cmap, vmin=vmin, vmax=vmax, origin='lower', interpolation='nearest' )
+            cbar = plt.colorbar(pp0, ax=aax, ticks=ticks)
+
+            if row == 0:
+                aax.set_title(title)
+
+            if col == 0:
+                cbar.ax.set_yticklabels(['occupied','unoccupied'], rotation=90)
+                aax.set_ylabel( 'generation ' + str( ts[idx] ) + '\nrow' )
+            else:
+                cbar.ax.set_ylabel(cbarLabel)
+
+            if row == nrows-1:
+                aax.set_xlabel('column')
+
+    plt.tight_layout()
+    plt.savefig(figName)
+    plt.close()
+
+def runsInDirectory(dirName):
+    '''
+    fNames = runsInDirectory(dirName)
+
+    Lists the results of each run in dirName, in the fastest format to plot if a run was recorded in more than one
+    '''
+
+    fNames = dict()
+
+    for name in sorted( os.listdir(dirName) ):
+
+        stem, ext = os.path.splitext(name)
+
+        if ext in resultsExts and ( stem not in fNames or resultsExts.index(ext) < resultsExts.index( os.path.splitext(fNames[stem])[1] ) ):
+            fNames[stem] = os.path.join(dirName, name)
+
+    return list( fNames.values() )
+
+def _plotFigure1sWorker(args):
+
+    plt.switch_backend('Agg') # no display in worker processes
+    plotFigure1s(*args)
+
+    return args[0]
+
+def plotDirectory(dirName, noProcs=None, every=1, maxGens=None, raster=False, noMaps=3):
+    '''
+    plotDirectory(dirName, noProcs=None, every=1, maxGens=None, raster=False, noMaps=3)
+
+    Plots Figure 1s for every run in dirName, over a pool of noProcs processes (if None, the number of CPUs)
+    '''
+
+    fNames = runsInDirectory(dirName)
+
+    with ProcessPoolExecutor(max_workers=noProcs) as pool:
+
+        for fName in pool.map( _plotFigure1sWorker, [ (fName, every, maxGens, raster, noMaps) for fName in fNames ] ):
+            print(fName)
+
+
+if __name__ == "__main__":
+
+    usage = 'plotFigure1s.py -f <results file name> | -d <directory> [-p <no. processes>] [-e <every> | -m <max. generations>] [-r] [-n <no. maps>]'
+
+    try:
+
+        opts, args = getopt.getopt(sys.argv[1:],'hf:d:p:e:m:rn:')
+
+    except getopt.GetoptError:
+
+        print(usage)
+        sys.exit(2)
+
+    fName = None; dirName = None; noProcs = None; every = 1; maxGens = None; raster = False; noMaps = 3
+
+    for opt, arg in opts:
+
+        if opt == '-h':
+
+            print(usage)
+            sys.exit()
+
+        elif opt == '-f':
+
+            fName = arg
+
+        elif opt == '-d':
+
+            dirName = arg
+
+        elif opt == '-p':
+
+            noProcs = int(arg)
+
+        elif opt == '-e':
+
+            every = int(arg)
+
+        elif opt == '-m':
+
+            maxGens = int(arg)
+
+        elif opt == '-r':
+
+            raster = True
+
+        elif opt == '-n':
+
+            noMaps = int(arg)
+
+    if dirName is not None:
 
+        plotDirectory(dirName, noProcs, every, maxGens, raster, noMaps)
 
-plt.tight_layout()
-plt.savefig(fName + '_Fig1s.png')
-plt.close()
-#plt.show()
+    else:
 
+        plotFigure1s(fName, every, maxGens, raster, noMaps)
@@ -0,0 +1,505 @@
+import os
+import pickle
+import numpy as np
+
+from timestepVec import ecosystem2popn
+from packedGenes import genesSpec, genesZeros
+
+# Streams the recorded generations of a simulation to disk as they happen, rather than keeping them all in memory.
+#
+# The stream file is append-only. It starts with one pickled header dictionary (the run's metadata), followed by one
+# record per generation, each a sequence of .npy blocks (written with np.save):
+#
+#   t,              int64 array of length 1, the timestep
+#   present,        boolean array (noLocns, noSlots), which mating-pair positions (slots) are occupied
+#   natalHabType,   uint8 array (noLocns, noSlots), natal habitat type codes (see timestepVec.habTypesList)
+#   genotype,       one int64 array (noLocns, noSlots) per gene type, in the order of header['geneTypes'], or uint64
+#                   (noLocns, noSlots, noWords) for genes of more than 62 loci (see packedGenes.py)
+#
+# The sex of each adult is given by its slot (parameters['sexes'][slot]). When the run finishes, a final block holding
+# -t is written, then the pickled stop dictionary, then a 16-byte trailer: the byte position of the -t block (little-endian
+# int64) and the tag b'STREAMND', so a reader can tell the run completed by looking only at the end of the file.
+# A stream without it is a partial run, and can still be read up to its last complete generation.
+
+_streamEnd = b'STREAMND' # the tag ending the trailer of a completed stream
+
+def streamOpen(fName, header):
+    """
+    rec = streamOpen(fName, header)
+
+    Creates the stream file fName and writes the header, returning the recorder
+
+    header:
+        dictionary, metadata of the run, must include 'parameters'
+    rec:
+        dictionary, with the open file 'f', the file name 'fName' and the 'geneTypes' in the order they are written
+    """
+
+    geneTypes = list( header['parameters']['genetics'].keys() )
+
+    header = dict(header)
+    header['geneTypes'] = geneTypes
+
+    f = open(fName, 'wb')
+    pickle.dump( header, f )
+    f.flush()
+
+    rec = { 'f': f, 'fName': fName, 'geneTypes': geneTypes }
+
+    return rec
+
+def streamWrite(rec, t, popn):
+    """
+    streamWrite(rec, t, popn)
+
+    Appends the population popn (in the array form of timestepVec.py) at timestep t to the stream
+    """
+
+    f = rec['f']
+
+    np.save( f, np.array([t], dtype=np.int64) )
+    np.save( f, popn['present'] )
+    np.save( f, popn['natalHabType'] )
+
+    for geneType in rec['geneTypes']:
+        np.save( f, popn['genotype'][geneType] )
+
+    f.flush()
+
+def streamClose(rec, t, stop=None):
+    """
+    streamClose(rec, t, stop=None)
+
+    Marks the stream as complete, storing t (the timestep after the last one run) and, after it, the pickled stop
+    dictionary (why and when the run stopped) and the trailer pointing to them, and closes it
+    """
+
+    f = rec['f']
+    posn = f.tell()
+
+    np.save( f, np.array([-t], dtype=np.int64) )
+    pickle.dump( stop, f )
+    f.write( np.array([posn], dtype='<i8').tobytes() + _streamEnd )
+    f.close()
+
+def streamReopen(fName, posn):
+    """
+    rec = streamReopen(fName, posn)
+
+    Reopens a stream file to continue writing at byte position posn (e.g. from a checkpoint), discarding anything after it
+    """
+
+    f = open(fName, 'r+b')
+    header = pickle.load( f )
+
+    f.truncate(posn)
+    f.seek(posn)
+
+    rec = { 'f': f, 'fName': fName, 'geneTypes': header['geneTypes'] }
+
+    return rec
+
+def streamPosn(rec):
+    """
+    Flushes the stream and returns the byte position at which the next generation will be written
+    """
+
+    rec['f'].flush()
+    os.fsync( rec['f'].fileno() )
+
+    return rec['f'].tell()
+
+def streamRead(fName):
+    """
+    header, gens = streamRead(fName)
+
+    Opens a stream file for reading
+
+    header:
+        dictionary, the metadata of the run, with 't' and 'stop' added if the run completed
+    gens:
+        generator, yielding (t, popn) for each recorded generation in turn, only one generation is in memory at a time.
+        If the stream is a partial run (e.g. the simulation crashed), it stops at the last complete generation.
+
+    >>> import os, tempfile
+    >>> fName = os.path.join( tempfile.mkdtemp(), 'test.stream' )
+    >>> parameters = {'genetics': {'repn': {}}}
+    >>> rec = streamOpen( fName, {'parameters': parameters, 'burnInT': 0} )
+    >>> popn = { 'present': np.ones((3,2), dtype=bool), 'natalHabType': np.zeros((3,2), dtype=np.uint8), 'genotype': {'repn': np.full((3,2), 31)} }
+    >>> streamWrite(rec, 1, popn); streamWrite(rec, 2, popn)
+    >>> streamClose(rec, 3)
+    >>> header, gens = streamRead(fName)
+    >>> [ (t, int(popn['genotype']['repn'].sum())) for t, popn in gens ]
+    [(1, 186), (2, 186)]
+    >>> header['t']
+    3
+    >>> rec = streamOpen( fName, {'parameters': parameters, 'burnInT': 0} ); streamWrite(rec, 1, popn); rec['f'].close()
+    >>> 't' in streamRead(fName)[0] # a partial run
+    False
+    """
+
+    f = open(fName, 'rb')
+    header = pickle.load( f )
+    posn = f.tell()
+
+    # if the run completed, the trailer at the end of the file points to t and the stop dictionary
+
+    if f.seek(0, os.SEEK_END) >= posn + 16:
+
+        f.seek(-16, os.SEEK_END)
+        trailer = f.read(16)
+
+        if trailer[8:] == _streamEnd:
+
+            f.seek( int( np.frombuffer(trailer[:8], dtype='<i8')[0] ) )
+            header['t'] = - int( np.load(f)[0] )
+            header['stop'] = pickle.load(f)
+
+    f.seek(posn)
+
+    gens = ( (t, popn) for t, popn in _streamRecords(f, header['geneTypes']) if t >= 0 )
+
+    return header, gens
+
+def _streamRecords(f, geneTypes):
+    """
+    Yields (t, popn) records from the open stream file f until its end or a truncated record, and (-t, None) for the end marker
+    """
+
+    while True:
+
+        try:
+
+            t = int( np.load(f)[0] )
+
+            if t < 0: # the end of the run
+
+                yield t, None
+                return
+
+            popn = { 'present': np.load(f), 'natalHabType': np.load(f), 'genotype': dict() }
+
+            for geneType in geneTypes:
+                popn['genotype'][geneType] = np.load(f)
+
+        except (EOFError, ValueError, OSError): # no more, or a partially written record
+
+            return
+
+        yield t, popn
+
+# The columnar format is a directory of fixed-dtype .npy arrays, each with one row per recorded generation,
+# so analyses can np.load(..., mmap_mode='r') just the array and the slice they need:
+#
+#   meta.pkl,               pickled dictionary of the run's metadata (burnInT, t, tf, landscape, path, parameters, initial_ecosystem, seed, stop, geneTypes)
+#   t.npy,                  int64 array (noGens,), the timestep of each row, 0 for rows not (yet) written
+#   present.npy,            boolean array (noGens, noLocns, noSlots)
+#   natalHabType.npy,       uint8 array (noGens, noLocns, noSlots)
+#   genotype_<geneType>.npy int64 array (noGens, noLocns, noSlots), one per gene type, or uint64 (noGens, noLocns, noSlots, noWords)
+#                           for packed genes
+#
+# The arrays are allocated for all tf - burnInT generations when the run starts and filled in as it goes, so a partial
+# run can be read up to its last written row.
+
+
+def columnsOpen(dirName, header, noLocns):
+    """
+    cols = columnsOpen(dirName, header, noLocns)
+
+    Creates the columnar results directory dirName, writes the metadata and allocates the arrays
+
+    header:
+        dictionary, metadata of the run, must include 'parameters', 'burnInT' and 'tf', and 'snapshotEvery' if
+        only every snapshotEvery'th recorded timestep is written
+    cols:
+        dictionary, the recorder, with the open memory-mapped arrays
+    """
+
+    parameters = header['parameters']
+    geneTypes = list( parameters['genetics'].keys() )
+    noGens = max( header['tf'] - header['burnInT'], 0 )
+
+    if header.get('snapshotEvery') is not None: # only every snapshotEvery'th timestep is written
+        noGens = -( -noGens // header['snapshotEvery'] )
+
+    shape = ( noGens, noLocns, len(parameters['sexes']) )
+
+    os.makedirs(dirName, exist_ok=True)
+
+    meta = dict(header)
+    meta['geneTypes'] = geneTypes
+    columnsWriteMeta(dirName, meta)
+
+    openFnc = lambda name, dtype, shape: np.lib.format.open_memmap( os.path.join(dirName, name + '.npy'), mode='w+', dtype=dtype, shape=shape )
+
+    cols = {
+            'dirName': dirName,
+            'meta': meta,
+            'row': 0,
+            't': openFnc('t', np.int64, (noGens,)),
+            'present': openFnc('present', bool, shape),
+            'natalHabType': openFnc('natalHabType', np.uint8, shape),
+            'genotype': { geneType: openFnc( 'genotype_' + geneType, genesSpec(parameters, geneType)[0], shape + genesSpec(parameters, geneType)[1] )
+                for geneType in geneTypes },
+            }
+
+    return cols
+
+def columnsWrite(cols, t, popn):
+    """
+    columnsWrite(cols, t, popn)
+
+    Writes the population popn (in the array form of timestepVec.py) at timestep t into the next row of the columnar arrays
+    """
+
+    row = cols['row']
+
+    cols['present'][row] = popn['present']
+    cols['natalHabType'][row] = popn['natalHabType']
+
+    for geneType, genes in cols['genotype'].items():
+        genes[row] = popn['genotype'][geneType]
+
+    cols['t'][row] = t # written last, so a row is only counted once it is complete
+    cols['row'] = row + 1
+
+def columnsClose(cols, t, stop=None):
+    """
+    columnsClose(cols, t, stop=None)
+
+    Flushes the columnar arrays and stores t (the timestep after the last one run) and stop (why and when the run stopped) in the metadata
+    """
+
+    for name in ['present', 'natalHabType', 't']:
+        cols[name].flush()
+
+    for genes in cols['genotype'].values():
+        genes.flush()
+
+    cols['meta']['t'] = t
+    cols['meta']['stop'] = stop
+    columnsWriteMeta(cols['dirName'], cols['meta'])
+
+def columnsReopen(dirName, row):
+    """
+    cols = columnsReopen(dirName, row)
+
+    Reopens a columnar results directory to continue writing at row (e.g. from a checkpoint), discarding any rows after it
+    """
+
+    f = open( os.path.join(dirName, 'meta.pkl'), 'rb' )
+    meta = pickle.load(f)
+    f.close()
+
+    openFnc = lambda name: np.load( os.path.join(dirName, name + '.npy'), mmap_mode='r+' )
+
+    cols = {
+            'dirName': dirName,
+            'meta': meta,
+            'row': row,
+            't': openFnc('t'),
+            'present': openFnc('present'),
+            'natalHabType': openFnc('natalHabType'),
+            'genotype': { geneType: openFnc('genotype_' + geneType) for geneType in meta['geneTypes'] },
+            }
+
+    cols['t'][row:] = 0 # rows written after the checkpoint are no longer counted
+
+    return cols
+
+def columnsPosn(cols):
+    """
+    Flushes the columnar arrays and returns the row at which the next generation will be written
+    """
+
+    for name in ['present', 'natalHabType', 't']:
+        cols[name].flush()
+
+    for genes in cols['genotype'].values():
+        genes.flush()
+
+    return cols['row']
+
+def columnsWriteMeta(dirName, meta):
+    """
+    columnsWriteMeta(dirName, meta)
+
+    Writes the metadata of a directory of arrays (a .cols or .obs directory) atomically, so a crash never leaves
+    a half-written meta.pkl
+    """
+
+    fNameTmp = os.path.join(dirName, 'meta.pkl.tmp')
+
+    with open(fNameTmp, 'wb') as f:
+        pickle.dump( meta, f )
+
+    os.replace( fNameTmp, os.path.join(dirName, 'meta.pkl') )
+
+def checkpointSave(fName, state):
+    """
+    checkpointSave(fName, state)
+
+    Pickles the simulation state (a dictionary) to the checkpoint file fName atomically: it is written to a temporary
+    file first and then renamed, so the checkpoint on disk is always either the previous one or the new one, complete
+    """
+
+    fNameTmp = fName + '.tmp'
+
+    with open(fNameTmp, 'wb') as f:
+        pickle.dump( state, f, protocol=pickle.HIGHEST_PROTOCOL )
+        f.flush()
+        os.fsync( f.fileno() )
+
+    os.replace( fNameTmp, fName )
+
+def checkpointAppend(fName, items):
+    """
+    posn = checkpointAppend(fName, items)
+
+    Appends the list items, pickled, to the file fName (creating it if needed), e.g. the generations recorded in memory since
+    the last checkpoint, so each checkpoint writes only what is new. Returns the byte position of the end, flushed to disk
+    """
+
+    with open(fName, 'ab') as f:
+
+        pickle.dump( items, f, protocol=pickle.HIGHEST_PROTOCOL )
+        f.flush()
+        os.fsync( f.fileno() )
+
+        return f.tell()
+
+def checkpointAppended(fName, posn):
+    """
+    items = checkpointAppended(fName, posn)
+
+    Reads back the lists appended to fName up to byte position posn (e.g. from a checkpoint) as one list, discarding anything after it
+
+    >>> import tempfile
+    >>> fName = os.path.join( tempfile.mkdtemp(), 'test.ckpt.gens' )
+    >>> posn = checkpointAppend(fName, [1, 2]); posn = checkpointAppend(fName, [3])
+    >>> _ = checkpointAppend(fName, [4]) # after the checkpoint
+    >>> checkpointAppended(fName, posn)
+    [1, 2, 3]
+    """
+
+    items = list()
+
+    with open(fName, 'r+b') as f:
+
+        f.truncate(posn)
+
+        while f.tell() < posn:
+            items.extend( pickle.load(f) )
+
+    return items
+
+def checkpointLoad(fName):
+    """
+    state = checkpointLoad(fName)
+
+    Loads the simulation state from the checkpoint file fName
+
+    >>> import tempfile
+    >>> fName = os.path.join( tempfile.mkdtemp(), 'test.ckpt' )
+    >>> checkpointSave(fName, {'t': 11})
+    >>> checkpointLoad(fName)
+    {'t': 11}
+    """
+
+    with open(fName, 'rb') as f:
+        state = pickle.load(f)
+
+    return state
+
+def loadResults(fName, mmap=True):
+    """
+    results = loadResults(fName, mmap=True)
+
+    Loads the results of a run in any of the formats simulate writes: a legacy pickle file (fName ends in .pkl),
+    a stream file (.stream, see streamRead), or a columnar directory (.cols). The generations are returned as arrays
+    with one row per recorded generation, laid out as in the columnar format.
+
+    mmap:
+        boolean, if True the arrays of a columnar directory are memory-mapped, so only the slices used are read from disk
+    results:
+        dictionary, with the metadata (burnInT, t, tf, landscape, path, parameters, initial_ecosystem, seed, stop, geneTypes)
+        and the arrays 'ts' (the timestep of each row), 'present', 'natalHabType' and 'genotype' ({geneType: array (noGens, noLocns, noSlots)})
+
+    >>> import tempfile
+    >>> dirName = os.path.join( tempfile.mkdtemp(), 'test.cols' )
+    >>> parameters = {'sexes': ('h', 'h'), 'genetics': {'repn': {'noLoci': 20}}}
+    >>> cols = columnsOpen( dirName, {'parameters': parameters, 'burnInT': 0, 'tf': 5}, 3 )
+    >>> popn = { 'present': np.ones((3,2), dtype=bool), 'natalHabType': np.zeros((3,2), dtype=np.uint8), 'genotype': {'repn': np.full((3,2), 31)} }
+    >>> columnsWrite(cols, 1, popn); columnsWrite(cols, 2, popn)
+    >>> columnsClose(cols, 3)
+    >>> results = loadResults(dirName)
+    >>> results['genotype']['repn'].shape, results['ts'].tolist(), results['t']
+    ((2, 3, 2), [1, 2], 3)
+    """
+
+    if fName.endswith('.pkl'):
+
+        f = open(fName, 'rb')
+        objs = [ pickle.load(f) for i in range(9) ]
+
+        for i in range(2): # the seed and stop, which older files do not have
+
+            try:
+                objs.append( pickle.load(f) )
+            except EOFError:
+                objs.append( None )
+
+        f.close()
+
+        ss, burnInT, t, tf, landscape, ecosystems, path, parameters, initial_ecosystem, seed, stop = objs
+        results = { 'ss': ss, 'burnInT': burnInT, 't': t, 'tf': tf, 'landscape': landscape, 'path': path, 'parameters': parameters,
+                'initial_ecosystem': initial_ecosystem, 'seed': seed, 'stop': stop, 'geneTypes': list( parameters['genetics'].keys() ) }
+
+        ts = list( range(burnInT+1, burnInT+1+len(ecosystems)) )
+        popns = [ ecosystem2popn(parameters, ecosystem) for ecosystem in ecosystems ]
+
+    elif fName.endswith('.stream'):
+
+        results, gens = streamRead(fName)
+        ts = list(); popns = list()
+
+        for t, popn in gens:
+            ts.append(t); popns.append(popn)
+
+    else: # columnar
+
+        f = open( os.path.join(fName, 'meta.pkl'), 'rb' )
+        results = pickle.load(f)
+        f.close()
+
+        mmapMode = 'r' if mmap else None
+        loadFnc = lambda name: np.load( os.path.join(fName, name + '.npy'), mmap_mode=mmapMode )
+
+        t = loadFnc('t')
+        noGens = int( np.argmin( np.r_[t, 0] > 0 ) ) # the written rows
+
+        results['ts'] = np.asarray( t[:noGens] )
+        results['present'] = loadFnc('present')[:noGens]
+        results['natalHabType'] = loadFnc('natalHabType')[:noGens]
+        results['genotype'] = { geneType: loadFnc('genotype_' + geneType)[:noGens] for geneType in results['geneTypes'] }
+
+        return results
+
+    # stack the generations from a pickle or stream file
+
+    parameters = results['parameters']
+    noLocns = len( results['landscape'] ); noSlots = len( parameters['sexes'] )
+    stackFnc = lambda arrays, dtype: np.stack(arrays) if arrays else np.zeros( (0, noLocns, noSlots), dtype=dtype )
+
+    results['ts'] = np.array(ts, dtype=np.int64)
+    results['present'] = stackFnc( [ popn['present'] for popn in popns ], bool )
+    results['natalHabType'] = stackFnc( [ popn['natalHabType'] for popn in popns ], np.uint8 )
+    results['genotype'] = { geneType: np.stack( [ popn['genotype'][geneType] for popn in popns ] ) if popns else genesZeros( parameters, geneType, (0, noLocns, noSlots) )
+            for geneType in results['geneTypes'] }
+
+    return results
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
@@ -1,13 +1,26 @@
 import random as random
 import pickle
 import os # 
-import copy
-
-from timestep import timestep # locally defined timestep function
+import time
+
+from timestep import timestep, timestepFused # locally defined timestep function
+from timestepVec import timestepVec, ecosystem2popn, popn2ecosystem, popnIsEmpty # array version of timestep
+from timestepNumba import timestepNumba, kernelTables # compiled version of timestep on the same arrays
+from timestepParallel import parallelOpen, timestepParallel, parallelStates, parallelClose # the same arrays split over worker processes
+from recorder import streamOpen, streamWrite, streamClose # streams recorded timesteps to disk
+from recorder import columnsOpen, columnsWrite, columnsClose # or writes them as columnar arrays
+from recorder import streamReopen, streamPosn, columnsReopen, columnsPosn, checkpointSave, checkpointLoad # checkpoint and resume
+from recorder import checkpointAppend, checkpointAppended
+from observers import observersOpen, observersWrite, observersClose, observersReopen, observersPosn # summary statistics of each timestep
+from metrics import metricsOpen, metricsReopen, metricsPhase, metricsCount, metricsGeneration, metricsClose # time and counts of each phase
 
 #import sys
 #sys.path.append("../../current_code/")
-from carryover import ecosystemIsEmpty # checks if the population has gone extinct
+from carryover import ecosystemIsEmpty, occupiedIndex # checks if the population has gone extinct, visiting only occupied territories
+from carryover import ecosystemSnapshot # copies of the ecosystem for recording, without deep-copying the individuals, and Flocks of Individuals from dictionaries
+from stopping import generationStats # statistics needed by stopping criteria
+from carryover import parameterModel # lookup tables built once from the parameters
+from carryover import RandomStream # seedable random number stream for the run
 
 # allows me to construct suffixes for files according to parameter values
 def parameters2filesuffix(tf, landscape, parameters):
@@ -20,7 +33,7 @@ def parameters2filesuffix(tf, landscape, parameters):
     else:
         d = str(distMax)
 
-    H = sum( c == 'H' for c in landscape )
+    H = landscape.count('H')
     L = len(landscape)
 
     sd = round( 10*parameters['habitats']['H']['sd'] )
@@ -36,12 +49,13 @@ def parameters2filesuffix(tf, landscape, parameters):
 
     return suffix
 
-def simulate(parameters, landscape, burnInT, tf, initial_ecosystem = None, idxRun=None, suffix=None):
+def simulate(parameters, landscape, burnInT, tf, initial_ecosystem = None, idxRun=None, suffix=None, engine='dicts', rng=None, record='pickle', seed=None, checkpointEvery=None, resume=False, stopCriteria=None, observers=None, snapshotEvery=None, noWorkers=None, metrics=None):
     '''
     parameters: 
         dictionary, see script.py for example
     landscape: 
-        string, defines the landscape as a string of H and L for high and low-quality habitats
+        string, defines the landscape as a string of H and L for high and low-quality habitats,
+        or a Landscape for 2-D grids and patch networks (see landscape.py)
     burnInT: 
         integer, some number of timesteps (generations) to not store in the pickle file
     tf:
@@ -52,16 +66,102 @@ def simulate(parameters, landscape, burnInT, tf, initial_ecosystem = None, idxRu
         like *_run0.pkl, *_run1.pkl, etc.
     suffix:
         string, the string to identify the pickled results file i.e. ecosystems_suffix_run0.pkl
+    engine:
+        string, 'dicts' to simulate the ecosystem as a list of flock dictionaries (timestep.py), 
+        or 'fused' to do the same without storing juveniles (timestep.timestepFused),
+        or 'numpy' to simulate it as arrays with batched operations over each generation (timestepVec.py),
+        or 'numba' to simulate the same arrays with compiled loops (timestepNumba.py, plain Python and slow if Numba is not installed),
+        or 'parallel' to simulate the same arrays with the landscape split into blocks over noWorkers processes (timestepParallel.py)
+    rng:
+        RandomStream (see carryover.py) used for every random draw in the run, if None one is created from seed
+    record:
+        string, 'pickle' to keep the recorded timesteps in memory and pickle them at the end (ecosystems_suffix.pkl),
+        or 'stream' to append each recorded timestep to ecosystems_suffix.stream as it happens (see recorder.py),
+        so memory is bounded by one generation and partial runs can be read,
+        or 'columns' to write them into memory-mappable arrays in the directory ecosystems_suffix.cols (see recorder.py).
+        All can be read with recorder.loadResults. If None, the ecosystem is not recorded (e.g. when only observers are wanted)
+    seed:
+        integer or numpy SeedSequence, seed of the RandomStream if rng is None. The seed of the stream is stored with the results,
+        so a run can be repeated exactly
+    checkpointEvery:
+        integer, if given, every checkpointEvery timesteps the state of the run (ecosystem, timestep, random number stream, and
+        how far the results have been written) is saved atomically to ecosystems_suffix.ckpt, which is removed when the run completes.
+        With record 'pickle', the timesteps recorded since the last checkpoint are appended to ecosystems_suffix.ckpt.gens,
+        so a checkpoint does not write them all again
+    resume:
+        boolean, if True and a checkpoint exists, continue the run from it, producing the same results as if it had not been
+        interrupted (with the same engine and record). Otherwise a new run is started
+    stopCriteria:
+        list of stopping criteria (see stopping.py, e.g. [stopStationary(window=100, tol=0.02), stopFixation('repn')]) checked
+        each recorded timestep. The run stops when any is met, at tf, or when there are no mating pairs left, and the reason and
+        timestep are stored with the results as stop
+    observers:
+        list of strings, summary statistics to calculate each recorded timestep (see observers.py, e.g. ['occupancy', 'noOffspring', 'phen']),
+        written as they go into the directory ecosystems_suffix.obs, which can be read with observers.loadObservations
+    snapshotEvery:
+        integer, if given, the whole ecosystem is only recorded every snapshotEvery recorded timesteps (from the first),
+        with record 'stream' or 'columns', while observers are calculated every timestep
+    noWorkers:
+        integer, the number of worker processes of the 'parallel' engine, if None the number of CPUs, or when resuming,
+        the number the checkpoint was made with (a different number raises ValueError)
+    metrics:
+        True to record the time of each phase of each generation, counts (e.g. offspring, dispersal draws, mutations) and
+        memory, written to ecosystems_suffix.metrics.json (see metrics.py), or 'memory' to also trace the peak memory
+        Python allocates each generation (slow). If None, nothing is recorded and the run is not slowed. Not available
+        with engine 'numba', whose compiled loops cannot be timed by phase (raises ValueError)
     '''
 
+    # build the results file's name
+
+    fName = 'ecosystems'
+
+    if suffix == None:
+        suffix = parameters2filesuffix(tf, landscape, parameters)
+    fName += suffix
+
+    if idxRun != None:
+        fName += '_run' + str(idxRun)
+
+    path = os.path.dirname(os.path.realpath('simulate.py'))
+
+    # if resuming, load the latest checkpoint
+
+    fNameCkpt = fName + '.ckpt'
+    checkpoint = None
+
+    if resume and os.path.exists(fNameCkpt):
+
+        checkpoint = checkpointLoad(fNameCkpt)
+
+        if checkpoint['engine'] != engine or checkpoint['record'] != record:
+            raise ValueError('checkpoint ' + fNameCkpt + ' was made with engine ' + checkpoint['engine'] + ' and record ' + checkpoint['record'])
+
+        rng = checkpoint['rng']
+        initial_ecosystem = checkpoint['initial_ecosystem']
+
+    if rng is None:
+        rng = RandomStream(seed)
+
+    # the metrics dictionary the timesteps add to, or None
+
+    if metrics and engine == 'numba':
+        raise ValueError('metrics are not recorded with engine \'numba\', use engine \'numpy\' to see where the time goes')
+
+    if checkpoint is not None and checkpoint.get('metrics') is not None:
+        runMetrics = metricsReopen( checkpoint['metrics'] )
+    elif metrics:
+        runMetrics = metricsOpen( memory=(metrics == 'memory') )
+    else:
+        runMetrics = None
+
     # initialise ecosystem
 
     if initial_ecosystem == None:
 
         # random start for individuals
-        geneRandFnc = lambda geneType: random.randint(0, 2**parameters['genetics'][geneType]['noLoci']-1)
-        #sexRandFnc = lambda: random.choice( parameters['sexes'] )
-        natalHabRandFnc = lambda: random.choice( landscape )
+        geneRandFnc = lambda geneType: rng.getrandbits( parameters['genetics'][geneType]['noLoci'] )
+        #sexRandFnc = lambda: rng.choice( parameters['sexes'] )
+        natalHabRandFnc = lambda: rng.choice( landscape )
 
         initial_ecosystem = [ {
                     'adults': [
@@ -71,61 +171,312 @@ def simulate(parameters, landscape, burnInT, tf, initial_ecosystem = None, idxRu
                     }
             for habType in landscape]
 
-    ecosystem = copy.deepcopy( initial_ecosystem ) # make a deep copy so we can store the initial conditions in pickle file
+    # compile the parameters into lookup tables once, the original parameters are stored in the pickle file
 
-    # simulate ecosystem for burn-in timesteps, but don't record results
+    model = parameterModel(parameters, landscape)
+
+    # choose how the ecosystem is represented and stepped forward
+
+    if engine in ['dicts', 'fused']:
+
+        ecosystem = ecosystemSnapshot( initial_ecosystem ) # Flocks of Individuals (see individuals.py), a copy so we can store the initial conditions in pickle file
+        timestepFnc = timestep if engine == 'dicts' else timestepFused
+        occupied = occupiedIndex(ecosystem) # the territories with adults, kept up to date by the timestep
+        stepFnc = lambda ecosystem: timestepFnc(model, ecosystem, landscape, rng, genStats, occupied, runMetrics)[0]
+        isEmptyFnc = lambda ecosystem: ecosystemIsEmpty(ecosystem, occupied)
+        recordFnc = ecosystemSnapshot
+
+    elif engine in ['numpy', 'numba', 'parallel']:
+
+        ecosystem = ecosystem2popn(parameters, initial_ecosystem) # arrays, so initial conditions are not modified
+
+        if engine == 'numpy':
+            stepFnc = lambda popn: timestepVec(model, popn, landscape, rng, genStats, runMetrics)[0]
+        elif engine == 'numba':
+            tables = kernelTables(model, landscape)
+            stepFnc = lambda popn: timestepNumba(model, popn, landscape, rng, genStats, tables)[0]
+        else:
+            par = None # the workers are started when the run starts, so they are always stopped (see below)
+            stepFnc = lambda popn: timestepParallel(par, popn, genStats, runMetrics)
+
+        isEmptyFnc = popnIsEmpty
+        recordFnc = lambda popn: popn2ecosystem(parameters, popn) # stored in the same form as the 'dicts' engine
+
+    else:
+
+        raise ValueError('unknown engine ' + str(engine))
 
     t = 1
-    while t <= burnInT and not ecosystemIsEmpty(ecosystem):
+    genStats = { 'noPairs': 0 if isEmptyFnc(ecosystem) else 1 } # after each timestep, the number of mating pairs
 
-        ecosystem, _ = timestep(parameters, ecosystem, landscape)
-        t += 1
+    if stopCriteria is None:
+        stopCriteria = list()
 
+    if checkpoint is not None:
 
-    # simulate ecosystem for remaining timesteps and record results
+        ecosystem = checkpoint['ecosystem']
+        t = checkpoint['t']
+        genStats = checkpoint['genStats']
+        stopCriteria = checkpoint['stopCriteria']
 
-    ecosystems = list() # a place to store the ecosystem at each timestep
-    while t <= tf and not ecosystemIsEmpty(ecosystem):
+        if engine in ['dicts', 'fused']: # pickled as dictionaries, and rebuild the index of occupied territories
+            ecosystem = ecosystemSnapshot(ecosystem)
+            occupied = occupiedIndex(ecosystem)
 
-        # one timestep of simulation
-        ecosystem, _ = timestep(parameters, ecosystem, landscape)
+    # check the stopping criteria, calculating only the statistics they need
 
-        # store info
-        ecosystems.append( copy.deepcopy(ecosystem) )
+    needs = set( need for criterion in stopCriteria for need in criterion['needs'] )
 
-        t += 1
+    def stopFnc(t, ecosystem):
 
+        if not stopCriteria:
+            return None
 
-    # pickle the info
+        stats = generationStats(model, ecosystem, landscape, needs)
 
-    # build the pickled results file's name
-    fName = 'ecosystems'
+        for criterion in stopCriteria:
+            if criterion['check'](criterion, stats):
+                return { 'reason': criterion['name'], 't': t }
 
-    if suffix == None:
-        suffix = parameters2filesuffix(tf, landscape, parameters)
-    fName += suffix
+        return None
 
-    if idxRun != None:
-        fName += '_run' + str(idxRun)
+    # choose how recorded timesteps are stored
+
+    if snapshotEvery is not None and record == 'pickle':
+        raise ValueError('snapshotEvery needs record \'stream\' or \'columns\'')
+
+    popnFnc = ( lambda ecosystem: ecosystem2popn(parameters, ecosystem) ) if engine in ['dicts', 'fused'] else ( lambda popn: popn )
+    header = { 'burnInT': burnInT, 'tf': tf, 'landscape': landscape, 'path': path, 'parameters': parameters, 'initial_ecosystem': initial_ecosystem,
+            'seed': rng.seed(), 'snapshotEvery': snapshotEvery }
+
+    if record is None:
+
+        storeFnc = lambda t, ecosystem: None
+        posnFnc = lambda: None
+
+    elif record == 'pickle':
+
+        # a place to store the ecosystem at each timestep, with those already saved by a checkpoint read back if resuming
+
+        if checkpoint is None:
+
+            ecosystems = list()
+
+            if checkpointEvery is not None and os.path.exists(fNameCkpt + '.gens'): # left by an earlier run
+                os.remove(fNameCkpt + '.gens')
+
+        else:
+
+            ecosystems = checkpointAppended( fNameCkpt + '.gens', checkpoint['recPosn'] )
+
+        noSaved = [ len(ecosystems) ] # how many have been appended to the checkpoint's file
+        storeFnc = lambda t, ecosystem: ecosystems.append( recordFnc(ecosystem) )
+
+        def posnFnc(): # append those recorded since the last checkpoint
+
+            posn = checkpointAppend( fNameCkpt + '.gens', ecosystems[ noSaved[0]: ] )
+            noSaved[0] = len(ecosystems)
+
+            return posn
+
+    elif record in ['stream', 'columns']:
+
+        # write each recorded timestep to disk as arrays as we go, see recorder.py
+
+        if record == 'stream':
+            rec = streamOpen(fName + '.stream', header) if checkpoint is None else streamReopen(fName + '.stream', checkpoint['recPosn'])
+            storeFnc = lambda t, ecosystem: streamWrite( rec, t, popnFnc(ecosystem) )
+            posnFnc = lambda: streamPosn(rec)
+        else:
+            rec = columnsOpen(fName + '.cols', header, len(landscape)) if checkpoint is None else columnsReopen(fName + '.cols', checkpoint['recPosn'])
+            storeFnc = lambda t, ecosystem: columnsWrite( rec, t, popnFnc(ecosystem) )
+            posnFnc = lambda: columnsPosn(rec)
+
+    else:
+
+        raise ValueError('unknown record ' + str(record))
+
+    if snapshotEvery is not None:
 
-    fName += '.pkl'
+        storeEveryFnc = storeFnc
+        storeFnc = lambda t, ecosystem: storeEveryFnc(t, ecosystem) if (t - burnInT - 1) % snapshotEvery == 0 else None
+
+    # calculate the observers' summary statistics each recorded timestep, with their own random number stream
+    # so that observing does not change the run
+
+    if observers:
+
+        if checkpoint is None:
+            obsRng = rng.spawn(1)[0].generator
+            obs = observersOpen(fName + '.obs', header, observers, len(landscape))
+        else:
+            obsRng = checkpoint['obsRng']
+            obs = observersReopen(fName + '.obs', checkpoint['obsPosn'])
+
+        observeFnc = lambda t, ecosystem: observersWrite( obs, t, model, popnFnc(ecosystem), landscape, obsRng )
+
+    else:
+
+        observeFnc = lambda t, ecosystem: None
+
+    # periodically save everything needed to carry on from here
+
+    def checkpointFnc(t):
+
+        if checkpointEvery is None or (t-1) % checkpointEvery != 0:
+            return
+
+        state = { 'engine': engine, 'record': record, 't': t, 'ecosystem': ecosystem, 'rng': rng, 'initial_ecosystem': initial_ecosystem,
+                'genStats': genStats, 'stopCriteria': stopCriteria }
+
+        if record is not None:
+            state['recPosn'] = posnFnc() # the recorder is flushed to here
+
+        if observers:
+            state['obsRng'] = obsRng
+            state['obsPosn'] = observersPosn(obs)
+
+        if engine == 'parallel':
+            state['workerStates'] = parallelStates(par)
+
+        if runMetrics is not None:
+            state['metrics'] = runMetrics
+
+        checkpointSave(fNameCkpt, state)
+
+    # with metrics, time each phase of the loop and close each generation
+
+    def metricsFnc(t):
+
+        if runMetrics is not None:
+            metricsCount( runMetrics, 'noPairs', genStats['noPairs'] )
+            metricsGeneration(runMetrics, t)
+
+    def timedFnc(phase, fnc):
+
+        if runMetrics is None:
+            return fnc
+
+        def timed(*args):
+            start = time.perf_counter()
+            out = fnc(*args)
+            metricsPhase(runMetrics, phase, start)
+            return out
+
+        return timed
+
+    stepFnc = timedFnc('step', stepFnc)
+    storeFnc = timedFnc('record', storeFnc)
+    observeFnc = timedFnc('observe', observeFnc)
+    stopFnc = timedFnc('stop', stopFnc)
+    checkpointFnc = timedFnc('checkpoint', checkpointFnc)
+
+    try:
+
+        if engine == 'parallel':
+
+            if checkpoint is None:
+
+                par = parallelOpen(model, landscape, ecosystem, noWorkers, rng)
+
+            else: # carry on with the same workers' random number streams, so as many workers as when the checkpoint was made
+
+                workerStates = checkpoint['workerStates']
+
+                if noWorkers is not None and min( noWorkers, len(landscape) ) != len(workerStates):
+                    raise ValueError('checkpoint ' + fNameCkpt + ' was made with ' + str( len(workerStates) ) + ' workers, not ' + str(noWorkers))
+
+                par = parallelOpen(model, landscape, ecosystem, len(workerStates), rng, workerStates)
+
+        # simulate ecosystem for burn-in timesteps, but don't record results
+
+        while t <= burnInT and genStats['noPairs'] > 0:
+
+            ecosystem = stepFnc(ecosystem)
+            t += 1
+
+            metricsFnc(t-1)
+            checkpointFnc(t)
+
+
+        # simulate ecosystem for remaining timesteps and record results
+
+        stop = None
+        while t <= tf and genStats['noPairs'] > 0 and stop is None:
+
+            # one timestep of simulation
+            ecosystem = stepFnc(ecosystem)
+
+            # store info
+            storeFnc(t, ecosystem)
+            observeFnc(t, ecosystem)
+
+            # see if the run can stop early
+            stop = stopFnc(t, ecosystem)
+
+            t += 1
+
+            metricsFnc(t-1)
+            checkpointFnc(t)
+
+    finally:
+
+        if engine == 'parallel' and par is not None: # stop the worker processes, even if the run failed
+            ecosystem = parallelClose(par) # in place of the shared memory it frees
+
+    if stop is None:
+        stop = { 'reason': 'extinct' if genStats['noPairs'] == 0 else 'tf', 't': t-1 }
+
+    # the run is complete, so the checkpoint is no longer needed
+
+    if checkpointEvery is not None and os.path.exists(fNameCkpt):
+        os.remove(fNameCkpt)
+
+    if checkpointEvery is not None and os.path.exists(fNameCkpt + '.gens'):
+        os.remove(fNameCkpt + '.gens')
+
+    if observers:
+
+        observersClose(obs, t, stop)
+
+    if runMetrics is not None:
+
+        metricsClose( fName + '.metrics.json', runMetrics, dict( { key: value for key, value in header.items() if key != 'initial_ecosystem' },
+                engine=engine, stop=stop ) )
+
+    if record is None:
+
+        return
+
+    if record == 'stream':
+
+        streamClose(rec, t, stop)
+        return
+
+    if record == 'columns':
+
+        columnsClose(rec, t, stop)
+        return
+
+    # pickle the info
 
     # open the file with the name fName
-    f = open(fName, 'wb')
+    f = open(fName + '.pkl', 'wb')
 
     # a string explaining the pickle file
-    path = os.path.dirname(os.path.realpath('simulate.py'))
     ss  = 'Created by simulate.py in ' + path + '.\n'
-    ss += 'Contains the following:\n'
+    ss += 'Contains the following 11 objects, in order:\n'
     ss += '0. ss, string: this string you are reading now.\n'
     ss += '1. burnInT, integer: the number of unrecorded timesteps of burn-in.\n'
     ss += '2. t, integer: the total number up to which timesteps run (so range(burnInT+1,t)).\n'
     ss += '3. tf, integer: the total maximum number up to which timesteps were attempted (if pop did not go extinct, t = tf+1).\n'
     ss += '4. landscape, string: a string defining the landscape habitat type composition (e.g. LLLLHHHLLLL).\n'
-    ss += '5. ecosystems, list of lists of dictionaries: the ecosystem at the end of each recorded timestep.\n'
+    ss += '5. ecosystems, list of lists of dictionaries: the ecosystem at the end of each recorded timestep, one flock dictionary {\'adults\': [...], \'juveniles\': [...]} per territory, each individual a dictionary {\'sex\', \'natalHabType\', \'genotype\'} (the \'dicts\' and \'fused\' engines record Flock and Individual snapshots, see individuals.py, which are written as, and read back as, plain dictionaries).\n'
     ss += '6. path, string: the path in which the run was performed.\n'
     ss += '7. parameters, dictionary: the parameter values with which the run was performed.\n'
     ss += '8. initial_ecosystem, list of dictionaries: the initial ecosystem.\n'
+    ss += '9. seed, dictionary: entropy and spawn_key of the run\'s random number stream, RandomStream(numpy.random.SeedSequence(**seed)) repeats the run.\n'
+    ss += '10. stop, dictionary: why the run stopped (\'reason\' is \'tf\', \'extinct\', or the name of a stopping criterion) and the last timestep run (\'t\').\n'
 
     pickle.dump( ss, f ) # 0.
     pickle.dump( burnInT, f )
@@ -136,6 +487,8 @@ def simulate(parameters, landscape, burnInT, tf, initial_ecosystem = None, idxRu
     pickle.dump( path, f ) # 6.
     pickle.dump( parameters, f )
     pickle.dump( initial_ecosystem, f )
+    pickle.dump( rng.seed(), f ) # 9.
+    pickle.dump( stop, f )
 
     f.close()
 
@@ -0,0 +1,156 @@
+import numpy as np
+
+from carryover import gene2phen
+from timestepVec import phenArray, habTypesList, landscape2codes
+
+# Stopping criteria that end a run in simulate before tf, evaluated each recorded generation.
+#
+# Each criterion is a dictionary with its 'name', the per-generation statistics it 'needs' (see generationStats),
+# a 'check' function, check(criterion, stats), that returns True when the run should stop, and any settings and
+# state of its own. They are dictionaries of plain values and module-level functions so they can be checkpointed.
+#
+# Extinction (no mating pairs left) always stops a run, and is tracked by the running count of mating pairs that
+# timestep and timestepVec return in stats['noPairs'], so it needs no extra pass over the ecosystem.
+
+
+def stopStationary(window=50, tol=0.01, geneType='repn'):
+    """
+    criterion = stopStationary(window=50, tol=0.01, geneType='repn')
+
+    Stops when the mean phenotype of geneType among adults on each habitat type has varied by no more than tol
+    (max - min) over the last window generations, e.g. a stable local-adaptation or source-sink state
+
+    >>> criterion = stopStationary(window=3, tol=0.1)
+    >>> [ criterion['check']( criterion, {'meanPhen': {'repn': {'H': x, 'L': -1}}} ) for x in [0.5, 0.9, 0.95, 0.92, 0.9] ]
+    [False, False, False, True, True]
+    """
+
+    criterion = { 'name': 'stationary', 'needs': ['meanPhen'], 'check': checkStationary,
+            'window': window, 'tol': tol, 'geneType': geneType, 'history': list() }
+
+    return criterion
+
+def checkStationary(criterion, stats):
+
+    history = criterion['history']
+    history.append( stats['meanPhen'][ criterion['geneType'] ] )
+
+    if len(history) > criterion['window']:
+        del history[0]
+
+    if len(history) < criterion['window']:
+        return False
+
+    for habType in history[-1]:
+
+        means = [ meanPhen[habType] for meanPhen in history ]
+
+        if np.isnan(means).any() or max(means) - min(means) > criterion['tol']:
+            return False
+
+    return True
+
+def stopFixation(geneType='repn'):
+    """
+    criterion = stopFixation(geneType='repn')
+
+    Stops when every locus of geneType has the same allele in all adults, so the trait can only change by mutation
+
+    >>> criterion = stopFixation()
+    >>> criterion['check']( criterion, {'fixed': {'repn': True}} )
+    True
+    """
+
+    criterion = { 'name': 'fixation', 'needs': ['fixed'], 'check': checkFixation, 'geneType': geneType }
+
+    return criterion
+
+def checkFixation(criterion, stats):
+
+    return stats['fixed'][ criterion['geneType'] ]
+
+def generationStats(parameters, ecosystem, landscape, needs):
+    """
+    stats = generationStats(parameters, ecosystem, landscape, needs)
+
+    Calculates the statistics listed in needs for the ecosystem (a list of flocks) or popn (the arrays of timestepVec.py)
+
+    needs:
+        list of strings, from
+        'meanPhen': {geneType: {habType: mean phenotype of adults living on habType}}
+        'fixed': {geneType: True if every locus has the same allele in all adults}
+
+    >>> parameters = {'sexes': ('h', 'h'), 'genetics': {'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False}}, 'habitats': {'L': {}, 'H': {}} }
+    >>> ecosystem = [ {'adults': [ {'sex': 'h', 'natalHabType': 'L', 'genotype': {'repn': gene}} ], 'juveniles': []} for gene in [0, 31, 31] ]
+    >>> stats = generationStats(parameters, ecosystem, 'LLH', ['meanPhen', 'fixed'])
+    >>> stats['meanPhen']['repn']['L'], stats['meanPhen']['repn']['H'], stats['fixed']['repn']
+    (-1.5, -1.0, False)
+    """
+
+    stats = dict()
+
+    if not needs:
+        return stats
+
+    geneTypes = list( parameters['genetics'].keys() )
+
+    if isinstance(ecosystem, dict): # popn arrays
+
+        present = ecosystem['present']
+        habCodes = np.broadcast_to( landscape2codes(parameters, landscape)[:,None], present.shape )[present]
+        genes = { geneType: ecosystem['genotype'][geneType][present] for geneType in geneTypes }
+
+        if 'meanPhen' in needs:
+
+            stats['meanPhen'] = dict()
+            for geneType in geneTypes:
+                phens = phenArray(parameters, genes[geneType], geneType)
+                stats['meanPhen'][geneType] = { habType: phens[habCodes == code].mean() if (habCodes == code).any() else np.nan
+                        for code, habType in enumerate( habTypesList(parameters) ) }
+
+        if 'fixed' in needs:
+
+            stats['fixed'] = { geneType: len(genes[geneType]) > 0 and # word by word for packed genes
+                    np.all( np.bitwise_and.reduce(genes[geneType], axis=0) == np.bitwise_or.reduce(genes[geneType], axis=0) ) for geneType in geneTypes }
+
+    else: # list of flocks
+
+        if 'meanPhen' in needs:
+
+            sums = { geneType: { habType: 0 for habType in parameters['habitats'] } for geneType in geneTypes }
+            counts = { habType: 0 for habType in parameters['habitats'] }
+
+            for flock, habType in zip(ecosystem, landscape):
+
+                for adult in flock['adults']:
+
+                    counts[habType] += 1
+                    for geneType in geneTypes:
+                        sums[geneType][habType] += gene2phen( parameters, adult['genotype'][geneType], geneType )
+
+            stats['meanPhen'] = { geneType: { habType: sums[geneType][habType] / counts[habType] if counts[habType] > 0 else np.nan
+                    for habType in counts } for geneType in geneTypes }
+
+        if 'fixed' in needs:
+
+            ands = { geneType: -1 for geneType in geneTypes } # all bits set
+            ors = { geneType: 0 for geneType in geneTypes }
+            noAdults = 0
+
+            for flock in ecosystem:
+
+                for adult in flock['adults']:
+
+                    noAdults += 1
+                    for geneType in geneTypes:
+                        ands[geneType] &= adult['genotype'][geneType]
+                        ors[geneType] |= adult['genotype'][geneType]
+
+            stats['fixed'] = { geneType: noAdults > 0 and ands[geneType] == ors[geneType] for geneType in geneTypes }
+
+    return stats
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,271 @@
+import os
+import copy
+import json
+import time
+import pickle
+import hashlib
+import itertools as it
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from simulate import simulate, parameters2filesuffix
+from carryover import RandomStream
+from landscape import Landscape
+from expected import simulateExpected
+
+# Runs replicates over a grid of parameter values in parallel, e.g.
+#
+#   grid = {
+#       ('competition', 'H'): [1, 10],
+#       ('distMax',): [3, 7],
+#       (('habitats', 'L', 'sd'), ('habitats', 'H', 'sd')): [0.8, 1.11], # several entries set to the same value
+#       ('genetics', 'repn', 'pMut'): [0.001, 0.01],
+#       'landscape': [ landscapeH(51, noH) for noH in [5, 9, 15] ],
+#       }
+#   sweep(parameters, landscape, grid, noReps=20, burnInT=0, tf=600, seed=42)
+#
+# Each run writes its results file as simulate does, with a short hash of its grid values (see runSuffix), as the suffix
+# does not tell apart every grid point, and the replicate number as idxRun, e.g. ecosystems_600_w10_..._g3f2a9c1e_run3.pkl
+#
+# To find the interesting part of a grid first, sweepExpected runs the deterministic expected-value approximation (see
+# expected.py) once for each combination of values, until it settles, in about a second or less a grid point, e.g.
+#
+#   for values, results in sweepExpected(parameters, landscape, grid, tf=2000):
+#       print(values, results['phen']['repn'][-1])
+
+
+def landscapeH(lenLandscape, noH):
+    """
+    landscape = landscapeH(lenLandscape, noH)
+
+    Returns a landscape with a patch of noH 'H' territories in the middle of 'L' territories, as in script.py
+
+    >>> landscapeH(11, 3)
+    'LLLLHHHLLLL'
+    """
+
+    noL = lenLandscape - noH
+
+    return (noL//2)*'L' + noH*'H' + (noL - noL//2)*'L'
+
+def sweepRuns(parameters, landscape, grid, noReps):
+    """
+    runs = sweepRuns(parameters, landscape, grid, noReps)
+
+    Lists the runs of a sweep, one for each combination of grid values and each replicate
+
+    grid:
+        dictionary, keys are paths into parameters (a tuple of keys, or a tuple of such tuples to set several entries to the same value),
+        or 'landscape', and values are lists of values to take
+    runs:
+        list of tuples (values, parameters, landscape, idxRun), where values is a dictionary of the grid values of the run
+
+    >>> parameters = {'distMax': 7, 'competition': {'L': 1, 'H': 10}}
+    >>> runs = sweepRuns(parameters, 'LLHLL', {('competition', 'H'): [1, 10], 'landscape': ['LLHLL', 'LHHHL']}, 2)
+    >>> len(runs)
+    8
+    >>> runs[-1][1]['competition'], runs[-1][2], runs[-1][3]
+    ({'L': 1, 'H': 10}, 'LHHHL', 1)
+    """
+
+    keys = list( grid.keys() )
+    runs = list()
+
+    for combo in it.product( *[ grid[key] for key in keys ] ):
+
+        runParameters = copy.deepcopy(parameters)
+        runLandscape = landscape
+        values = dict()
+
+        for key, value in zip(keys, combo):
+
+            if key == 'landscape':
+
+                runLandscape = value
+                values['landscape'] = value
+
+            else:
+
+                paths = key if isinstance(key[0], tuple) else (key,)
+
+                for path in paths:
+
+                    d = runParameters
+                    for k in path[:-1]:
+                        d = d[k]
+                    d[ path[-1] ] = value
+
+                values['.'.join(paths[0])] = value
+
+        for idxRun in range(noReps):
+            runs.append( (values, runParameters, runLandscape, idxRun) )
+
+    return runs
+
+def runSuffix(parameters, landscape, tf, values):
+    """
+    suffix = runSuffix(parameters, landscape, tf, values)
+
+    The suffix of a sweep run's results file: parameters2filesuffix, which rounds some values and keeps only the length and
+    number of H territories of the landscape, followed by a hash of the run's grid values, so each grid point has its own files
+
+    >>> parameters = { 'distMax': 7, 'competition': {'L': 1, 'H': 10}, 'habitats': {'L': {'sd': 1.11}, 'H': {'sd': 1.11}},
+    ...     'genetics': {'repn': {'pMut': 0.0001, 'noLoci': 20}} }
+    >>> suffixes = [ runSuffix(parameters, landscape, 100, {'landscape': landscape}) for landscape in ['LLHHLL', 'LHLLHL'] ]
+    >>> suffixes[0]
+    '100_w10_d7_H2_L6_sd11_pMut0_nL20_r_geaef5904'
+    >>> suffixes[0] == suffixes[1]
+    False
+    """
+
+    # a Landscape by its habitat types and layout, as its repr gives only its topology and size
+
+    key = { name: ( ''.join(value), value.topology, value.shape, value.edges ) if isinstance(value, Landscape) else value
+            for name, value in values.items() }
+    digest = hashlib.sha1( json.dumps(key, sort_keys=True, default=repr).encode() ).hexdigest()
+
+    return parameters2filesuffix(tf, landscape, parameters) + '_g' + digest[:8]
+
+def runFileName(parameters, landscape, tf, idxRun, record, values):
+    """
+    Returns the name of the results file simulate writes for this run
+    """
+
+    ext = { 'pickle': '.pkl', 'stream': '.stream', 'columns': '.cols' }[record]
+
+    return 'ecosystems' + runSuffix(parameters, landscape, tf, values) + '_run' + str(idxRun) + ext
+
+def runIsComplete(fName):
+    """
+    Checks if a run's results file exists and the run finished (stream and columnar files exist while the run is going)
+    """
+
+    if not os.path.exists(fName):
+
+        return False
+
+    if fName.endswith('.pkl'): # only written at the end
+
+        return True
+
+    if fName.endswith('.stream'):
+
+        from recorder import streamRead
+        header, _ = streamRead(fName)
+
+    else:
+
+        f = open( os.path.join(fName, 'meta.pkl'), 'rb' )
+        header = pickle.load(f)
+        f.close()
+
+    return 't' in header
+
+def _sweepRun(args):
+    """
+    Runs one simulation of a sweep in a worker process, with its own random number streams
+    """
+
+    runParameters, runLandscape, burnInT, tf, idxRun, suffix, seedSeq, engine, record = args
+
+    rng = RandomStream(seedSeq)
+
+    t0 = time.time()
+    simulate(runParameters, runLandscape, burnInT, tf, None, idxRun, suffix, engine=engine, rng=rng, record=record)
+
+    return time.time() - t0
+
+def sweep(parameters, landscape, grid, noReps, burnInT, tf, seed=None, noProcs=None, engine='numpy', record='pickle', manifest='manifest.jsonl'):
+    """
+    sweep(parameters, landscape, grid, noReps, burnInT, tf, seed=None, noProcs=None, engine='numpy', record='pickle', manifest='manifest.jsonl')
+
+    Runs noReps replicates of simulate for every combination of values in grid (see sweepRuns), fanned out over a pool of processes.
+    Runs whose results file is already complete are skipped, so an interrupted sweep can be resumed by calling it again.
+
+    seed:
+        integer, the root seed of the sweep. Each run gets its own independent stream spawned from it (numpy SeedSequence),
+        in the order of sweepRuns, so a given run gets the same stream whatever the order runs finish or are resumed in.
+        If None, fresh entropy is used and recorded in the manifest
+    noProcs:
+        integer, number of worker processes, if None the number of CPUs
+    manifest:
+        string, file name of the manifest, to which a JSON line is appended for each completed run
+        (its file name, grid values, replicate, seed and run time)
+    """
+
+    runs = sweepRuns(parameters, landscape, grid, noReps)
+
+    seedSeq = np.random.SeedSequence(seed)
+    seedSeqs = seedSeq.spawn( len(runs) )
+
+    # each run's results file, which must be its own, e.g. not if the grid repeats a value
+
+    suffixes = [ runSuffix(runParameters, runLandscape, tf, values) for values, runParameters, runLandscape, idxRun in runs ]
+    fNames = [ runFileName(runParameters, runLandscape, tf, idxRun, record, values) for values, runParameters, runLandscape, idxRun in runs ]
+    runValues = dict()
+
+    for fName, (values, runParameters, runLandscape, idxRun) in zip(fNames, runs):
+
+        if fName in runValues:
+            raise ValueError('the runs with grid values ' + repr( runValues[fName] ) + ' and ' + repr(values) + ' would both write ' + fName)
+
+        runValues[fName] = values
+
+    if noProcs is None:
+        noProcs = os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=noProcs) as pool:
+
+        futures = dict()
+
+        for (values, runParameters, runLandscape, idxRun), runSeedSeq, suffix, fName in zip(runs, seedSeqs, suffixes, fNames):
+
+            if runIsComplete(fName): # done in an earlier sweep
+                continue
+
+            args = (runParameters, runLandscape, burnInT, tf, idxRun, suffix, runSeedSeq, engine, record)
+            futures[ pool.submit(_sweepRun, args) ] = (fName, values, idxRun, runSeedSeq)
+
+        for future in as_completed(futures):
+
+            fName, values, idxRun, runSeedSeq = futures[future]
+            runTime = future.result()
+
+            entry = { 'fName': fName, 'values': values, 'idxRun': idxRun,
+                    'seed': {'entropy': runSeedSeq.entropy, 'spawn_key': list(runSeedSeq.spawn_key)}, 'runTime': runTime }
+
+            with open(manifest, 'a') as f:
+                f.write( json.dumps(entry, default=repr) + '\n' ) # a Landscape is written as its repr
+
+def sweepExpected(parameters, landscape, grid, tf, every=None, tol=1e-4):
+    """
+    runs = sweepExpected(parameters, landscape, grid, tf, every=None, tol=1e-4)
+
+    Runs the expected-value approximation (see expected.simulateExpected) for every combination of values in grid (see
+    sweepRuns), to screen the grid before running the stochastic model over it. It is deterministic, so there are no replicates
+
+    every:
+        integer, keep the summary of every this many generations, if None only of the first and last
+    tol:
+        value or None, stop each run once it has settled to within tol (see simulateExpected), or after tf generations
+    runs:
+        list of tuples (values, results), where results is as returned by simulateExpected
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'distMax': 2, 'competition': {'L': 1, 'H': 10},
+    ...     'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0.001} },
+    ...     'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.11}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.11} } }
+    >>> runs = sweepExpected(parameters, landscapeH(21, 3), {('competition', 'H'): [1, 10]}, 100)
+    >>> [ ( values['competition.H'], bool( results['phen']['repn'][-1, 10] > 0 ) ) for values, results in runs ] # adapted to H in the middle?
+    [(1, False), (10, True)]
+    """
+
+    if every is None:
+        every = max(tf, 1)
+
+    return [ ( values, simulateExpected(runParameters, runLandscape, tf, every=every, tol=tol) )
+            for values, runParameters, runLandscape, idxRun in sweepRuns(parameters, landscape, grid, 1) ]
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
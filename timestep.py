@@ -1,57 +1,245 @@
+import time
 import random as random
 
 #import sys
 #sys.path.append("../../current_code/")
 from carryover import noOffspringFnc
-from carryover import gene2bin
 from carryover import offspringGenotypeFnc
-from carryover import dispFnc
-from carryover import compnSimpleFnc
+from carryover import dispGenotypeFnc
+from carryover import compnReservoir, compnOffer, compnWinners
+from carryover import broodFnc
+from carryover import compnClassOffer, compnClassWinners
+from metrics import metricsPhase, metricsArrivals
+from individuals import Individual
 
-def timestep(parameters, ecosystem, landscape):
+def timestep(parameters, ecosystem, landscape, rng=None, stats=None, occupied=None, metrics=None):
+    '''
+    ecosystem, landscape = timestep(parameters, ecosystem, landscape, rng=None, stats=None, occupied=None, metrics=None)
+
+    One generation: reproduction and dispersal, death of all adults, and competition among juveniles.
+    ecosystem is a list of Flocks of Individuals (see individuals.py), e.g. ecosystemSnapshot of an ecosystem of dictionaries.
+    Each pair's brood is made and dispersed in one call (see broodFnc), and the juveniles compete as they arrive
+    (see compnOffer), so only the current winners in each flock are kept.
+    rng is a RandomStream used for every random draw, or None to use the random module.
+    If stats is a dictionary, stats['noPairs'] is set to the number of mating pairs after competition.
+    If occupied is the index of occupied territories (see occupiedIndex), only those flocks and the flocks juveniles
+    arrive at are visited, with the same result, and it is updated in place. Juveniles already waiting in other flocks are ignored.
+    If metrics is a dictionary, the time of each phase and the counts are added to it (see metrics.py)
+    '''
+
+    if rng is None:
+        rng = random
+
+    if metrics is not None:
+        lap = time.perf_counter()
+        arrivals = dict() # the number of juveniles arriving at each flock
+
+    locns = range(len(ecosystem)) if occupied is None else sorted(occupied) # the flocks with adults, in order
+    geneTypes = list( parameters['genetics'] )
+
+    # the competition for the mating-pair positions of each flock juveniles arrive at, including any juveniles already there
+
+    reservoirs = dict()
+
+    for locn in locns:
+
+        if ecosystem[locn].juveniles:
+
+            reservoirs[locn] = compnReservoir(parameters)
+
+            for juvenile in ecosystem[locn].juveniles:
+                compnOffer(parameters, reservoirs[locn], juvenile, rng)
+
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'competition', lap)
 
     # reproduction and dispersal
 
-    for locn, flock in enumerate(ecosystem):
+    for locn in locns:
 
         habType = landscape[locn]
-        adults = flock['adults']
+        adults = ecosystem[locn].adults
+        noOffspring = noOffspringFnc(parameters, adults, habType)
+
+        if noOffspring > 0: # create and disperse the brood
+
+            # rewrite mum and dads genotypes into a dictionary of the form
+            #  {polygenes type: (mum's polygenes, dad's polygenes)}
+            parGenotype = {
+                    geneType: ( adults[0].genotype[geneType], adults[1].genotype[geneType] )
+                    for geneType in geneTypes }
+
+            if metrics is not None:
+                lap = metricsPhase(metrics, 'reproduction', lap)
+
+            sexes, offGenotypes, newLocns = broodFnc(parameters, parGenotype, habType, locn, noOffspring, landscape, rng, metrics)
+
+            if metrics is not None:
+                lap = time.perf_counter() # broodFnc timed its reproduction and dispersal
+
+            # each offspring competes in the flock it arrives at
+
+            for sex, genes, newLocn in zip( sexes, zip( *offGenotypes.values() ), newLocns ):
+
+                offspring = Individual( sex, habType, dict( zip(geneTypes, genes) ) )
+
+                if metrics is not None:
+                    arrivals[newLocn] = arrivals.get(newLocn, 0) + 1
+
+                reservoir = reservoirs.get(newLocn)
+                if reservoir is None:
+                    reservoir = reservoirs[newLocn] = compnReservoir(parameters)
+
+                compnOffer(parameters, reservoir, offspring, rng)
+
+            if metrics is not None:
+                lap = metricsPhase(metrics, 'competition', lap)
+
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'reproduction', lap)
+
+    # survival, all adults assumed to die, and the winners of the competition become the new adults
+
+    noPairs = 0
+    newOccupied = set()
+
+    for locn in set(locns) | reservoirs.keys():
+
+        flock = ecosystem[locn]
+        flock.adults = compnWinners( reservoirs[locn] ) if locn in reservoirs else list()
+        flock.juveniles = list() # all other juveniles die
+        noPairs += len(flock.adults) == 2
+
+        if flock.adults:
+            newOccupied.add(locn)
+
+    if occupied is not None:
+        occupied.clear()
+        occupied.update(newOccupied)
+
+    if stats is not None:
+        stats['noPairs'] = noPairs
+
+    if metrics is not None:
+        metricsPhase(metrics, 'death', lap)
+        metricsArrivals( metrics, arrivals.values() )
+
+    return ecosystem, landscape
+
+def timestepFused(parameters, ecosystem, landscape, rng=None, stats=None, occupied=None, metrics=None):
+    '''
+    ecosystem, landscape = timestepFused(parameters, ecosystem, landscape, rng=None, stats=None, occupied=None, metrics=None)
+
+    The same generation as timestep, with reproduction, dispersal and competition fused so juveniles are never stored.
+    Each flock counts the juveniles of each sex and natal habitat type that arrive and keeps a few candidates of each
+    (see compnClassOffer). Only the genes needed for dispersal ('pref', 'phil' and 'dist') are made before dispersal,
+    and the rest of the genotype is made only for the winners, as recombination and mutation are independent across gene types.
+    occupied and metrics are as in timestep, where 'death' includes making the rest of the winners' genotypes
+    '''
+
+    if rng is None:
+        rng = random
+
+    if metrics is not None:
+        lap = time.perf_counter()
+        arrivals = dict() # the number of juveniles arriving at each flock
+
+    dispGeneTypes = [ geneType for geneType in parameters['genetics'] if geneType in ['pref', 'phil', 'dist'] ]
+    otherGeneTypes = [ geneType for geneType in parameters['genetics'] if geneType not in dispGeneTypes ]
+
+    locns = range(len(ecosystem)) if occupied is None else sorted(occupied) # the flocks with adults, in order
+
+    # the competition in each flock juveniles arrive at, including any juveniles already there, whose genotypes are complete
+
+    classes = dict()
+
+    for locn in locns:
+
+        if ecosystem[locn].juveniles:
+
+            classes[locn] = dict()
+
+            for juvenile in ecosystem[locn].juveniles:
+                compnClassOffer(parameters, classes[locn], juvenile.sex, juvenile.natalHabType, (juvenile.genotype, None), rng)
+
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'competition', lap)
+
+    # reproduction and dispersal
+
+    for locn in locns:
+
+        habType = landscape[locn]
+        adults = ecosystem[locn].adults
         noOffspring = noOffspringFnc(parameters, adults, habType)
 
         if noOffspring > 0: # create and disperse each offspring
 
-            # rewrite mum and dads genotypes as binary strings (saves time to do it first) into a dictionary of the form 
-            #  {polygenes type: (mum's polygenes as binary string, dad's polygenes as binary str)}
-            parGenotypeBin = {
-                    geneType: ( gene2bin(parameters, adults[0]['genotype'][geneType],geneType), gene2bin(parameters, adults[1]['genotype'][geneType],geneType) )
-                    for geneType in parameters['genetics'] }
+            # the parents' genes needed for dispersal, and the rest, in the form {polygenes type: (mum's polygenes, dad's polygenes)}
+            dispParGenotype = { geneType: ( adults[0].genotype[geneType], adults[1].genotype[geneType] ) for geneType in dispGeneTypes }
+            otherParGenotype = { geneType: ( adults[0].genotype[geneType], adults[1].genotype[geneType] ) for geneType in otherGeneTypes }
 
             for cnt in range(noOffspring):
 
-                # create offspring
-                offspring = {
-                        'sex': random.choice( parameters['sexes'] ),
-                        'natalHabType': habType,
-                        'genotype': offspringGenotypeFnc(parameters, parGenotypeBin)
-                        }
+                # create offspring, with only the genes needed for dispersal
+                offspring = Individual( rng.choice( parameters['sexes'] ), habType, offspringGenotypeFnc(parameters, dispParGenotype, rng, metrics) )
 
-                # disperse offspring
-                newLocn = dispFnc(parameters, offspring, locn, landscape)
-                ecosystem[newLocn]['juveniles'].append(offspring)
+                if metrics is not None:
+                    lap = metricsPhase(metrics, 'reproduction', lap)
 
-    # survival
+                # disperse offspring, and it competes in the flock it arrives at
+                newLocn = dispGenotypeFnc(parameters, offspring.genotype, habType, locn, landscape, rng, metrics)
 
-    for flock in ecosystem:
+                if metrics is not None:
+                    lap = metricsPhase(metrics, 'dispersal', lap)
+                    arrivals[newLocn] = arrivals.get(newLocn, 0) + 1
 
-        flock['adults'] = list() # all adults assumed to die
-        # all juveniles live
+                flockClasses = classes.get(newLocn)
+                if flockClasses is None:
+                    flockClasses = classes[newLocn] = dict()
 
-    # competition
+                compnClassOffer(parameters, flockClasses, offspring.sex, habType, (offspring.genotype, otherParGenotype), rng)
 
-    for flock in ecosystem:
+                if metrics is not None:
+                    lap = metricsPhase(metrics, 'competition', lap)
 
-        flock = compnSimpleFnc(parameters, flock) # rearranges each flock according to competition process
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'reproduction', lap)
 
-    return ecosystem, landscape
+    # survival, all adults assumed to die, and the winners of the competition become the new adults
+
+    noPairs = 0
+    newOccupied = set()
+
+    for locn in sorted( set(locns) | classes.keys() ): # in order, as the winners are drawn here
+
+        adults = list()
 
+        for sex, natalHabType, (genotype, otherParGenotype) in compnClassWinners(parameters, classes.get(locn, dict()), rng):
 
+            if otherParGenotype is not None: # make the rest of the winner's genotype
+                genotype.update( offspringGenotypeFnc(parameters, otherParGenotype, rng, metrics) )
+
+            genotype = { geneType: genotype[geneType] for geneType in parameters['genetics'] } # in the usual order
+            adults.append( Individual(sex, natalHabType, genotype) )
+
+        flock = ecosystem[locn]
+        flock.adults = adults
+        flock.juveniles = list() # all other juveniles die
+        noPairs += len(adults) == 2
+
+        if adults:
+            newOccupied.add(locn)
+
+    if occupied is not None:
+        occupied.clear()
+        occupied.update(newOccupied)
+
+    if stats is not None:
+        stats['noPairs'] = noPairs
+
+    if metrics is not None:
+        metricsPhase(metrics, 'death', lap)
+        metricsArrivals( metrics, arrivals.values() )
+
+    return ecosystem, landscape
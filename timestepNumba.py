@@ -0,0 +1,331 @@
+from math import exp, log
+import numpy as np
+
+from timestepVec import landscape2codes, habTypesList
+from carryover import dispersalTables, popcount2phen, RandomStream
+from packedGenes import maxIntLoci
+
+# Compiled version of timestep, which works on the population arrays of timestepVec.py. The generation is done
+# territory by territory and offspring by offspring as in timestep, but in kernels compiled by Numba, so it runs at
+# C-like speed. Each juvenile goes straight into the competition for the territory it disperses to, keeping only the
+# current winners (weighted sampling without replacement by exponential keys, as in timestepVec.compnArray),
+# so juveniles are never stored.
+#
+# If Numba is not installed, the same kernels run as plain Python, which gives the same results but is slow.
+# The kernels draw from numpy's global random state (Numba's own when compiled), seeded from the run's random
+# number stream each generation, so runs are repeatable and can be checkpointed.
+
+try:
+
+    from numba import njit
+
+except ImportError: # run the kernels as plain Python
+
+    def njit(*args, **kwargs):
+
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+
+        return lambda fnc: fnc
+
+
+@njit(cache=True)
+def _seedKernel(seed):
+
+    np.random.seed(seed)
+
+@njit(cache=True)
+def _popcount(gene):
+
+    noOnes = 0
+
+    while gene:
+        gene &= gene - 1
+        noOnes += 1
+
+    return noOnes
+
+@njit(cache=True)
+def _mutationMask(noLoci, pMut):
+
+    # as mutationMaskFnc, drawing the gaps between mutated loci
+
+    if pMut <= 0:
+        return 0
+
+    if pMut >= 1:
+        return (1 << noLoci) - 1
+
+    logq = log(1 - pMut)
+
+    mask = 0
+    posn = int( log( 1 - np.random.random() ) / logq )
+
+    while posn < noLoci:
+
+        mask |= 1 << posn
+        posn += 1 + int( log( 1 - np.random.random() ) / logq )
+
+    return mask
+
+@njit(cache=True)
+def _timestepKernel(present, genes, landCodes, noLoci, pMut, phenTables, noOffspringTable, habParams, geneIdxs, dispMode, distMax,
+        offsetsIn, offsetsOut, counts, codeH, codeL, slotGroups, compnWeights):
+
+    noLocns, noSlots = present.shape
+    noGeneTypes = genes.shape[0]
+    idxRepn, idxDispGene, idxDist = geneIdxs[0], geneIdxs[1], geneIdxs[2]
+
+    # the winners so far in each slot of each territory, ordered by key within each sex
+
+    keys = np.full( (noLocns, noSlots), np.inf )
+    newGenes = np.zeros( (noGeneTypes, noLocns, noSlots), dtype=np.int64 )
+    newNatalHabCodes = np.zeros( (noLocns, noSlots), dtype=np.uint8 )
+
+    offGenes = np.zeros( noGeneTypes, dtype=np.int64 )
+
+    for locn in range(noLocns):
+
+        isPair = True
+        for slot in range(noSlots):
+            isPair = isPair and present[locn, slot]
+
+        if not isPair:
+            continue
+
+        habCode = int( landCodes[locn] )
+
+        # number of offspring, looked up by the pair's total number of 1 alleles, or from the Gaussian function
+
+        noOnes0 = _popcount( genes[idxRepn, locn, 0] )
+        noOnes1 = _popcount( genes[idxRepn, locn, 1] )
+
+        if noOffspringTable.shape[1] > 0:
+            noOffspring = noOffspringTable[habCode, noOnes0 + noOnes1]
+        else:
+            phenPair = ( phenTables[idxRepn, noOnes0] + phenTables[idxRepn, noOnes1] ) / 2
+            rMax, phenOpt, sd = habParams[habCode, 0], habParams[habCode, 1], habParams[habCode, 2]
+            noOffspring = int( round( rMax * exp( - (phenPair - phenOpt)**2 / (2*sd**2) ) ) )
+
+        for cnt in range(noOffspring):
+
+            # sex and genotype, by recombination with a random bitmask and mutation
+
+            sexIdx = int( np.random.random() * noSlots )
+
+            for idxGene in range(noGeneTypes):
+
+                allOnes = (1 << noLoci[idxGene]) - 1
+
+                mask = 0
+                for bit in range(0, noLoci[idxGene], 32):
+                    mask |= int( np.random.random() * 4294967296.0 ) << bit
+                mask &= allOnes
+
+                offGene = ( genes[idxGene, locn, 0] & mask ) | ( genes[idxGene, locn, 1] & ~mask & allOnes )
+                offGenes[idxGene] = offGene ^ _mutationMask( noLoci[idxGene], pMut[idxGene] )
+
+            # dispersal
+
+            if distMax >= 0:
+                dist = distMax
+            else:
+                dist = int( phenTables[idxDist, _popcount( offGenes[idxDist] )] )
+
+            if dispMode == 0: # random dispersal
+
+                newLocn = ( locn + int( np.random.random() * (2*dist+1) ) - dist ) % noLocns
+
+            else: # preference (dispMode 1) or NHPI (dispMode 2), as in dispTablesSample
+
+                phen = phenTables[idxDispGene, _popcount( offGenes[idxDispGene] )]
+
+                if dispMode == 1:
+                    prefHabCode = codeL if phen < 0 else codeH
+                elif phen < 0:
+                    prefHabCode = codeL if habCode == codeH else codeH
+                else:
+                    prefHabCode = habCode
+
+                weight = 1 + abs(phen)
+                nIn = counts[locn, prefHabCode, dist]
+                x = np.random.random() * ( weight*nIn + 2*dist+1 - nIn )
+
+                if x < weight*nIn:
+                    offset = offsetsIn[locn, prefHabCode, min( int(x/weight), nIn-1 )]
+                else:
+                    offset = offsetsOut[locn, prefHabCode, min( int(x - weight*nIn), 2*dist-nIn )]
+
+                newLocn = ( locn + offset ) % noLocns
+
+            # competition, the juvenile takes the first slot of its sex whose holder has a larger key,
+            # and the holders it displaces move down the slots of that sex
+
+            weight = compnWeights[habCode]
+
+            if weight <= 0: # can never win
+                continue
+
+            key = - log( 1 - np.random.random() ) / weight
+            natalHabCode = habCode
+            group = slotGroups[sexIdx]
+
+            for slot in range(noSlots):
+
+                if slotGroups[slot] == group and key < keys[newLocn, slot]:
+
+                    key, keys[newLocn, slot] = keys[newLocn, slot], key
+                    natalHabCode, newNatalHabCodes[newLocn, slot] = int( newNatalHabCodes[newLocn, slot] ), natalHabCode
+
+                    for idxGene in range(noGeneTypes):
+                        offGenes[idxGene], newGenes[idxGene, newLocn, slot] = newGenes[idxGene, newLocn, slot], offGenes[idxGene]
+
+    newPresent = keys < np.inf
+
+    noPairs = 0
+    for locn in range(noLocns):
+
+        isPair = True
+        for slot in range(noSlots):
+            isPair = isPair and newPresent[locn, slot]
+
+        noPairs += isPair
+
+    return newPresent, newGenes, newNatalHabCodes, noPairs
+
+def kernelTables(parameters, landscape):
+    """
+    tables = kernelTables(parameters, landscape)
+
+    The parameters as the arrays passed to the kernel, in the order of its arguments after the population
+
+    >>> parameters = { 'sexes': ('m', 'f'), 'distMax': 2, 'competition': {'L': 1, 'H': 10},
+    ...     'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0.001} },
+    ...     'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.1} } }
+    >>> tables = kernelTables(parameters, 'LLHL')
+    >>> tables['landCodes'], tables['slotGroups'], tables['compnWeights']
+    (array([1, 1, 0, 1], dtype=uint8), array([0, 1]), array([10.,  1.]))
+    """
+
+    if not isinstance(landscape, str) and landscape.topology != 'ring':
+        raise ValueError('the numba engine disperses around a 1-D ring, use the numpy engine for ' + landscape.topology + ' landscapes')
+
+    geneTypes = list( parameters['genetics'].keys() )
+
+    for geneType, geneParams in parameters['genetics'].items():
+        if geneParams['noLoci'] > maxIntLoci or geneParams.get('linkageMap') is not None:
+            raise ValueError('the numba engine holds genes as int64 with free recombination, use the numpy engine for ' + geneType)
+
+    habTypes = habTypesList(parameters)
+    landCodes = landscape2codes(parameters, landscape)
+    modelTables = parameters.get('tables', dict())
+
+    # phenotype of each number of 1 alleles of each gene type, padded to the most loci
+
+    noLoci = np.array( [ parameters['genetics'][geneType]['noLoci'] for geneType in geneTypes ], dtype=np.int64 )
+    phenTables = np.zeros( (len(geneTypes), noLoci.max()+1) )
+
+    for idxGene, geneType in enumerate(geneTypes):
+        phenTables[idxGene, :noLoci[idxGene]+1] = [ popcount2phen(parameters, noOnes, geneType) for noOnes in range(noLoci[idxGene]+1) ]
+
+    # number of offspring, from the parameter model's table if there is one, else (no columns) calculated in the kernel
+
+    if modelTables.get('noOffspringArray') is not None:
+        noOffspringTable = modelTables['noOffspringArray']
+    else:
+        noOffspringTable = np.zeros( (len(habTypes), 0), dtype=np.int64 )
+
+    habParams = np.array( [ [ parameters['habitats'][habType].get(key, 0) for key in ['rMax', 'phenOpt', 'sd'] ] for habType in habTypes ], dtype=float )
+
+    # dispersal
+
+    if 'pref' in geneTypes:
+        dispMode, dispGeneType = 1, 'pref'
+    elif 'phil' in geneTypes:
+        dispMode, dispGeneType = 2, 'phil'
+    else:
+        dispMode, dispGeneType = 0, None
+
+    geneIdxs = np.array( [ geneTypes.index(geneType) if geneType in geneTypes else -1 for geneType in ['repn', dispGeneType, 'dist'] ], dtype=np.int64 )
+    distMax = -1 if parameters['distMax'] is None else parameters['distMax']
+
+    if dispMode == 0: # not needed
+        dispTables = { 'offsetsIn': np.zeros( (1, 1, 1), dtype=np.int32 ), 'offsetsOut': np.zeros( (1, 1, 1), dtype=np.int32 ), 'counts': np.zeros( (1, 1, 1), dtype=np.int64 ) }
+    elif 'disp' in modelTables and modelTables['landCodes'] is landCodes:
+        dispTables = modelTables['disp']
+    else:
+        dispTables = dispersalTables(parameters, landCodes)
+
+    codeH = habTypes.index('H') if 'H' in habTypes else 0
+    codeL = habTypes.index('L') if 'L' in habTypes else 0
+
+    # competition, each slot's sex as the index of the first slot of that sex
+
+    sexes = list( parameters['sexes'] )
+    slotGroups = np.array( [ sexes.index(sex) for sex in sexes ], dtype=np.int64 )
+    compnWeights = np.array( [ parameters['competition'][habType] for habType in habTypes ], dtype=float )
+
+    tables = {
+            'landCodes': landCodes, 'noLoci': noLoci,
+            'pMut': np.array( [ parameters['genetics'][geneType]['pMut'] for geneType in geneTypes ], dtype=float ),
+            'phenTables': phenTables, 'noOffspringTable': noOffspringTable, 'habParams': habParams,
+            'geneIdxs': geneIdxs, 'dispMode': dispMode, 'distMax': distMax,
+            'offsetsIn': dispTables['offsetsIn'], 'offsetsOut': dispTables['offsetsOut'], 'counts': dispTables['counts'],
+            'codeH': codeH, 'codeL': codeL, 'slotGroups': slotGroups, 'compnWeights': compnWeights,
+            }
+
+    return tables
+
+def timestepNumba(parameters, popn, landscape, rng, stats=None, tables=None):
+    """
+    popn, landscape = timestepNumba(parameters, popn, landscape, rng, stats=None, tables=None)
+
+    Compiled version of timestep on the population arrays of timestepVec.py: reproduction, dispersal, death of adults,
+    and competition
+
+    rng:
+        numpy random Generator, or a RandomStream (see carryover.py) whose generator is used, to seed the kernel
+    stats:
+        dictionary or None, if given stats['noPairs'] is set to the number of mating pairs after competition
+    tables:
+        the kernel's arrays from kernelTables, so they need not be rebuilt each generation
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'distMax': 1, 'competition': {'L': 1, 'H': 1},
+    ...     'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0} },
+    ...     'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.1} } }
+    >>> popn = { 'present': np.ones( (3, 2), dtype=bool ), 'natalHabType': np.ones( (3, 2), dtype=np.uint8 ), 'genotype': {'repn': np.full( (3, 2), 31 )} }
+    >>> popn, _ = timestepNumba(parameters, popn, 'LLL', np.random.default_rng(1))
+    >>> popn['present'].all(), (popn['genotype']['repn'] == 31).all() # well-adapted parents fill the landscape with their copies
+    (np.True_, np.True_)
+    """
+
+    if isinstance(rng, RandomStream):
+        rng = rng.generator
+
+    if tables is None:
+        tables = kernelTables(parameters, landscape)
+
+    geneTypes = list( parameters['genetics'].keys() )
+    genes = np.stack( [ popn['genotype'][geneType] for geneType in geneTypes ] )
+
+    _seedKernel( int( rng.integers(2**32) ) )
+
+    present, newGenes, natalHabCodes, noPairs = _timestepKernel( popn['present'], genes, tables['landCodes'], tables['noLoci'], tables['pMut'],
+            tables['phenTables'], tables['noOffspringTable'], tables['habParams'], tables['geneIdxs'], tables['dispMode'], tables['distMax'],
+            tables['offsetsIn'], tables['offsetsOut'], tables['counts'], tables['codeH'], tables['codeL'], tables['slotGroups'], tables['compnWeights'] )
+
+    popn = {
+            'present': present,
+            'natalHabType': natalHabCodes,
+            'genotype': { geneType: newGenes[idxGene] for idxGene, geneType in enumerate(geneTypes) },
+            }
+
+    if stats is not None:
+        stats['noPairs'] = int(noPairs)
+
+    return popn, landscape
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
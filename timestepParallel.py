@@ -0,0 +1,439 @@
+import os
+import time
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+from carryover import offspringGenesArray
+from carryover import RandomStream
+from timestepVec import landscape2codes, noOffspringArray, dispArray, compnKeys, compnArray
+from packedGenes import genesSpec, genesZeros, genesWhere
+from metrics import metricsPhase, metricsCount, metricsTime
+
+# A domain-decomposed version of timestepVec, so one run on a very large landscape can use many cores.
+#
+# The landscape is split into contiguous blocks of territories, each handled by a worker process that lives for the
+# whole run. The population arrays (see timestepVec.py) are held in shared memory, and each worker reads and writes
+# only the rows of its own block. Each generation, on one message from the main process:
+#
+#   1. every worker breeds the mating pairs in its block, disperses the offspring, and draws their competition keys
+#      (see compnKeys) from its own random number stream;
+#   2. juveniles that disperse out of the block are sent straight to the worker that owns their new territory, through
+#      that worker's queue. Only those that could still win there are sent: the juveniles with the smallest keys in each
+#      territory, one per slot of their sex;
+#   3. every worker runs the competition in its block among the juveniles that stayed and those that arrived, and
+#      replies to the main process with its number of mating pairs.
+#
+# Because dispersal is bounded by the dispersal distance, only juveniles born near the edge of a block cross it, and
+# each worker exchanges juveniles only with the workers of the blocks within the dispersal distance (see _blockNeighbours).
+# The main process handles no juveniles and does not copy the population: timestepParallel returns the arrays in shared
+# memory, so its cost per generation does not grow with the population.
+# The winners have the same distribution as in timestepVec, as every juvenile's key is drawn independently,
+# but the random numbers are drawn in a different order, so runs are statistically equivalent rather than identical.
+#
+#   par = parallelOpen(parameters, landscape, popn, noWorkers, rng)
+#   popn = timestepParallel(par, popn, stats)
+#   popn = parallelClose(par) # a copy of the last generation, as the shared memory is freed
+
+
+def _sharedArrays(parameters, noLocns):
+    """
+    Returns the names, shapes and dtypes of the population arrays held in shared memory
+    """
+
+    noSlots = len( parameters['sexes'] )
+    specs = [ ('present', (noLocns, noSlots), np.bool_), ('natalHabType', (noLocns, noSlots), np.uint8) ]
+    specs += [ ('genotype_' + geneType, (noLocns, noSlots) + genesSpec(parameters, geneType)[1], genesSpec(parameters, geneType)[0])
+            for geneType in parameters['genetics'] ]
+
+    return specs
+
+def _popnArrays(specs, shms):
+    """
+    Returns the population dictionary of arrays in the shared memory blocks shms, which must be kept open while they are used
+    """
+
+    arrays = { name: np.ndarray(shape, dtype=dtype, buffer=shm.buf) for (name, shape, dtype), shm in zip(specs, shms) }
+
+    return { 'present': arrays['present'], 'natalHabType': arrays['natalHabType'],
+            'genotype': { name[len('genotype_'):]: array for name, array in arrays.items() if name.startswith('genotype_') } }
+
+def _blockNeighbours(parameters, landscape, bounds):
+    """
+    Returns, for each block, the other blocks its juveniles can disperse to: those with a territory within the dispersal
+    distance of the block on a ring, within as many rows on a grid, and all of them on a graph or if the distance is genetic
+
+    >>> _blockNeighbours( {'distMax': 2}, 20*'L', np.array([0, 5, 10, 15, 20]) )
+    [[1, 3], [0, 2], [1, 3], [0, 2]]
+    >>> _blockNeighbours( {'distMax': None}, 20*'L', np.array([0, 10, 20]) )
+    [[1], [0]]
+    """
+
+    noLocns = len(landscape)
+    noBlocks = len(bounds) - 1
+    distMax = parameters.get('distMax')
+
+    if distMax is None or not ( isinstance(landscape, str) or landscape.topology in ['ring', 'torus', 'bounded'] ):
+        return [ [ j for j in range(noBlocks) if j != i ] for i in range(noBlocks) ]
+
+    if isinstance(landscape, str) or landscape.topology == 'ring':
+        reach = distMax
+    else: # a territory distMax king moves away is at most distMax rows and a row's length away
+        reach = distMax * landscape.shape[1] + landscape.shape[1] - 1
+
+    neighbours = list()
+
+    for i in range(noBlocks):
+
+        start, stop = bounds[i], bounds[i+1]
+
+        if stop - start + 2*reach >= noLocns:
+            neighbours.append( [ j for j in range(noBlocks) if j != i ] )
+        else:
+            blockIdxs = np.unique( np.searchsorted( bounds, np.arange(start - reach, stop + reach) % noLocns, side='right' ) - 1 )
+            neighbours.append( [ int(j) for j in blockIdxs if j != i ] )
+
+    return neighbours
+
+def _blockBreed(parameters, popn, landCodes, dispLandscape, start, stop, rng):
+    """
+    Reproduction and dispersal of the mating pairs in the block start:stop. Returns the juveniles that stay in the block,
+    and those leaving it that could win where they arrive, each as a dictionary of arrays
+    """
+
+    sexes = parameters['sexes']
+    blockPopn = { 'present': popn['present'][start:stop], 'genotype': { geneType: genes[start:stop] for geneType, genes in popn['genotype'].items() } }
+
+    # reproduction
+
+    pairLocns, noOffspring = noOffspringArray(parameters, blockPopn, landCodes[start:stop])
+    parentLocns = np.repeat( pairLocns, noOffspring )
+
+    juveniles = {
+            'sexIdxs': rng.integers( 0, len(sexes), size=len(parentLocns) ),
+            'natalHabCodes': landCodes[start + parentLocns],
+            'genotype': { geneType: offspringGenesArray( parameters, genes[parentLocns,0], genes[parentLocns,1], geneType, rng )
+                for geneType, genes in blockPopn['genotype'].items() },
+            }
+
+    # dispersal, and the keys for the competition
+
+    juveniles['locns'] = dispArray(parameters, juveniles['genotype'], juveniles['natalHabCodes'], start + parentLocns, landCodes, rng, dispLandscape)
+    juveniles['keys'] = compnKeys(parameters, juveniles['natalHabCodes'], rng)
+
+    # the juveniles leaving the block that win the competition among those leaving for the same territory
+
+    staying = (juveniles['locns'] >= start) & (juveniles['locns'] < stop)
+    leaving = _juvenilesSelect( juveniles, ~staying )
+
+    destLocns, destIdxs = np.unique( leaving['locns'], return_inverse=True )
+    winners = compnArray(parameters, leaving['sexIdxs'], leaving['natalHabCodes'], destIdxs, len(destLocns), rng, leaving['keys'])
+
+    return _juvenilesSelect( juveniles, staying ), _juvenilesSelect( leaving, np.sort( winners[winners >= 0] ) )
+
+def _juvenilesSelect(juveniles, idxs):
+
+    return { key: ( { geneType: genes[idxs] for geneType, genes in value.items() } if key == 'genotype' else value[idxs] )
+            for key, value in juveniles.items() }
+
+def _juvenilesConcatenate(juvenilesList):
+
+    return { key: ( { geneType: np.concatenate( [ juveniles['genotype'][geneType] for juveniles in juvenilesList ] ) for geneType in value }
+                if key == 'genotype' else np.concatenate( [ juveniles[key] for juveniles in juvenilesList ] ) )
+            for key, value in juvenilesList[0].items() }
+
+def _blockCompete(parameters, popn, juveniles, start, stop, rng):
+    """
+    Competition in the block start:stop among the juveniles arriving there, whose winners become the block's adults
+    in the shared arrays. Returns the number of mating pairs in the block
+    """
+
+    winners = compnArray(parameters, juveniles['sexIdxs'], juveniles['natalHabCodes'], juveniles['locns'] - start, stop - start, rng, juveniles['keys'])
+    present = winners >= 0
+    winners[~present] = 0 # dummy index for empty slots, masked below
+
+    if len( juveniles['locns'] ) == 0: # nobody to fill the slots
+
+        juveniles = dict( juveniles, natalHabCodes=np.zeros(1, dtype=np.uint8),
+                genotype={ geneType: genesZeros( parameters, geneType, (1,) ) for geneType in juveniles['genotype'] } )
+
+    popn['present'][start:stop] = present
+    popn['natalHabType'][start:stop] = np.where( present, juveniles['natalHabCodes'][winners], 0 )
+
+    for geneType, genes in juveniles['genotype'].items():
+        popn['genotype'][geneType][start:stop] = genesWhere( present, genes[winners] )
+
+    return int( present.all(axis=1).sum() )
+
+def _blockWorker(conn, parameters, landscape, bounds, idxBlock, sendTo, noFrom, queues, specs, shmNames, seedSeq):
+    """
+    The loop of the worker process for the block idxBlock, bounds[idxBlock]:bounds[idxBlock+1], which carries out the steps
+    sent by the main process, sending the juveniles that leave the block to the queues of the blocks sendTo, and
+    receiving those of noFrom blocks from its own queue
+    """
+
+    start, stop = bounds[idxBlock], bounds[idxBlock+1]
+
+    shms = [ SharedMemory(name=shmName) for shmName in shmNames ]
+    popn = _popnArrays(specs, shms)
+    rng = np.random.default_rng(seedSeq)
+    landscape = parameters.get('tables', dict()).get('landscape', landscape) # the same object as in a model, so its tables are used
+    landCodes = landscape2codes(parameters, landscape)
+    dispLandscape = None if isinstance(landscape, str) or landscape.topology == 'ring' else landscape
+
+    while True:
+
+        step, arg = conn.recv()
+
+        if step == 'step':
+
+            lap = time.perf_counter()
+            times = list()
+
+            staying, leaving = _blockBreed(parameters, popn, landCodes, dispLandscape, start, stop, rng)
+            times.append( time.perf_counter() - lap ); lap += times[-1]
+
+            # send the juveniles leaving to the block they arrive at, and gather those arriving, in the order of the
+            # blocks they come from, so the competition does not depend on which arrives first
+
+            blockIdxs = np.searchsorted( bounds, leaving['locns'], side='right' ) - 1
+
+            for j in sendTo:
+                queues[j].put( ( idxBlock, _juvenilesSelect( leaving, np.flatnonzero( blockIdxs == j ) ) ) )
+
+            arriving = sorted( [ queues[idxBlock].get() for cnt in range(noFrom) ], key=lambda arrival: arrival[0] )
+            times.append( time.perf_counter() - lap ); lap += times[-1]
+
+            noPairs = _blockCompete(parameters, popn, _juvenilesConcatenate( [staying] + [ juveniles for i, juveniles in arriving ] ), start, stop, rng)
+            times.append( time.perf_counter() - lap )
+
+            conn.send( ( noPairs, len( leaving['locns'] ), times ) )
+
+        elif step == 'getState':
+
+            conn.send( rng.bit_generator.state )
+
+        elif step == 'setState':
+
+            rng.bit_generator.state = arg
+            conn.send(None)
+
+        else: # 'close'
+
+            break
+
+    del popn
+    for shm in shms:
+        shm.close()
+
+def parallelOpen(parameters, landscape, popn, noWorkers=None, rng=None, states=None):
+    """
+    par = parallelOpen(parameters, landscape, popn, noWorkers=None, rng=None, states=None)
+
+    Starts the worker processes of timestepParallel, and puts the population in shared memory
+
+    parameters:
+        dictionary, a parameter model (see carryover.parameterModel) built with this landscape
+    popn:
+        dictionary of arrays, the population (see timestepVec.py)
+    noWorkers:
+        integer, the number of worker processes, each handling a block of territories. If None, the number of CPUs
+    rng:
+        RandomStream (see carryover.py), whose child streams (one per worker) are used by the workers
+    states:
+        list of the workers' random number generator states (see parallelStates), to carry on a run from a checkpoint
+    par:
+        dictionary, with the worker processes, their connections and queues, and the shared memory, to pass to timestepParallel
+
+    >>> parameters = { 'sexes': ('h', 'h'), 'distMax': 2, 'competition': {'L': 1, 'H': 10},
+    ...     'genetics': { 'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False, 'pMut': 0} },
+    ...     'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt': 1, 'sd': 1.1} } }
+    >>> popn = { 'present': np.ones((40, 2), dtype=bool), 'natalHabType': np.ones((40, 2), dtype=np.uint8), 'genotype': {'repn': np.full((40, 2), 31)} }
+    >>> par = parallelOpen(parameters, 40*'L', popn, noWorkers=2, rng=RandomStream(1))
+    >>> popn = timestepParallel(par, popn)
+    >>> popn = parallelClose(par)
+    >>> popn['present'].all(), (popn['genotype']['repn'] == 31).all() # well-adapted parents fill the landscape with their copies
+    (np.True_, np.True_)
+    """
+
+    if rng is None:
+        rng = RandomStream()
+
+    noLocns = len(landscape)
+    noWorkers = min( noWorkers or os.cpu_count(), noLocns )
+
+    if states is not None and len(states) != noWorkers:
+        raise ValueError('there are ' + str( len(states) ) + ' worker states to carry on from, but ' + str(noWorkers) + ' workers')
+    bounds = np.linspace( 0, noLocns, noWorkers+1 ).astype(int) # each worker's block is bounds[i]:bounds[i+1]
+
+    # the population arrays in shared memory
+
+    specs = _sharedArrays(parameters, noLocns)
+    shms = [ SharedMemory( create=True, size=max( int( np.prod(shape) ) * np.dtype(dtype).itemsize, 1 ) ) for name, shape, dtype in specs ]
+    shmNames = [ shm.name for shm in shms ]
+
+    # the workers, each with its own random number stream
+
+    seedSeqs = [ childRng.seedSeq for childRng in rng.spawn(noWorkers) ]
+    conns = list(); procs = list()
+
+    # a queue for each worker, into which its neighbours put the juveniles arriving in its block
+
+    queues = [ mp.Queue() for i in range(noWorkers) ]
+    sendTo = _blockNeighbours(parameters, landscape, bounds)
+    noFrom = [ sum( i in blocks for blocks in sendTo ) for i in range(noWorkers) ]
+
+    for i in range(noWorkers):
+
+        conn, workerConn = mp.Pipe()
+        proc = mp.Process( target=_blockWorker, args=(workerConn, parameters, landscape, bounds, i, sendTo[i], noFrom[i], queues, specs, shmNames, seedSeqs[i]), daemon=True )
+        proc.start()
+        workerConn.close() # only the worker's end is open, so the main process gets EOFError if the worker stops
+        conns.append(conn); procs.append(proc)
+
+    par = { 'bounds': bounds, 'conns': conns, 'procs': procs, 'queues': queues, 'shms': shms, 'popn': _popnArrays(specs, shms) }
+
+    if states is not None:
+
+        for conn, state in zip(conns, states):
+            conn.send( ('setState', state) )
+        _workersRecv(par)
+
+    _popnCopy(popn, par['popn'])
+
+    return par
+
+def _workerRecv(conn, proc):
+    """
+    Receives a worker's reply, raising an error instead of waiting forever if the worker has stopped (e.g. it raised an exception)
+    """
+
+    try:
+
+        return conn.recv()
+
+    except EOFError:
+
+        proc.join()
+        raise RuntimeError('worker process ' + proc.name + ' stopped, with exit code ' + str(proc.exitcode)) from None
+
+def _workersRecv(par):
+    """
+    Receives every worker's reply, in the order of the blocks. A worker can be left waiting for juveniles from a worker
+    that has stopped, so the replies are taken as they come, and an error is raised as soon as any worker stops
+    """
+
+    conns = par['conns']
+    procs = par['procs']
+    replies = [None] * len(conns)
+    waiting = set( range( len(conns) ) )
+
+    while waiting:
+
+        ready = set( mp.connection.wait( [ conns[i] for i in waiting ] + [ procs[i].sentinel for i in waiting ] ) )
+
+        for i in list(waiting):
+            if conns[i] in ready or procs[i].sentinel in ready:
+                replies[i] = _workerRecv(conns[i], procs[i])
+                waiting.remove(i)
+
+    return replies
+
+def _popnCopy(popnFrom, popnTo):
+
+    popnTo['present'][:] = popnFrom['present']
+    popnTo['natalHabType'][:] = popnFrom['natalHabType']
+
+    for geneType, genes in popnFrom['genotype'].items():
+        popnTo['genotype'][geneType][:] = genes
+
+def timestepParallel(par, popn, stats=None, metrics=None):
+    """
+    popn = timestepParallel(par, popn, stats=None, metrics=None)
+
+    One generation of timestepVec, with each block of territories handled by one of the worker processes started by parallelOpen
+
+    popn:
+        dictionary of arrays, the population (see timestepVec.py). If it is not the one the last generation returned,
+        it is copied into shared memory, so it can be changed between generations (e.g. when carrying on from a checkpoint)
+        The population returned is the arrays in shared memory, not a copy, so the next generation overwrites it, and
+        anything to be kept (e.g. a recorded generation) must be copied
+    stats:
+        dictionary or None, if given stats['noPairs'] is set to the number of mating pairs after competition
+    metrics:
+        dictionary or None, if given the time the slowest worker took in each round and the juveniles exchanged are added
+        to it (see metrics.py)
+    """
+
+    if popn is not par['popn']:
+        _popnCopy(popn, par['popn'])
+
+    # every block breeds, exchanges the juveniles leaving it with its neighbours, and runs its competition
+
+    for conn in par['conns']:
+        conn.send( ('step', None) )
+
+    replies = _workersRecv(par)
+
+    if metrics is not None:
+
+        for phase, times in zip( ['breed', 'exchange', 'compete'], zip( *[ times for noPairs, noExchanged, times in replies ] ) ):
+            metricsTime( metrics, phase, max(times) )
+
+        metricsCount( metrics, 'exchanged', sum( noExchanged for noPairs, noExchanged, times in replies ) )
+
+    if stats is not None:
+        stats['noPairs'] = sum( noPairs for noPairs, noExchanged, times in replies )
+
+    return par['popn']
+
+def parallelStates(par):
+    """
+    Returns the states of the workers' random number generators, e.g. to save in a checkpoint
+    """
+
+    for conn in par['conns']:
+        conn.send( ('getState', None) )
+
+    return _workersRecv(par)
+
+def parallelClose(par):
+    """
+    popn = parallelClose(par)
+
+    Stops the worker processes and frees the shared memory, returning a copy of the population in it, the last generation,
+    to use in place of the arrays timestepParallel returned
+    """
+
+    for conn in par['conns']:
+        try:
+            conn.send( ('close', None) )
+        except OSError: # the worker has already stopped, e.g. after an error
+            pass
+
+    for proc in par['procs']:
+
+        if any( proc.exitcode not in [None, 0] for proc in par['procs'] ): # a worker failed, so the others may be left waiting for its juveniles
+            proc.terminate()
+
+        proc.join()
+
+    popn = { 'present': par['popn']['present'].copy(), 'natalHabType': par['popn']['natalHabType'].copy(),
+            'genotype': { geneType: genes.copy() for geneType, genes in par['popn']['genotype'].items() } }
+
+    par['popn'] = None
+    for shm in par['shms']:
+
+        try:
+            shm.close()
+        except BufferError: # arrays in it are still held, e.g. by the traceback of an error, and it is unmapped when they go
+            pass
+
+        shm.unlink()
+
+    return popn
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,462 @@
+import time
+import numpy as np
+
+from carryover import offspringGenesArray
+from carryover import dispTablesSample
+from carryover import RandomStream
+from landscape import landscapeCodes
+from packedGenes import isPacked, genesZeros, packGenes, unpackGenes, popcountGenes, genesWhere
+from metrics import metricsPhase, metricsCount, metricsArrivals
+
+# A structure-of-arrays version of the ecosystem and of timestep.
+#
+# Instead of a list of flock dictionaries, the population (popn) is held as arrays with one row per
+# territory and one column per mating-pair position (slot), where the slots are in the order of parameters['sexes']:
+#
+#   popn = {
+#       'present':      boolean array (noLocns, noSlots), True if an adult holds that slot
+#       'natalHabType': uint8 array (noLocns, noSlots), index into habTypesList(parameters)
+#       'genotype':     dictionary, keys are gene types and values int64 arrays (noLocns, noSlots)
+#       }
+#
+# so the sex of an adult is given by the slot it holds. Genes of more than 62 loci are held as packed words instead, uint64
+# arrays (noLocns, noSlots, noWords) (see packedGenes.py).
+
+
+def habTypesList(parameters):
+    """
+    habTypes = habTypesList(parameters)
+
+    Returns the habitat types in the order used to code them as integers in the arrays
+
+    >>> parameters = { 'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt':  1, 'sd': 1.1}, } }
+    >>> habTypesList(parameters)
+    ['H', 'L']
+    """
+
+    if 'tables' in parameters:
+        return parameters['tables']['habTypes']
+
+    return sorted( parameters['habitats'].keys() )
+
+def landscape2codes(parameters, landscape):
+    """
+    landCodes = landscape2codes(parameters, landscape)
+
+    Turns the landscape string, or Landscape (see landscape.py), into an array of habitat-type codes
+
+    >>> parameters = { 'habitats': { 'L': {'rMax': 10, 'phenOpt': -1, 'sd': 1.1}, 'H': {'rMax': 10, 'phenOpt':  1, 'sd': 1.1}, } }
+    >>> landscape2codes(parameters, 'LLHHL')
+    array([1, 1, 0, 0, 1], dtype=uint8)
+    """
+
+    if 'tables' in parameters and parameters['tables'].get('landscape') == landscape: # already in the parameter model
+        return parameters['tables']['landCodes']
+
+    return landscapeCodes( landscape, habTypesList(parameters) )
+
+def phenArray(parameters, genes, geneType):
+    """
+    phens = phenArray(parameters, genes, geneType)
+
+    Array version of gene2phen
+
+    >>> parameters = {'genetics': {'repn': {'noLoci': 20, 'maxPhen': 2, 'minPhen': -2, 'isInt': False} } }
+    >>> phenArray(parameters, np.array([0, 31, 2**20-1]), 'repn')
+    array([-2., -1.,  2.])
+    """
+
+    if 'tables' in parameters: # a parameter model, so look up the phenotype of each number of 1 alleles
+        return parameters['tables']['phenArray'][geneType][ popcountGenes(genes) ]
+
+    maxPhen = parameters['genetics'][geneType]['maxPhen']
+    minPhen = parameters['genetics'][geneType]['minPhen']
+    noLoci = parameters['genetics'][geneType]['noLoci']
+
+    phens = minPhen + ( popcountGenes(genes) / noLoci ) * ( maxPhen - minPhen )
+
+    if parameters['genetics'][geneType]['isInt']:
+        phens = np.round(phens).astype(np.int64)
+
+    return phens
+
+def ecosystem2popn(parameters, ecosystem):
+    """
+    popn = ecosystem2popn(parameters, ecosystem)
+
+    Converts the list-of-flocks ecosystem into the array form popn. Each adult is put in the first
+    free slot of its sex, or the first free slot if none match (e.g. hermaphrodites in an initial ecosystem when sexes is ('m','f')).
+
+    >>> parameters = { 'sexes': ('m', 'f'), 'genetics': {'repn': {'noLoci': 20} }, 'habitats': {'L': {}, 'H': {}} }
+    >>> ecosystem = [ {'adults': [{'sex': 'f', 'natalHabType': 'L', 'genotype': {'repn': 31}}], 'juveniles': []}, {'adults': [], 'juveniles': []} ]
+    >>> popn = ecosystem2popn(parameters, ecosystem)
+    >>> popn['present']
+    array([[False,  True],
+           [False, False]])
+    >>> popn['genotype']['repn'][0,1]
+    np.int64(31)
+    """
+
+    sexes = parameters['sexes']
+    habTypes = habTypesList(parameters)
+    noLocns = len(ecosystem)
+    noSlots = len(sexes)
+
+    popn = {
+            'present': np.zeros( (noLocns, noSlots), dtype=bool ),
+            'natalHabType': np.zeros( (noLocns, noSlots), dtype=np.uint8 ),
+            'genotype': { geneType: genesZeros( parameters, geneType, (noLocns, noSlots) ) for geneType in parameters['genetics'] },
+            }
+
+    for locn, flock in enumerate(ecosystem):
+
+        for adult in flock['adults']:
+
+            free = [ slot for slot in range(noSlots) if not popn['present'][locn, slot] ]
+            matching = [ slot for slot in free if sexes[slot] == adult['sex'] ]
+            slot = matching[0] if matching else free[0]
+
+            popn['present'][locn, slot] = True
+            popn['natalHabType'][locn, slot] = habTypes.index( adult['natalHabType'] )
+
+            for geneType, geneParams in parameters['genetics'].items():
+                if isPacked(parameters, geneType):
+                    popn['genotype'][geneType][locn, slot] = packGenes( [ adult['genotype'][geneType] ], geneParams['noLoci'] )[0]
+                else:
+                    popn['genotype'][geneType][locn, slot] = adult['genotype'][geneType]
+
+    return popn
+
+def popn2ecosystem(parameters, popn):
+    """
+    ecosystem = popn2ecosystem(parameters, popn)
+
+    Converts the array form popn back into the list-of-flocks ecosystem, e.g. for storing in the pickle file
+
+    >>> parameters = { 'sexes': ('m', 'f'), 'genetics': {'repn': {'noLoci': 20} }, 'habitats': {'L': {}, 'H': {}} }
+    >>> ecosystem = [ {'adults': [{'sex': 'f', 'natalHabType': 'L', 'genotype': {'repn': 31}}], 'juveniles': []}, {'adults': [], 'juveniles': []} ]
+    >>> popn2ecosystem(parameters, ecosystem2popn(parameters, ecosystem)) == ecosystem
+    True
+    >>> parameters['genetics']['repn']['noLoci'] = 100 # packed genes
+    >>> ecosystem[0]['adults'][0]['genotype']['repn'] = 2**99 + 31
+    >>> popn2ecosystem(parameters, ecosystem2popn(parameters, ecosystem)) == ecosystem
+    True
+    """
+
+    sexes = parameters['sexes']
+    habTypes = habTypesList(parameters)
+    geneTypes = list( parameters['genetics'].keys() )
+
+    present = popn['present'].tolist()
+    natalHabType = popn['natalHabType'].tolist()
+    genotype = { geneType: unpackGenes( popn['genotype'][geneType] ) if isPacked(parameters, geneType) else popn['genotype'][geneType].tolist()
+            for geneType in geneTypes }
+
+    ecosystem = [ {
+                'adults': [ {
+                    'sex': sexes[slot],
+                    'natalHabType': habTypes[ natalHabType[locn][slot] ],
+                    'genotype': { geneType: genotype[geneType][locn][slot] for geneType in geneTypes } }
+                    for slot, isPresent in enumerate(presentLocn) if isPresent ],
+                'juveniles': list(),
+                }
+        for locn, presentLocn in enumerate(present) ]
+
+    return ecosystem
+
+def popnIsEmpty(popn):
+    """
+    Array version of ecosystemIsEmpty, returns True if there is no mating pair in popn
+    """
+
+    return not popn['present'].all(axis=1).any()
+
+def noOffspringArray(parameters, popn, landCodes):
+    """
+    pairLocns, noOffspring = noOffspringArray(parameters, popn, landCodes)
+
+    Array version of noOffspringFnc, returning the locations of the mating pairs and how many offspring each has
+    """
+
+    habTypes = habTypesList(parameters)
+
+    pairLocns = np.flatnonzero( popn['present'].all(axis=1) )
+    habCodes = landCodes[pairLocns]
+
+    if 'tables' in parameters and parameters['tables']['noOffspringArray'] is not None:
+
+        # a parameter model, so look up the number of offspring for each pair's total number of 1 alleles
+        noOnes = popcountGenes( popn['genotype']['repn'][pairLocns] ).sum(axis=1)
+
+        return pairLocns, parameters['tables']['noOffspringArray'][habCodes, noOnes]
+
+    # get the reproductive phenotype of each pair
+
+    phenPair = phenArray( parameters, popn['genotype']['repn'][pairLocns], 'repn' ).mean(axis=1)
+
+    # get the attributes of each pair's habitat type that relate to reproduction
+
+    rMax = np.array( [ parameters['habitats'][habType]['rMax'] for habType in habTypes ] )[habCodes]
+    phenOpt = np.array( [ parameters['habitats'][habType]['phenOpt'] for habType in habTypes ] )[habCodes]
+    sd = np.array( [ parameters['habitats'][habType]['sd'] for habType in habTypes ] )[habCodes]
+
+    # calculate the number of offspring each pair will have based on the Gaussian function
+
+    noOffspring = np.round( rMax * np.exp( - (phenPair - phenOpt)**2 / (2*sd**2) ) ).astype(np.int64)
+
+    return pairLocns, noOffspring
+
+def dispArray(parameters, genotype, natalHabCodes, locns, landCodes, rng, landscape=None, metrics=None):
+    """
+    newLocns = dispArray(parameters, genotype, natalHabCodes, locns, landCodes, rng, landscape=None, metrics=None)
+
+    Array version of dispFnc, finds the new locations of all offspring after dispersal
+
+    genotype:
+        dictionary, keys are gene types and values are arrays of the offspring's genes
+    natalHabCodes:
+        array, the code of each offspring's natal habitat type
+    locns:
+        array, the location each offspring was born in
+    landCodes:
+        array, the habitat type code of each location in the landscape
+    landscape:
+        a Landscape (see landscape.py) other than a 1-D ring, or None for a ring
+    metrics:
+        dictionary or None, if given the locations proposed are counted in it (see metrics.py)
+    """
+
+    habTypes = habTypesList(parameters)
+    lenLandscape = len(landCodes)
+    noOffspring = len(locns)
+
+    if metrics is not None: # one location proposed each, and one more for each rejected below
+        metricsCount(metrics, 'dispersalDraws', noOffspring)
+
+    # find the maximum dispersal distance of each offspring
+
+    if parameters['distMax'] is None:
+        distMax = phenArray( parameters, genotype['dist'], 'dist' ).astype(np.int64)
+    else:
+        distMax = np.full( noOffspring, parameters['distMax'], dtype=np.int64 )
+
+    isRandom = ('pref' not in genotype) and ('phil' not in genotype) # assume random dispersal
+
+    if isRandom and landscape is None:
+
+        newLocns = ( locns + rng.integers(-distMax, distMax+1) ) % lenLandscape
+
+    else: # has genes controlling habitat type preferences, or disperses across a grid or graph
+
+        if isRandom: # every habitat type weighted 1
+
+            prefHabCodes = natalHabCodes; phen = np.zeros(noOffspring)
+
+        elif 'pref' in genotype: # preference by habitat type, positive prefers 'H' and negative prefers 'L'
+
+            codeH = habTypes.index('H'); codeL = habTypes.index('L')
+            phen = phenArray( parameters, genotype['pref'], 'pref' )
+            prefHabCodes = np.where( phen < 0, codeL, codeH )
+
+        else: # preference by NHPI, positive prefers natal habitat type and negative prefers non-natal
+
+            codeH = habTypes.index('H'); codeL = habTypes.index('L')
+            phen = phenArray( parameters, genotype['phil'], 'phil' )
+            otherHabCodes = np.where( natalHabCodes == codeH, codeL, codeH )
+            prefHabCodes = np.where( phen < 0, otherHabCodes, natalHabCodes )
+
+        weight = 1 + np.abs(phen)
+
+        tables = parameters.get('tables', dict())
+
+        if landscape is not None: # choose uniformly in each neighbourhood, and accept with probability weight/maximum weight
+
+            newLocns = np.full( noOffspring, -1, dtype=np.int64 )
+            todo = np.arange(noOffspring)
+
+            while len(todo) > 0:
+
+                proposed = landscape.proposeArray( locns[todo], distMax[todo], rng.random( len(todo) ) )
+                proposedWeights = np.where( landCodes[proposed] == prefHabCodes[todo], weight[todo], 1.0 )
+                accept = ( proposed >= 0 ) & ( rng.random( len(todo) ) * weight[todo] < proposedWeights ) # -1 is off the edge of a bounded grid
+
+                newLocns[ todo[accept] ] = proposed[accept]
+                todo = todo[~accept]
+
+                if metrics is not None:
+                    metricsCount( metrics, 'dispersalDraws', len(todo) )
+
+            return newLocns
+
+        if 'disp' in tables and tables['landCodes'] is landCodes: # use the precomputed neighbourhoods
+
+            newLocns = ( locns + dispTablesSample( tables['disp'], locns, prefHabCodes, weight, distMax, rng.random(noOffspring) ) ) % lenLandscape
+
+            return newLocns
+
+        # weight each location in the neighbourhood, giving 0 to those beyond each offspring's dispersal distance
+
+        offsets = np.arange( -distMax.max(), distMax.max()+1 ) if noOffspring > 0 else np.zeros(1, dtype=np.int64)
+        neighbourLocns = ( locns[:,None] + offsets[None,:] ) % lenLandscape
+        neighbourWeights = np.where( landCodes[neighbourLocns] == prefHabCodes[:,None], weight[:,None], 1.0 )
+        neighbourWeights[ np.abs(offsets)[None,:] > distMax[:,None] ] = 0
+
+        # weighted choice of a new location, as in randIdxWeights
+
+        cumWeights = np.cumsum(neighbourWeights, axis=1)
+        r = rng.random(noOffspring) * cumWeights[:,-1]
+        idxs = ( cumWeights <= r[:,None] ).sum(axis=1)
+        newLocns = neighbourLocns[ np.arange(noOffspring), idxs ]
+
+    return newLocns
+
+def compnKeys(parameters, natalHabCodes, rng):
+    """
+    keys = compnKeys(parameters, natalHabCodes, rng)
+
+    The exponential keys (Efraimidis-Spirakis) of juveniles in the competition, exponentially distributed with rate
+    the weighting of their natal habitat type, so in each location the juveniles with the smallest keys are the winners.
+    Juveniles with zero weight can never win and get the key inf
+    """
+
+    habTypes = habTypesList(parameters)
+
+    compnWeights = np.array( [ parameters['competition'][habType] for habType in habTypes ], dtype=float )[natalHabCodes]
+
+    canWin = compnWeights > 0
+    keys = np.full( len(natalHabCodes), np.inf )
+    keys[canWin] = rng.exponential( size=canWin.sum() ) / compnWeights[canWin]
+
+    return keys
+
+def compnArray(parameters, sexIdxs, natalHabCodes, newLocns, noLocns, rng, keys=None):
+    """
+    winners = compnArray(parameters, sexIdxs, natalHabCodes, newLocns, noLocns, rng, keys=None)
+
+    Array version of compnSimpleFnc assuming all positions are open. For each location and slot,
+    a juvenile of the slot's sex is chosen by weighted choice without replacement, the weighting determined
+    by natal habitat type. Uses exponential keys (see compnKeys), so the juveniles with the smallest keys
+    in each location are the winners.
+
+    sexIdxs:
+        array, index into parameters['sexes'] of each juvenile's sex
+    keys:
+        array, the juveniles' keys if already drawn (e.g. by another process), else they are drawn with rng
+    winners:
+        array (noLocns, noSlots), index of the winning juvenile in each slot, or -1 if nobody took it
+    """
+
+    sexes = parameters['sexes']
+
+    if keys is None:
+        keys = compnKeys(parameters, natalHabCodes, rng)
+
+    # juveniles with zero weight can never win
+
+    canWin = np.isfinite(keys)
+
+    winners = np.full( (noLocns, len(sexes)), -1, dtype=np.int64 )
+
+    for sex in set(sexes):
+
+        slots = [ slot for slot, s in enumerate(sexes) if s == sex ]
+
+        # candidates of this sex, sorted by location then key
+
+        cands = np.flatnonzero( canWin & np.isin( sexIdxs, slots ) )
+        cands = cands[ np.lexsort( (keys[cands], newLocns[cands]) ) ]
+        candLocns = newLocns[cands]
+
+        # rank of each candidate within its location
+
+        starts = np.flatnonzero( np.r_[True, candLocns[1:] != candLocns[:-1]] ) if len(cands) else np.zeros(0, dtype=np.int64)
+        ranks = np.arange( len(cands) ) - np.repeat( starts, np.diff( np.r_[starts, len(cands)] ) )
+
+        # the r-th ranked candidate takes the r-th slot of this sex
+
+        for r, slot in enumerate(slots):
+            winners[ candLocns[ranks == r], slot ] = cands[ranks == r]
+
+    return winners
+
+def timestepVec(parameters, popn, landscape, rng, stats=None, metrics=None):
+    """
+    popn, landscape = timestepVec(parameters, popn, landscape, rng, stats=None, metrics=None)
+
+    Array version of timestep: reproduction, dispersal, death of adults, and competition,
+    each done as batched operations over the whole generation
+
+    rng:
+        numpy random Generator, or a RandomStream (see carryover.py) whose generator is used
+    stats:
+        dictionary or None, if given stats['noPairs'] is set to the number of mating pairs after competition
+    metrics:
+        dictionary or None, if given the time of each phase and the counts are added to it (see metrics.py)
+    """
+
+    if isinstance(rng, RandomStream):
+        rng = rng.generator
+
+    if metrics is not None:
+        lap = time.perf_counter()
+
+    sexes = parameters['sexes']
+    landCodes = landscape2codes(parameters, landscape)
+    noLocns = len(landscape)
+
+    # reproduction
+
+    pairLocns, noOffspring = noOffspringArray(parameters, popn, landCodes)
+    parentLocns = np.repeat( pairLocns, noOffspring )
+    noOff = len(parentLocns)
+
+    sexIdxs = rng.integers( 0, len(sexes), size=noOff )
+    natalHabCodes = landCodes[parentLocns]
+    offGenotype = { geneType: offspringGenesArray( parameters, genes[parentLocns,0], genes[parentLocns,1], geneType, rng, metrics=metrics )
+            for geneType, genes in popn['genotype'].items() }
+
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'reproduction', lap)
+
+    # dispersal
+
+    newLocns = dispArray(parameters, offGenotype, natalHabCodes, parentLocns, landCodes, rng, None if isinstance(landscape, str) or landscape.topology == 'ring' else landscape, metrics)
+
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'dispersal', lap)
+
+    # survival, all adults assumed to die, and competition
+
+    winners = compnArray(parameters, sexIdxs, natalHabCodes, newLocns, noLocns, rng)
+
+    if metrics is not None:
+        lap = metricsPhase(metrics, 'competition', lap)
+
+    present = winners >= 0
+    winners[~present] = 0 # dummy index for empty slots, masked below
+
+    if noOff == 0: # nobody to fill the slots
+
+        natalHabCodes = np.zeros(1, dtype=np.uint8)
+        offGenotype = { geneType: genesZeros( parameters, geneType, (1,) ) for geneType in offGenotype }
+
+    popn = {
+            'present': present,
+            'natalHabType': np.where( present, natalHabCodes[winners], 0 ).astype(np.uint8),
+            'genotype': { geneType: genesWhere( present, genes[winners] ) for geneType, genes in offGenotype.items() },
+            }
+
+    if stats is not None:
+        stats['noPairs'] = int( present.all(axis=1).sum() )
+
+    if metrics is not None:
+        metricsPhase(metrics, 'death', lap)
+        noJuveniles = np.bincount(newLocns, minlength=noLocns)
+        metricsArrivals( metrics, noJuveniles[ noJuveniles > 0 ].tolist() )
+
+    return popn, landscape
+
+if __name__ == "__main__":
+
+    import doctest
+    doctest.testmod()